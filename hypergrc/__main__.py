@@ -26,13 +26,30 @@ import argparse
 import http.server
 import socketserver
 
-from .routes import PROJECT_LIST, ROUTES
+from .routes import PROJECT_LIST, ROUTES, SETTINGS, is_admin, path_matches, load_projects
+from . import metrics
+from . import profiling
+from .render import configure_templates, send_body, warm_templates
+from . import fragments
+from . import preload
+from . import opencontrol
+from . import repos
+from . import warmer
 
 # Read command-line arguments.
 
 parser = argparse.ArgumentParser(description='hyperGRC')
 parser.add_argument('--bind', default="localhost:8000", help='[host:]port to bind to')
 parser.add_argument('--showaddress', default=None, help='The address to recommend the user visit.')
+parser.add_argument('--admin-token', default=None, help='A secret that administrators present in the X-hyperGRC-Admin-Token header or hypergrc_admin_token cookie to use admin pages and profiling. Without it, admin features are only available from this machine.')
+parser.add_argument('--access-log', default=None, help='Write a structured (JSON lines) access log to this file, or to the console if `-`.')
+parser.add_argument('--template-cache', default=None, help='Directory to keep compiled templates in, which may be shared by several hyperGRC processes and filled ahead of time with `python -m hypergrc.render DIRECTORY`. Defaults to a directory in the system temporary directory.')
+parser.add_argument('--production', action='store_true', help='Assume templates do not change while hyperGRC is running and do not check them for changes.')
+parser.add_argument('--debug', action='store_true', help='Report the time spent loading and rendering templates on the console and in a Server-Timing header.')
+parser.add_argument('--fragment-cache-size', type=int, default=32, help='Megabytes (roughly) of rendered HTML fragments to keep in memory. Default 32.')
+parser.add_argument('--load-workers', type=int, default=0, help='Load the projects when hyperGRC starts, parsing their files in this many processes (1 to parse them in this process), instead of when they are first viewed.')
+parser.add_argument('--yaml-loader', choices=['libyaml', 'rtyaml'], default='libyaml', help='How to parse OpenControl files for reading: with PyYAML\'s faster C loader (the default, if PyYAML was built with libyaml) or always with rtyaml.')
+parser.add_argument('--warm-cpu-budget', type=float, default=0.25, help='The fraction of one CPU that the background cache warmer may use to rebuild stale data of recently viewed projects before it is needed. Default 0.25. 0 turns the warmer off.')
 parser.add_argument('project', nargs="*", default=["@repos.conf"], help='Path to a directory containing an opencontrol.yaml file for a system. Specify more than once to edit multiple system projects. Precede with an @-sign to read a list of directories from a newline-delimited text file.')
 args = parser.parse_args()
 
@@ -45,33 +62,61 @@ else:
   BIND_HOST = "localhost"
   BIND_PORT = args.bind
 
-# Read list of projects from the command-line and any @-prefixed listing files.
-# '@' prefixes are the Unixy-way of saying read a list from a file and use
-# the contents of the listing file as if they were command-line arguments.
-for project in args.project:
-  if project.startswith("@"):
-    # Read the listing file.
-    if not os.path.isfile(project[1:]):
-      fatal_error("File `{}` listing Compliance as Code repositories was not found.".format(project[1:]))
-    with open(project[1:], 'r') as f:
-      for line in f:
-        line = line.strip()
-        if line and not line.startswith("#"):
-          PROJECT_LIST.append(line)
-  else:
-    # Append this argument.
-    PROJECT_LIST.append(project)
+# Read list of projects from the command-line and any @-prefixed listing files,
+# and validate that each project path is valid. See repos.py.
+try:
+  repos.configure(args.project)
+except ValueError as e:
+  fatal_error(str(e))
+
+SETTINGS["admin_token"] = args.admin_token
+configure_templates(args.template_cache, production=args.production, debug=args.debug)
+fragments.SETTINGS["max_size"] = args.fragment_cache_size * 1024 * 1024
+opencontrol.SETTINGS["yaml_loader"] = args.yaml_loader
+if not (0 <= args.warm_cpu_budget <= 1):
+  fatal_error("--warm-cpu-budget must be between 0 and 1.")
+warmer.SETTINGS["cpu_budget"] = args.warm_cpu_budget
+
+# Open the structured access log, if requested.
+if args.access_log == "-":
+  ACCESS_LOG = sys.stdout
+elif args.access_log:
+  ACCESS_LOG = open(args.access_log, "a", encoding="utf8")
+else:
+  ACCESS_LOG = None
 
-# Validate that each project path is valid.
-for project in PROJECT_LIST:
-  if not os.path.isdir(project):
-    fatal_error("Path `{}` to Compliance as Code repository was not found.".format(project))
-  if not os.path.isfile(os.path.join(project, 'opencontrol.yaml')):
-    fatal_error("Path `{}` to Compliance as Code repository does not contain a file named opencontrol.yaml.".format(project))
+# Stands in for the response stream after the headers of a response to
+# a HEAD request are sent.
+class DiscardBody:
+  def __init__(self, wfile):
+    self.wfile = wfile
+  def write(self, data):
+    return len(data)
+  def __getattr__(self, name):
+    return getattr(self.wfile, name)
 
 # Define the basic HTTP server request handler which is called
 # on each HTTP request.
 class Handler(http.server.SimpleHTTPRequestHandler):
+  # Keep connections open for more requests. Every response must then say
+  # where it ends, with a Content-Length header or chunked transfer encoding
+  # (see render.py's render_template). Responses that do neither, like the
+  # /events streams, end the connection instead (see end_headers).
+  protocol_version = "HTTP/1.1"
+
+  def setup(self):
+    super().setup()
+    # Remember the stream that writes directly to the client's socket, so
+    # that files can be sent with sendfile when the response isn't being
+    # captured. See render.py's copy_file_to_response.
+    self.socket_wfile = self.wfile
+
+  def handle_one_request(self):
+    # The previous request on this connection may have been a HEAD request.
+    if isinstance(self.wfile, DiscardBody):
+      self.wfile = self.wfile.wfile
+    super().handle_one_request()
+
   def do_GET(self):
     if self.path.startswith("/static/"):
       # For /static only, serve static files.
@@ -80,6 +125,14 @@ class Handler(http.server.SimpleHTTPRequestHandler):
       # Otherwise, run one of our routes.
       self.do_request("GET")
 
+  def do_HEAD(self):
+    if self.path.startswith("/static/"):
+      super().do_HEAD()
+    else:
+      # Run the GET route. Only the headers of its response are sent (see
+      # end_headers).
+      self.do_request("HEAD")
+
   def do_POST(self):
     # Parse POST body.
     if not self.parse_request_body():
@@ -116,10 +169,107 @@ class Handler(http.server.SimpleHTTPRequestHandler):
       self.form = { key: value[0] if len(value) == 1 else value for key, value in self.form.items() }
       return True
 
-  # Handle a request (for something other than a static file).
+  # Remember the status code of the response for metrics and the access log.
+  def send_response(self, code, message=None):
+    self.status = code
+    self.response_length_known = False
+    super().send_response(code, message)
+
+  # Remember whether the response says where its body ends.
+  def send_header(self, keyword, value):
+    if keyword.lower() in ("content-length", "transfer-encoding"):
+      self.response_length_known = True
+    super().send_header(keyword, value)
+
+  # A response to a HEAD request has no body, so discard whatever the
+  # route writes after the headers. A response with a body of unknown
+  # length can only end by closing the connection.
+  def end_headers(self):
+    if not getattr(self, "response_length_known", True) and self.command != "HEAD" \
+      and self.status not in (204, 304):
+      self.close_connection = True
+    super().end_headers()
+    if self.command == "HEAD" and not isinstance(self.wfile, DiscardBody):
+      self.wfile = DiscardBody(self.wfile)
+
+  # Handle a request (for something other than a static file), recording
+  # how long it took, its route and its status.
   def do_request(self, method):
+    self.status = None
+    self.route_name = "not_found" # until a route matches
+    metrics.http_requests_in_flight.inc()
+    start = time.perf_counter()
+    try:
+      self.profile_request(method)
+    finally:
+      duration = time.perf_counter() - start
+      metrics.http_requests_in_flight.dec()
+      metrics.http_request_duration.observe(duration, route=self.route_name, method=method)
+      metrics.http_requests.inc(route=self.route_name, method=method, status=self.status or 500)
+      if ACCESS_LOG:
+        import json, datetime
+        ACCESS_LOG.write(json.dumps({
+          "time": datetime.datetime.utcnow().isoformat() + "Z",
+          "client": self.client_address[0],
+          "method": method,
+          "path": self.path,
+          "route": self.route_name,
+          "status": self.status or 500,
+          "duration_ms": round(duration * 1000, 3),
+        }) + "\n")
+        ACCESS_LOG.flush()
+
+  # Run the request under the profiler if an administrator asked for it by
+  # adding __profile to the query string or if all requests are being
+  # profiled. See profiling.py.
+  def profile_request(self, method):
+    self.path, profile_mode = profiling.take_profile_parameter(self.path)
+    if profile_mode is None and not profiling.SETTINGS["profile_all"]:
+      self.route_request(method)
+      return
+    if profile_mode is not None and not is_admin(self):
+      self.send_error(403, "Profiling is only available to administrators.")
+      return
+
+    # With a bare ?__profile, the report is sent instead of the page, so
+    # capture whatever the route writes. If the route fails, send what it
+    # wrote (its error page) after all.
+    send_report = (profile_mode == "")
+    if send_report:
+      import io
+      wfile = self.wfile
+      self.wfile = io.BytesIO()
+    try:
+      profiler, duration = profiling.run_profiled(lambda : self.route_request(method))
+    except Exception:
+      if send_report:
+        wfile.write(self.wfile.getvalue())
+        self.wfile = wfile
+      raise
+    if send_report:
+      response = self.wfile.getvalue()
+      self.wfile = wfile
+
+    # If another request was being profiled, this one wasn't. Send the page
+    # as usual.
+    if profiler is None:
+      if send_report:
+        self.wfile.write(response)
+      return
+
+    # Keep the report if it's among the slowest, and send it if asked.
+    report = profiling.make_report(profiler, duration, method, self.path)
+    profiling.keep_profile(method, self.path, duration, report)
+    if send_report:
+      send_body(self, 200, "text/plain; charset=UTF-8", report.encode("utf8"))
+
+  def route_request(self, method):
     # Add the method as an attribute on 'self'. Some route functions
     # will look at it to see if this is a GET or POST request, etc.
+    # HEAD requests are handled by GET routes, which can check
+    # self.command to skip making the body.
+    if method == "HEAD":
+      method = "GET"
     self.method = method
 
     # Find the (first) route that can handle this request. On a match,
@@ -138,6 +288,7 @@ class Handler(http.server.SimpleHTTPRequestHandler):
     # A route matched. Call the route's function passing it this request
     # and the parsed path parameters as keyword arguments.
     # See routes.py's parse_route_path_string.
+    self.route_name = route_function.__name__
     try:
       resp = route_function(self, **m)
     except Exception as e:
@@ -151,33 +302,41 @@ class Handler(http.server.SimpleHTTPRequestHandler):
     # as text/plain.
     if isinstance(resp, str):
       # Send string return values as plain text.
-      self.send_response(200)
-      self.send_header("Content-Type", "text/plain; charset=UTF-8")
-      self.end_headers()
-      self.wfile.write(resp.encode("utf8"))
-
-def path_matches(route_path, path):
-  # Does path match the route path specification in route_path?
-  # If so, return a dict mapping path components to parts of
-  # the input path. Un-URL-encode the values.
-  from urllib.parse import unquote_plus
-  m = route_path.match(path)
-  if m:
-    return {
-      k: unquote_plus(v)
-      for k, v
-      in m.groupdict().items()
-    }
-  return False
+      send_body(self, 200, "text/plain; charset=UTF-8", resp.encode("utf8"))
 
 # Start the HTTP server and simulated project loading
 try:
-  socketserver.TCPServer.allow_reuse_address = True
-  httpd = socketserver.TCPServer((BIND_HOST, int(BIND_PORT)), Handler)
+  # Compile the templates before accepting requests.
+  template_count, template_time = warm_templates()
+
+  # Load the projects before accepting requests, if asked.
+  if args.load_workers > 0:
+    load_start = time.perf_counter()
+    preloaded_file_count = preload.load_projects(list(load_projects()), args.load_workers)
+    load_time = time.perf_counter() - load_start
+
+  # Handle each request on its own thread so that long-lived requests,
+  # like the /events streams that pages keep open, don't hold up others.
+  class Server(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+  httpd = Server((BIND_HOST, int(BIND_PORT)), Handler)
+
+  # Pick up changes to repos.conf and other listing files while running.
+  repos.start_watcher()
+
+  # Rebuild stale data of recently viewed projects in the background.
+  warmer.start_warmer()
+
   COLRS = "\33[33m"
   COLRS2 = "\33[92m"
   COLRE = "\33[0m"
   sys.stdout.write(COLRS+"[hyperGRC] starting...\n"+COLRE)
+  sys.stdout.write(COLRS+"[hyperGRC] {} templates ready in {:.0f} ms\n".format(template_count, template_time * 1000)+COLRE)
+  if args.load_workers > 0:
+    sys.stdout.write(COLRS+"[hyperGRC] projects loaded in {:.1f} s ({} files parsed in {} processes)\n".format(load_time, preloaded_file_count, args.load_workers)+COLRE
+                     if preloaded_file_count else
+                     COLRS+"[hyperGRC] projects loaded in {:.1f} s\n".format(load_time)+COLRE)
   time.sleep(.800)
   for project in PROJECT_LIST:
     sys.stdout.write(COLRS+"\r[hyperGRC] loading {}".format(project)+COLRE)
@@ -0,0 +1,271 @@
+# A read-only JSON API over projects, components and control
+# implementations, for scripts. See the /api routes in routes.py.
+#
+# Lists are returned a page at a time, in a stable order, with an opaque
+# cursor for the next page. The cursor holds the sort key of the last item
+# returned, so pages stay consistent even if items are added or removed
+# between requests. Lists can be filtered on the server and the fields of
+# each item can be selected, e.g.:
+#
+#   /api/organizations/<organization>/projects/<project>/controls?family=AC&status=Planned&fields=control.id,narrative
+#
+# Control implementations are served from the coverage records that are
+# already cached for each project (see coverage.py), sorted once per change
+# to the project's files. Only the items on the requested page are turned
+# into JSON records.
+
+import base64
+import bisect
+import json
+
+from . import coverage
+from .cache import Cache
+
+# How many items are returned per page, unless the request asks for fewer.
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+
+_controls_index_cache = Cache("api")
+
+class ApiError(Exception):
+    # A problem with a request, reported to the client with an HTTP error
+    # status (400 unless given).
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf8")).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor):
+    # Turn a cursor back into a sort key. JSON turned the key's tuples into
+    # lists, so turn them back into tuples so that they compare with keys.
+    def tuplify(value):
+        if isinstance(value, list):
+            return tuple(tuplify(item) for item in value)
+        return value
+    if not isinstance(cursor, str):
+        # The cursor parameter was repeated.
+        raise ApiError("Invalid cursor.")
+    try:
+        key = tuplify(json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode("utf8")))
+    except ValueError:
+        raise ApiError("Invalid cursor.")
+    if not isinstance(key, tuple):
+        raise ApiError("Invalid cursor.")
+    return key
+
+def has_key_shape(value, key):
+    # Does value have the structure of the sort key key, so that the two
+    # can be compared? None may stand in for, or be stood in for by, anything.
+    # Tuples may differ in length, as control number sort keys do, since
+    # tuples are compared item by item only up to the shorter one's length.
+    if value is None or key is None:
+        return True
+    if isinstance(key, tuple):
+        return isinstance(value, tuple) \
+            and all(has_key_shape(v, k) for v, k in zip(value, key))
+    return type(value) is type(key)
+
+def get_list_parameter(query, name):
+    # Return the set of values given for a query string parameter, which may
+    # be repeated or hold comma-separated values, or None if it is absent.
+    values = query.get(name)
+    if values is None:
+        return None
+    if isinstance(values, str):
+        values = [values]
+    return set(value for item in values for value in item.split(","))
+
+def get_limit(query):
+    try:
+        limit = int(query.get("limit", DEFAULT_LIMIT))
+    except ValueError:
+        raise ApiError("limit must be a number.")
+    if limit < 1 or limit > MAX_LIMIT:
+        raise ApiError("limit must be between 1 and {}.".format(MAX_LIMIT))
+    return limit
+
+def paginate(keys, items, query, predicate=None, formatter=None, lo=0, hi=None):
+    # Return a page of items as a response object. keys are the sort keys of
+    # the items, in order. Only the items from lo to hi that pass predicate
+    # are included, and only the items on the page are passed to formatter.
+    limit = get_limit(query)
+    if hi is None:
+        hi = len(items)
+    start = lo
+    if query.get("cursor"):
+        # A cursor from another list (or made up) can't be compared with
+        # this list's keys.
+        cursor = decode_cursor(query["cursor"])
+        if lo < hi and not has_key_shape(cursor, keys[lo]):
+            raise ApiError("Invalid cursor.")
+        try:
+            start = bisect.bisect_right(keys, cursor, lo, hi)
+        except TypeError:
+            raise ApiError("Invalid cursor.")
+
+    page = []
+    next_cursor = None
+    for i in range(start, hi):
+        if predicate is not None and not predicate(items[i]):
+            continue
+        if len(page) == limit:
+            # There's at least one more item, so there's another page.
+            next_cursor = encode_cursor(keys[page[-1]])
+            break
+        page.append(i)
+
+    fields = get_list_parameter(query, "fields")
+    return {
+        "items": [
+            select_fields(formatter(items[i]) if formatter else items[i], fields)
+            for i in page
+        ],
+        "next_cursor": next_cursor,
+    }
+
+def select_fields(record, fields):
+    # Return a copy of record with only the given fields. Fields of nested
+    # records are given with dots, like "control.id".
+    if not fields:
+        return record
+    result = { }
+    for field in fields:
+        source = record
+        target = result
+        path = field.split(".")
+        for i, name in enumerate(path):
+            if not isinstance(source, dict) or name not in source:
+                break
+            if i == len(path) - 1:
+                target[name] = source[name]
+            else:
+                source = source[name]
+                target = target.setdefault(name, { })
+    return result
+
+# Projects.
+
+def format_project(project):
+    return {
+        "id": project["id"],
+        "organization": project["organization"],
+        "title": project["title"],
+        "description": project["description"],
+        "authorization_id": project["authorization_id"],
+        "source_repository": project["source_repository"],
+        "url": project["url"],
+        "api_url": "/api" + project["url"],
+    }
+
+def list_projects(projects, query):
+    projects = sorted(projects, key = lambda project : (project["title"], project["organization"]["id"], project["id"]))
+    keys = [(project["title"], project["organization"]["id"], project["id"]) for project in projects]
+    return paginate(keys, projects, query, formatter=format_project)
+
+# Components.
+
+def format_component(entry):
+    component = entry["component"]
+    return {
+        "id": component["id"],
+        "name": component["name"],
+        "url": component["url"],
+        "api_url": "/api" + component["url"],
+        "control_part_count": coverage.count(entry["coverage"]),
+    }
+
+def list_components(project, query):
+    index = load_project_index(project)
+    return paginate(index["component_keys"], index["components"], query, formatter=format_component)
+
+# Control implementations.
+
+def load_project_index(project):
+    # Return the project's components and control implementations in the
+    # order the API lists them, with their sort keys. Rebuilt whenever the
+    # project's coverage records are.
+    return _controls_index_cache.get(project["path"], lambda : build_project_index(project))
+
+def build_project_index(project):
+    project_coverage = coverage.load_project_coverage(project)
+
+    components = sorted(project_coverage.values(), key = lambda entry : (entry["component"]["name"], entry["component"]["id"]))
+
+    controls = []
+    for entry in components:
+        component = entry["component"]
+        for controlimpls in entry["narratives"].values():
+            # A component can have more than one narrative for the same
+            # control part. Their positions keep their keys unique, so a
+            # cursor never skips one.
+            for i, controlimpl in enumerate(controlimpls):
+                controls.append(((component["name"], component["id"]) + controlimpl["sort_key"] + (i,), controlimpl))
+    controls.sort(key = lambda item : item[0])
+
+    return {
+        "components": components,
+        "component_keys": [(entry["component"]["name"], entry["component"]["id"]) for entry in components],
+        "controls": [controlimpl for key, controlimpl in controls],
+        "control_keys": [key for key, controlimpl in controls],
+    }
+
+def format_controlimpl(controlimpl):
+    return {
+        "component": {
+            "id": controlimpl["component"]["id"],
+            "name": controlimpl["component"]["name"],
+            "url": controlimpl["component"]["url"],
+        },
+        "standard": {
+            "id": controlimpl["standard"]["id"],
+            "name": controlimpl["standard"]["name"],
+        },
+        "family": {
+            "id": controlimpl["family"]["id"],
+            "name": controlimpl["family"]["name"],
+        },
+        "control": {
+            "id": controlimpl["control"]["id"],
+            "number": controlimpl["control"]["number"],
+            "name": controlimpl["control"].get("name"),
+            "description": controlimpl["control"].get("description"),
+            "url": controlimpl["control"]["url"],
+        },
+        "control_part": controlimpl["control_part"],
+        "narrative": controlimpl["narrative"],
+        "implementation_status": controlimpl["implementation_status"],
+        "evidence": controlimpl["evidence"],
+        "source_file": controlimpl["source_file"],
+    }
+
+def list_controls(project, query, component_id=None):
+    # List the control implementations in a project, or in one component if
+    # component_id is given, filtered by the standard, family, status and
+    # component query string parameters.
+    index = load_project_index(project)
+    keys = index["control_keys"]
+
+    # A component's control implementations are a contiguous run of the list.
+    lo, hi = 0, len(keys)
+    if component_id is not None:
+        matches = [key for key in index["component_keys"] if key[1] == component_id]
+        if not matches:
+            raise ApiError("Component `{}` not found in project.".format(component_id), status=404)
+        lo = bisect.bisect_left(keys, matches[0])
+        hi = lo
+        while hi < len(keys) and keys[hi][:2] == matches[0]:
+            hi += 1
+
+    standards = get_list_parameter(query, "standard")
+    families = get_list_parameter(query, "family")
+    statuses = get_list_parameter(query, "status")
+    components = get_list_parameter(query, "component")
+    def predicate(controlimpl):
+        return (standards is None or controlimpl["standard"]["id"] in standards) \
+           and (families is None or controlimpl["family"]["id"] in families) \
+           and (statuses is None or controlimpl["implementation_status"] in statuses) \
+           and (components is None or controlimpl["component"]["id"] in components)
+
+    return paginate(keys, index["controls"], query, predicate=predicate, formatter=format_controlimpl, lo=lo, hi=hi)
@@ -0,0 +1,200 @@
+# Certification baselines and gap analysis.
+#
+# A project's certifications select the controls of each standard that
+# the project must implement --- its baseline. Gap analysis compares the
+# baseline with the controls that have a narrative in any of the project's
+# components, listing the controls that are certified but not implemented
+# (the gaps) and those that are implemented but not certified.
+#
+# Every control of a standard is given a position in a registry, and a set
+# of controls of a standard is then a Python int with the bit at each
+# control's position set. A project's baseline is computed once, with its
+# own registry, and cached until its certification files change, so the
+# registry is dropped along with it. The implemented controls come from the
+# per-component statistics that are already kept up to date (see
+# statistics.py), and comparing the two --- for one project or, in the
+# portfolio gap matrix, for every project --- is a handful of bit operations
+# per standard. Bits are only combined within one registry: implemented
+# controls are added to a copy of the baseline's registry, and the gap
+# matrix renumbers every project's baseline into one registry.
+
+from . import opencontrol
+from . import statistics
+from .cache import Cache
+
+_baseline_cache = Cache("baselines")
+
+def new_registry():
+    # A registry maps each standard id to the control ids in the order of
+    # their positions and to a mapping from control ids to their positions.
+    return { }
+
+def copy_registry(registry):
+    # Return a copy of a registry that controls can be added to without
+    # changing the positions of the controls already in it.
+    return {
+        standard_id: (list(ids), dict(positions))
+        for standard_id, (ids, positions) in registry.items()
+    }
+
+def get_control_bits(registry, standard_id, control_ids):
+    # Return the bits of the given controls of a standard, adding the
+    # controls to the registry if they aren't in it yet.
+    ids, positions = registry.setdefault(standard_id, ([], { }))
+    bits = 0
+    for control_id in control_ids:
+        position = positions.get(control_id)
+        if position is None:
+            position = positions[control_id] = len(ids)
+            ids.append(control_id)
+        bits |= 1 << position
+    return bits
+
+def iter_control_ids(registry, standard_id, bits):
+    # Yield the ids of the controls of a standard whose bits are set.
+    ids = registry[standard_id][0] if bits else []
+    while bits:
+        lowest = bits & -bits
+        yield ids[lowest.bit_length() - 1]
+        bits ^= lowest
+
+def get_control_ids(registry, standard_id, bits):
+    # Return the ids of the controls of a standard whose bits are set,
+    # sorted by control number.
+    return sorted(iter_control_ids(registry, standard_id, bits), key=opencontrol.make_control_number_sort_key)
+
+def is_set(registry, standard_id, bits, control_id):
+    position = registry.get(standard_id, (None, { }))[1].get(control_id)
+    return position is not None and bool(bits >> position & 1)
+
+def count_bits(bits):
+    return bin(bits).count("1")
+
+def load_project_baseline(project):
+    # Return the project's baseline: a registry of the controls that the
+    # project's certifications select, and a mapping from the id of each
+    # standard they select controls from to the bits of those controls.
+    # The registry is cached with the baseline, so it must not be changed.
+    def builder():
+        certified_controls = { }
+        for standard_id, control_id in opencontrol.load_project_certified_controls(project):
+            certified_controls.setdefault(standard_id, []).append(control_id)
+        registry = new_registry()
+        return {
+            "registry": registry,
+            "controls": {
+                standard_id: get_control_bits(registry, standard_id, control_ids)
+                for standard_id, control_ids in certified_controls.items()
+            },
+        }
+    return _baseline_cache.get(project["path"], builder)
+
+def load_project_implemented(project, registry):
+    # Return a mapping from standard ids to the bits of the controls that
+    # any component has a narrative for, adding them to the registry.
+    # Statistics identify controls by standard name, which is also the
+    # standard's id (see load_standard).
+    implemented_controls = { }
+    for stats in statistics.load_project_statistics(project).values():
+        for standard_id, control_id in stats["controls"]:
+            implemented_controls.setdefault(standard_id, set()).add(control_id)
+    return {
+        standard_id: get_control_bits(registry, standard_id, control_ids)
+        for standard_id, control_ids in implemented_controls.items()
+    }
+
+def build_project_gaps(project):
+    # Return the gap analysis of a project: for each standard in the
+    # project's baseline, the certified controls that aren't implemented and
+    # the implemented controls that aren't certified. Implemented controls
+    # of standards that no certification selects from are all in scope, so
+    # those standards are only listed by id.
+    baseline = load_project_baseline(project)
+    registry = copy_registry(baseline["registry"])
+    implemented = load_project_implemented(project, registry)
+    baseline = baseline["controls"]
+    standards = []
+    for standard_id, certified in sorted(baseline.items()):
+        implemented_bits = implemented.get(standard_id, 0)
+        standards.append({
+            "id": standard_id,
+            "certified_controls": count_bits(certified),
+            "certified_controls_implemented": count_bits(certified & implemented_bits),
+            "certified_unimplemented": get_control_ids(registry, standard_id, certified & ~implemented_bits),
+            "implemented_uncertified": get_control_ids(registry, standard_id, implemented_bits & ~certified),
+        })
+    return {
+        "standards": standards,
+        "uncertified_standards": sorted(standard_id for standard_id in implemented if standard_id not in baseline),
+    }
+
+def build_gap_matrix(projects):
+    # Return the portfolio gap matrix: for each standard that any project's
+    # certifications select from, the controls that are a gap (certified but
+    # not implemented) or implemented but not certified in at least one
+    # project, and for each project the status of each of those controls:
+    # "gap", "uncertified", "met" (certified and implemented), or None
+    # (neither certified nor implemented).
+    # Each project's baseline has its own registry, so renumber the
+    # baselines into one registry that the implemented controls are then
+    # added to.
+    registry = new_registry()
+    baselines = []
+    for project in projects:
+        baseline = load_project_baseline(project)
+        baselines.append({
+            standard_id: get_control_bits(registry, standard_id, iter_control_ids(baseline["registry"], standard_id, bits))
+            for standard_id, bits in baseline["controls"].items()
+        })
+    implemented = [load_project_implemented(project, registry) for project in projects]
+
+    standards = []
+    for standard_id in sorted(set(standard_id for baseline in baselines for standard_id in baseline)):
+        rows = []
+        any_gap = 0
+        for baseline, implemented_controls in zip(baselines, implemented):
+            if standard_id not in baseline:
+                rows.append(None)
+                continue
+            certified = baseline[standard_id]
+            implemented_bits = implemented_controls.get(standard_id, 0)
+            rows.append((certified, implemented_bits))
+            any_gap |= certified ^ implemented_bits
+        control_ids = get_control_ids(registry, standard_id, any_gap)
+
+        def status(certified, implemented_bits, control_id):
+            if not is_set(registry, standard_id, certified | implemented_bits, control_id):
+                return None
+            if not is_set(registry, standard_id, implemented_bits, control_id):
+                return "gap"
+            if not is_set(registry, standard_id, certified, control_id):
+                return "uncertified"
+            return "met"
+
+        standards.append({
+            "id": standard_id,
+            "controls": control_ids,
+            "projects": [
+                None if row is None else {
+                    "certified_controls": count_bits(row[0]),
+                    "certified_controls_implemented": count_bits(row[0] & row[1]),
+                    "gaps": count_bits(row[0] & ~row[1]),
+                    "implemented_uncertified": count_bits(row[1] & ~row[0]),
+                    "controls": [status(row[0], row[1], control_id) for control_id in control_ids],
+                }
+                for row in rows
+            ],
+        })
+
+    return {
+        "projects": [
+            {
+                "id": project["id"],
+                "organization": project["organization"]["id"],
+                "title": project["title"],
+                "url": project["url"],
+            }
+            for project in projects
+        ],
+        "standards": standards,
+    }
@@ -0,0 +1,3 @@
+# Tools for measuring hyperGRC's performance: a generator of synthetic
+# OpenControl repositories of any size (generate.py) and a benchmark runner
+# that times every route against them (python -m hypergrc.benchmark).
@@ -0,0 +1,259 @@
+# Benchmark hyperGRC end to end.
+#
+# Times a request to every route in routes.ROUTES, plus building the SSP
+# and CSV exports directly, against the projects given on the command
+# line --- usually repositories made by generate.py. Each case is run
+# once "cold", with every cache flushed first, and then repeatedly "warm".
+# Reports the median and 95th percentile times and the peak memory
+# allocated by a cold run, and compares them with a saved baseline:
+#
+#   python -m hypergrc.benchmark.generate /tmp/bench
+#   python -m hypergrc.benchmark @/tmp/bench/repos.conf --save-baseline baseline.json
+#   (make a change)
+#   python -m hypergrc.benchmark @/tmp/bench/repos.conf --baseline baseline.json
+#
+# The exit status is 1 if any case regressed beyond the tolerance.
+#
+# Routes are called in-process through a stand-in for the HTTP request
+# handler so that the timings measure hyperGRC and not the network.
+
+import json
+import os.path
+import sys
+import time
+import tracemalloc
+from urllib.parse import quote_plus
+
+from .. import routes, opencontrol
+from ..cache import CACHES
+from ..render import CapturedRequest
+
+# Routes that modify the repositories are not benchmarked, and neither
+# is the events stream, which runs until the client disconnects.
+SKIPPED_ROUTES = {
+    "update_control",
+    "project_events",
+}
+
+def dispatch(method, path, form=None):
+    # Handle a request the way __main__.Handler.route_request does and
+    # return the request object holding the response.
+    request = CapturedRequest(method, path, form)
+    for methods, route_path, route_function in routes.ROUTES:
+        if method in methods:
+            m = routes.path_matches(route_path, path)
+            if m is not False:
+                break
+    else:
+        request.send_error(404)
+        return request
+    resp = route_function(request, **m)
+    if isinstance(resp, str):
+        request.send_response(200)
+        request.wfile.write(resp.encode("utf8"))
+    return request
+
+def make_sample_requests(project):
+    # Return a dict mapping route function names to a sample (method, path,
+    # form) request for the route, using the given project.
+    components = list(opencontrol.load_project_components(project))
+    component = components[0]
+    standards = opencontrol.load_project_standards(project)
+    controlimpl = next(iter(opencontrol.load_project_component_controls(component, standards)))
+
+    # Find a document.
+    document = None
+    for doc_dir, dirs, files in sorted(os.walk(os.path.join(project["path"], "outputs"))):
+        if files:
+            document = os.path.relpath(os.path.join(doc_dir, sorted(files)[0]), os.path.join(project["path"], "outputs"))
+            break
+
+    P = project["url"]
+    C = component["url"]
+    component_urls = [c["url"] for c in components]
+    requests = {
+        "index": ("GET", "/", None),
+        "dashboard": ("GET", "/dashboard", None),
+        "dashboard_json": ("GET", "/dashboard.json", None),
+        "gap_matrix": ("GET", "/gaps", None),
+        "project": ("GET", P, None),
+        "documents": ("GET", P + "/documents", None),
+        "team": ("GET", P + "/team", None),
+        "settings": ("GET", "/settings", None),
+        "project_settings": ("GET", P + "/settings", None),
+        "assessments": ("GET", P + "/assessments", None),
+        "poams": ("GET", P + "/poams", None),
+        "component": ("GET", C, None),
+        "component_statistics": ("GET", C + "/statistics.json", None),
+        "project_statistics": ("GET", P + "/statistics.json", None),
+        "portfolio_statistics": ("GET", "/statistics.json", None),
+        "bulk_component_statistics": ("POST", "/component-statistics.json", { "component": component_urls }),
+        "component_guide": ("GET", C + "/guide", None),
+        "controls": ("GET", P + "/controls", None),
+        "project_gaps": ("GET", P + "/gaps", None),
+        "project_control_grid": ("GET", controlimpl["control"]["url"] + "/grid", None),
+        "evidence": ("GET", P + "/evidence", None),
+        "ssp": ("GET", P + "/ssp.md", None),
+        "component_app_export": ("GET", C + "/app.yaml", None),
+        "create_system": ("GET", "/create-system", None),
+        "add_component": ("GET", P + "/add-component", None),
+        "all_components": ("GET", "/all-components", None),
+        "component_comparison": ("POST", "/component-comparison", { "component_selected": component_urls[:10] }),
+        "narrative_duplicates": ("GET", "/narrative-duplicates", None),
+        "prometheus_metrics": ("GET", "/metrics", None),
+        "admin_profiles": ("GET", "/admin/profiles", None),
+        "admin_profile": ("GET", "/admin/profiles/1", None),
+        "admin_warmer": ("GET", "/admin/warmer", None),
+        "admin_caches": ("GET", "/admin/caches", None),
+        "admin_caches_json": ("GET", "/admin/caches.json", None),
+        "custom_css": ("GET", P + "/_extensions/hypergrc/static/css/repo.css", None),
+        "api_projects": ("GET", "/api/projects", None),
+        "api_components": ("GET", "/api" + P + "/components", None),
+        "api_controls": ("GET", "/api" + P + "/controls?status=Planned", None),
+        "api_component_controls": ("GET", "/api" + C + "/controls", None),
+        "api_gap_matrix": ("GET", "/api/gaps", None),
+        "api_project_gaps": ("GET", "/api" + P + "/gaps", None),
+    }
+    if document:
+        requests["document"] = ("GET", P + "/documents/?f=" + quote_plus(document.replace(os.sep, ">")), None)
+    return requests
+
+def make_cases(projects):
+    # Return a list of (name, function) benchmark cases and a list of the
+    # names of routes that have no case.
+    project = projects[0]
+    sample_requests = make_sample_requests(project)
+    cases = []
+    missing = []
+    for methods, route_path, route_function in routes.ROUTES:
+        name = route_function.__name__
+        if name in SKIPPED_ROUTES:
+            continue
+        if name not in sample_requests:
+            missing.append(name)
+            continue
+        method, path, form = sample_requests[name]
+        cases.append((name, lambda method=method, path=path, form=form : dispatch(method, path, form)))
+
+    from ..ssp import build_ssp
+    from ..csv import build_csv
+    cases.append(("build_ssp", lambda : build_ssp(project, {})))
+    cases.append(("build_csv", lambda : build_csv(project, {})))
+    return cases, missing
+
+def flush_caches():
+    for cache in CACHES:
+        cache.invalidate()
+
+def check_response(name, result):
+    # Route cases return the request. Fail loudly on errors so that a
+    # broken route doesn't look fast.
+    if isinstance(result, CapturedRequest) and (result.status or 500) >= 400:
+        raise Exception("{} returned HTTP status {}.".format(name, result.status))
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def run_case(name, function, repeat, measure_memory):
+    result = { }
+
+    # Cold.
+    flush_caches()
+    start = time.perf_counter()
+    check_response(name, function())
+    result["cold_ms"] = (time.perf_counter() - start) * 1000
+
+    # Warm.
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        check_response(name, function())
+        times.append((time.perf_counter() - start) * 1000)
+    result["warm_p50_ms"] = percentile(times, 50)
+    result["warm_p95_ms"] = percentile(times, 95)
+
+    # Peak memory of a cold run. Tracing slows everything down, so this is
+    # a separate run.
+    if measure_memory:
+        flush_caches()
+        tracemalloc.start()
+        try:
+            function()
+            result["peak_kb"] = tracemalloc.get_traced_memory()[1] / 1024
+        finally:
+            tracemalloc.stop()
+
+    return result
+
+def compare(results, baseline, tolerance, min_ms):
+    # Return a list of (case, measure, baseline value, new value) for each
+    # measure that got worse by more than tolerance (a fraction). Times
+    # that changed by less than min_ms are ignored as noise.
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline:
+            continue
+        for measure, value in result.items():
+            old = baseline[name].get(measure)
+            if old is None:
+                continue
+            if measure.endswith("_ms") and value - old < min_ms:
+                continue
+            if value > old * (1 + tolerance):
+                regressions.append((name, measure, old, value))
+    return regressions
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Benchmark hyperGRC's routes.", fromfile_prefix_chars="@")
+    parser.add_argument("p", nargs="+", help="project directories to load (or @file to read them from a file)")
+    parser.add_argument("--repeat", type=int, default=10, help="number of warm runs of each case")
+    parser.add_argument("--only", action="append", help="run only the named case (may be repeated)")
+    parser.add_argument("--no-memory", action="store_true", help="skip measuring peak memory")
+    parser.add_argument("--save-baseline", metavar="FILE", help="save the results to FILE")
+    parser.add_argument("--baseline", metavar="FILE", help="compare the results with those saved in FILE")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed fractional regression (default 0.2)")
+    parser.add_argument("--min-ms", type=float, default=1.0, help="ignore time differences smaller than this (default 1.0)")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    routes.PROJECT_LIST.extend(args.p)
+    projects = list(routes.load_projects())
+    if not projects:
+        print("No projects.", file=sys.stderr)
+        sys.exit(2)
+
+    cases, missing = make_cases(projects)
+    if args.only:
+        cases = [(name, function) for name, function in cases if name in args.only]
+
+    results = { }
+    for name, function in cases:
+        results[name] = run_case(name, function, args.repeat, not args.no_memory)
+        if not args.json:
+            r = results[name]
+            print("{:<28} cold {:9.1f} ms   warm p50 {:9.1f} ms  p95 {:9.1f} ms{}".format(
+                name, r["cold_ms"], r["warm_p50_ms"], r["warm_p95_ms"],
+                "   peak {:9.0f} KB".format(r["peak_kb"]) if "peak_kb" in r else ""), flush=True)
+
+    if args.json:
+        print(json.dumps(results, indent=2, sort_keys=True))
+    if missing:
+        print("Routes without a benchmark case: " + ", ".join(missing), file=sys.stderr)
+
+    if args.save_baseline:
+        with open(args.save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance, args.min_ms)
+        for name, measure, old, new in regressions:
+            print("REGRESSION {} {}: {:.1f} -> {:.1f}".format(name, measure, old, new), file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+        print("No regressions beyond {:.0%} of the baseline.".format(args.tolerance), file=sys.stderr)
+
+main()
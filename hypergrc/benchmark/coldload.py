@@ -0,0 +1,87 @@
+# Benchmark loading projects cold, serially and in parallel.
+#
+# Times preload.load_projects, with every cache flushed first, with 1
+# worker (the serial path, which parses each file when it is first
+# needed) and with each other number of worker processes given, and
+# checks that the parallel loads produce exactly the same data in the same
+# order as the serial load:
+#
+#   python -m hypergrc.benchmark.generate /tmp/bench --components 300
+#   python -m hypergrc.benchmark.coldload @/tmp/bench/repos.conf --workers 1,4,16
+#
+# The exit status is 1 if a parallel load produced different data.
+
+import hashlib
+import os
+import sys
+import time
+
+from .. import routes, preload, coverage, statistics
+from ..cache import CACHES
+
+def flush_caches():
+    for cache in CACHES:
+        cache.invalidate()
+
+def digest_projects(projects):
+    # Return a hash of the loaded control implementations and statistics,
+    # in the order they were loaded.
+    h = hashlib.sha1()
+    for project in projects:
+        for component_id, entry in coverage.load_project_coverage(project).items():
+            for controlimpls in entry["narratives"].values():
+                for controlimpl in controlimpls:
+                    h.update(repr((
+                        component_id,
+                        controlimpl["source_file"],
+                        controlimpl["sort_key"],
+                        controlimpl["control"].get("name"),
+                        controlimpl["family"]["name"],
+                        controlimpl["narrative"],
+                        controlimpl["implementation_status"],
+                        controlimpl["evidence"],
+                    )).encode("utf8"))
+        for component_id, stats in sorted(statistics.load_project_statistics(project).items()):
+            h.update(repr((component_id, statistics.summarize_statistics(stats))).encode("utf8"))
+    return h.hexdigest()
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Benchmark loading projects cold, serially and in parallel.", fromfile_prefix_chars="@")
+    parser.add_argument("p", nargs="+", help="project directories to load (or @file to read them from a file)")
+    parser.add_argument("--workers", default="1,{}".format(os.cpu_count() or 1), help="comma-separated numbers of worker processes to try (default 1 and the number of CPUs)")
+    parser.add_argument("--repeat", type=int, default=3, help="number of loads with each number of workers (default 3)")
+    args = parser.parse_args()
+
+    routes.PROJECT_LIST.extend(args.p)
+    projects = list(routes.load_projects())
+    if not projects:
+        print("No projects.", file=sys.stderr)
+        sys.exit(2)
+
+    worker_counts = sorted(set([1] + [int(n) for n in args.workers.split(",")]))
+    serial_digest = None
+    mismatches = []
+    for workers in worker_counts:
+        times = []
+        for i in range(args.repeat):
+            flush_caches()
+            start = time.perf_counter()
+            file_count = preload.load_projects(projects, workers)
+            times.append(time.perf_counter() - start)
+        digest = digest_projects(projects)
+        if serial_digest is None:
+            serial_digest = digest
+        elif digest != serial_digest:
+            mismatches.append(workers)
+        times.sort()
+        print("{:>3} worker{}  best {:8.2f} s   median {:8.2f} s{}{}".format(
+            workers, " " if workers == 1 else "s", times[0], times[len(times) // 2],
+            "   ({} files preloaded)".format(file_count) if file_count else "",
+            "   DIFFERENT DATA" if digest != serial_digest else ""), flush=True)
+
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,225 @@
+# Generate synthetic OpenControl repositories of configurable size for
+# benchmarking.
+#
+# Each generated project is a system with components whose control
+# narratives are drawn from the real control IDs in the NIST SP 800-53
+# standard in ref/, split across nested "satisfies" files the way
+# hyperGRC supports, with evidence and output documents. Generation is
+# deterministic for a given seed.
+
+import os.path
+import random
+import shutil
+
+import rtyaml
+
+from .. import opencontrol
+
+REF_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..", "ref")
+STANDARD_FN = os.path.join(REF_DIR, "standards", "NIST-SP-800-53-rev4.yaml")
+CERTIFICATION_FN = os.path.join(REF_DIR, "certifications", "fisma-low-impact.yaml")
+
+DEFAULTS = {
+    "projects": 3,
+    "components": 20, # per project
+    "controls": 40, # per component
+    "parts": 2, # per control
+    "narrative_words": 80, # per control part
+    "files": 4, # nested satisfies files per component
+    "evidence": 3, # per component
+    "documents": 10, # per project
+    "duplicate_rate": 0.1, # fraction of narratives copied from another component
+    "seed": 1,
+}
+
+STATUSES = ["In Place", "Partially in Place", "Planned", "Not Applicable", ""]
+
+WORDS = """
+access account accounts administrator agency application approved audit authentication
+authorization automated backup baseline boundary change configuration contingency control
+controls credentials data defined documented employs encryption enforces environment event
+events federal firewall function identifies implements incident information integrity
+interconnection logging maintains malicious management mechanisms monitoring network
+organization organizational personnel physical policy privileged procedures process protection
+recovery records remote reviews risk roles scanning security sessions software system systems
+technical third-party updates users vulnerability
+""".split()
+
+def load_control_ids():
+    # Return the IDs of the controls in the NIST SP 800-53 standard in ref/.
+    standard = opencontrol.load_opencontrol_yaml(STANDARD_FN, "standard", None)
+    return [
+        control_id for control_id, control in standard.items()
+        if isinstance(control, dict) and control.get("type") is None
+    ]
+
+def make_narrative(rng, n):
+    words = [rng.choice(WORDS) for i in range(n)]
+    sentences = []
+    while words:
+        k = rng.randint(6, 14)
+        sentence, words = words[:k], words[k:]
+        sentences.append(" ".join(sentence).capitalize() + ".")
+    return " ".join(sentences)
+
+def mutate_narrative(rng, text):
+    # Copy-pasted narratives drift: change a few words.
+    words = text.split(" ")
+    for i in range(max(1, len(words) // 20)):
+        words[rng.randrange(len(words))] = rng.choice(WORDS)
+    return " ".join(words)
+
+def generate_component(rng, component_dir, name, control_ids, narratives, options):
+    # Write a component.yaml file and its nested satisfies files.
+    os.makedirs(component_dir)
+
+    # Evidence.
+    verifications = []
+    for i in range(options["evidence"]):
+        key = "{}-evidence-{}".format(name, i+1)
+        verifications.append({
+            "key": key,
+            "name": "Evidence {} for {}".format(i+1, name),
+            "path": "evidence/{}.txt".format(key),
+            "type": "document",
+        })
+    if verifications:
+        os.makedirs(os.path.join(component_dir, "evidence"))
+        for verification in verifications:
+            with open(os.path.join(component_dir, verification["path"]), "w", encoding="utf8") as f:
+                f.write(make_narrative(rng, 40) + "\n")
+
+    # Controls, dealt out round-robin into the nested files.
+    files = [[] for i in range(max(1, options["files"]))]
+    for i, control_id in enumerate(rng.sample(control_ids, min(options["controls"], len(control_ids)))):
+        narrative = []
+        for j in range(options["parts"]):
+            if narratives and rng.random() < options["duplicate_rate"]:
+                text = mutate_narrative(rng, rng.choice(narratives))
+            else:
+                text = make_narrative(rng, options["narrative_words"])
+                narratives.append(text)
+            part = { }
+            if options["parts"] > 1:
+                part["key"] = "abcdefghijklmnopqrstuvwxyz"[j % 26]
+            part["text"] = text
+            status = rng.choice(STATUSES)
+            if status:
+                part["implementation_status"] = status
+            narrative.append(part)
+        control = {
+            "control_key": control_id,
+            "standard_key": "NIST SP 800-53 Revision 4",
+            "covered_by": [
+                { "verification_key": verification["key"] }
+                for verification in rng.sample(verifications, min(len(verifications), 1))
+            ],
+            "narrative": narrative,
+        }
+        files[i % len(files)].append(control)
+
+    file_names = []
+    for i, controls in enumerate(files):
+        fn = "controls-{}.yaml".format(i+1)
+        file_names.append(fn)
+        with open(os.path.join(component_dir, fn), "w", encoding="utf8") as f:
+            f.write(rtyaml.dump({
+                "name": name,
+                "schema_version": "3.0.0",
+                "satisfies": controls,
+            }))
+
+    with open(os.path.join(component_dir, "component.yaml"), "w", encoding="utf8") as f:
+        f.write(rtyaml.dump({
+            "name": name,
+            "schema_version": "3.0.0",
+            "satisfies": file_names,
+            "verifications": verifications,
+        }))
+
+def generate_project(rng, project_dir, index, control_ids, narratives, options):
+    # Write an OpenControl system repository.
+    os.makedirs(os.path.join(project_dir, "standards"))
+    os.makedirs(os.path.join(project_dir, "certifications"))
+    shutil.copyfile(STANDARD_FN, os.path.join(project_dir, "standards", "NIST-SP-800-53-rev4.yaml"))
+    shutil.copyfile(CERTIFICATION_FN, os.path.join(project_dir, "certifications", "fisma-low-impact.yaml"))
+
+    component_paths = []
+    for i in range(options["components"]):
+        name = "Component {:04d}".format(i+1)
+        path = os.path.join("components", "Component{:04d}".format(i+1))
+        generate_component(rng, os.path.join(project_dir, path), name, control_ids, narratives, options)
+        component_paths.append("./" + path)
+
+    # Output documents, in nested directories.
+    for i in range(options["documents"]):
+        doc_dir = os.path.join(project_dir, "outputs", "batch-{}".format(i // 10 + 1))
+        os.makedirs(doc_dir, exist_ok=True)
+        with open(os.path.join(doc_dir, "document-{}.md".format(i+1)), "w", encoding="utf8") as f:
+            f.write("# Document {}\n\n{}\n".format(i+1, make_narrative(rng, 200)))
+
+    # A custom stylesheet.
+    css_dir = os.path.join(project_dir, "_extensions", "hypergrc", "static", "css")
+    os.makedirs(css_dir)
+    with open(os.path.join(css_dir, "repo.css"), "w", encoding="utf8") as f:
+        f.write("#navbar {{ background-color: #{:06x}; }}\n".format(rng.randrange(0x1000000)))
+
+    # The team file.
+    os.makedirs(os.path.join(project_dir, "team"))
+    with open(os.path.join(project_dir, "team", "team.yaml"), "w", encoding="utf8") as f:
+        f.write(rtyaml.dump({
+            "name": "Team",
+            "team": [{ "name": "Person {}".format(i+1), "role": rng.choice(["ISSO", "ISSM", "Developer"]) } for i in range(5)],
+        }))
+
+    with open(os.path.join(project_dir, "opencontrol.yaml"), "w", encoding="utf8") as f:
+        f.write(rtyaml.dump({
+            "schema_version": "1.0.0",
+            "name": "Benchmark System {:03d}".format(index+1),
+            "metadata": {
+                "description": "A synthetic system for benchmarking hyperGRC.",
+                "organization": {
+                    "name": "Benchmark Organization {}".format(index % 3 + 1),
+                    "abbreviation": "BENCH{}".format(index % 3 + 1),
+                },
+            },
+            "components": component_paths,
+            "standards": ["./standards/NIST-SP-800-53-rev4.yaml"],
+            "certifications": ["./certifications/fisma-low-impact.yaml"],
+        }))
+
+def generate(output_dir, **options):
+    # Generate projects in output_dir, which must not exist, and a repos.conf
+    # file listing them. Returns the list of project directories.
+    options = dict(DEFAULTS, **{ k: v for k, v in options.items() if v is not None })
+    rng = random.Random(options["seed"])
+    control_ids = load_control_ids()
+    narratives = []
+    os.makedirs(output_dir)
+    project_dirs = []
+    for i in range(options["projects"]):
+        project_dir = os.path.join(output_dir, "system-{:03d}".format(i+1))
+        generate_project(rng, project_dir, i, control_ids, narratives, options)
+        project_dirs.append(project_dir)
+    with open(os.path.join(output_dir, "repos.conf"), "w", encoding="utf8") as f:
+        for project_dir in project_dirs:
+            f.write(os.path.abspath(project_dir) + "\n")
+    return project_dirs
+
+def add_arguments(parser):
+    # Add command-line arguments for each generator option.
+    for option, default in DEFAULTS.items():
+        parser.add_argument("--" + option.replace("_", "-"), dest=option, type=type(default), default=None,
+                            help="(default {})".format(default))
+
+if __name__ == "__main__":
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Generate synthetic OpenControl repositories for benchmarking hyperGRC.")
+    parser.add_argument("output_dir", help="directory to create the repositories in (must not exist)")
+    add_arguments(parser)
+    args = parser.parse_args()
+    options = vars(args)
+    output_dir = options.pop("output_dir")
+    project_dirs = generate(output_dir, **options)
+    print("Generated {} projects. Start hyperGRC with: python -m hypergrc @{}".format(
+        len(project_dirs), os.path.join(output_dir, "repos.conf")))
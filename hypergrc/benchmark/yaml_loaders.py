@@ -0,0 +1,100 @@
+# Compare the YAML loaders that opencontrol.load_opencontrol_yaml can use.
+#
+# Parses every YAML file in the given directories (by default ref/ and
+# example/) with rtyaml and with PyYAML's libyaml-based C loader, checks
+# that both produce the same data --- the same values of the same types,
+# with mapping keys in the same order --- and reports how long each took:
+#
+#   python -m hypergrc.benchmark.yaml_loaders
+#   python -m hypergrc.benchmark.yaml_loaders /tmp/bench
+#
+# The exit status is 1 if any file is loaded differently, or 2 if PyYAML
+# was built without libyaml, in which case only rtyaml is used.
+
+import os
+import sys
+import time
+
+import rtyaml
+import yaml
+
+from .. import opencontrol
+
+def find_yaml_files(directories):
+    for directory in directories:
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            for fn in sorted(filenames):
+                if fn.endswith((".yaml", ".yml")):
+                    yield os.path.join(dirpath, fn)
+
+def find_difference(a, b, path="$"):
+    # Return a description of the first difference between two parsed YAML
+    # values, or None if they are the same.
+    if isinstance(a, dict) and isinstance(b, dict):
+        if list(a) != list(b):
+            return "{}: keys {} != {}".format(path, list(a), list(b))
+        for key in a:
+            difference = find_difference(a[key], b[key], "{}.{}".format(path, key))
+            if difference:
+                return difference
+        return None
+    if isinstance(a, list) and isinstance(b, list):
+        if len(a) != len(b):
+            return "{}: {} items != {} items".format(path, len(a), len(b))
+        for i, (x, y) in enumerate(zip(a, b)):
+            difference = find_difference(x, y, "{}[{}]".format(path, i))
+            if difference:
+                return difference
+        return None
+    if type(a) != type(b) or a != b:
+        return "{}: {!r} != {!r}".format(path, a, b)
+    return None
+
+def load(fn, loader):
+    with open(fn, encoding="utf8") as f:
+        start = time.perf_counter()
+        if loader == "rtyaml":
+            data = rtyaml.load(f)
+        else:
+            data = yaml.load(f, Loader=opencontrol.FastYamlLoader)
+        return data, time.perf_counter() - start
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Check that the YAML loaders produce the same data, and time them.")
+    parser.add_argument("directory", nargs="*", help="directories of YAML files (default ref and example)")
+    args = parser.parse_args()
+
+    if opencontrol.FastYamlLoader is None:
+        print("PyYAML was built without libyaml. hyperGRC will use rtyaml.", file=sys.stderr)
+        sys.exit(2)
+
+    directories = args.directory
+    if not directories:
+        root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+        directories = [os.path.join(root, "ref"), os.path.join(root, "example")]
+
+    times = { "rtyaml": 0, "libyaml": 0 }
+    file_count = 0
+    differences = 0
+    for fn in find_yaml_files(directories):
+        file_count += 1
+        results = { }
+        for loader in times:
+            results[loader], duration = load(fn, loader)
+            times[loader] += duration
+        difference = find_difference(results["rtyaml"], results["libyaml"])
+        if difference:
+            differences += 1
+            print("{}: {}".format(fn, difference), file=sys.stderr)
+
+    print("{} files, {} loaded differently".format(file_count, differences))
+    for loader, duration in sorted(times.items()):
+        print("{:<8} {:9.1f} ms".format(loader, duration * 1000))
+
+    if differences:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
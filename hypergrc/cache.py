@@ -0,0 +1,251 @@
+# Caching of data derived from the files in OpenControl repositories.
+#
+# hyperGRC has no database --- everything it shows is derived from YAML
+# files on disk that users may edit at any time, with hyperGRC or with any
+# other tool. So every cached value remembers which files it was built
+# from and the modification time and size of each file when it was read.
+# A cached value is only used if none of those files have changed since.
+#
+# Dependencies are recorded automatically: opencontrol.load_opencontrol_yaml
+# calls record_dependency for every file it reads, and the files are added
+# to every cache entry that is being built at that moment on this thread.
+
+import contextlib
+import copy
+import os
+import threading
+import time
+
+from . import metrics
+
+# All of the caches that have been created, so that they can be inspected
+# and flushed together.
+CACHES = []
+
+_local = threading.local()
+
+def file_fingerprint(fn):
+    # Return a value that changes when the file changes, or None if the
+    # file does not exist.
+    try:
+        st = os.stat(fn)
+    except OSError:
+        return None
+    return (st.st_mtime_ns, st.st_size)
+
+def record_dependency(fn, fingerprint=None):
+    # Record that the value(s) being built on this thread depend on the
+    # file fn. Call this *before* reading the file so that a change made
+    # while the file is being read makes the entry stale.
+    stack = getattr(_local, "stack", None)
+    if not stack:
+        return
+    fn = os.path.normpath(fn)
+    if fingerprint is None:
+        fingerprint = file_fingerprint(fn)
+    for dependencies in stack:
+        dependencies.setdefault(fn, fingerprint)
+
+@contextlib.contextmanager
+def recording_dependencies():
+    # Collect the files read, directly or through caches, within a with
+    # block on this thread. Yields a dict that is filled in with the name
+    # and fingerprint of each file. Outer blocks and entries being built
+    # around this one also depend on the files.
+    stack = getattr(_local, "stack", None)
+    if stack is None:
+        stack = _local.stack = []
+    dependencies = { }
+    stack.append(dependencies)
+    try:
+        yield dependencies
+    finally:
+        stack.pop()
+    for fn, fingerprint in dependencies.items():
+        record_dependency(fn, fingerprint)
+
+class SingleFlight:
+    # Runs at most one computation at a time per key. When a burst of
+    # requests all need the same thing that isn't cached --- e.g. right
+    # after a project's files change --- one of them computes it and the
+    # others wait for it and share its result, instead of each computing it
+    # again. The files the computation read are recorded as dependencies of
+    # the waiters too.
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = { }
+        self.lock = threading.Lock()
+
+    def do(self, key, function):
+        # Return function(), or the result of the call already in progress
+        # for key on another thread.
+        with self.lock:
+            call = self.calls.get(key)
+            if call is None:
+                call = self.calls[key] = {
+                    "thread": threading.get_ident(),
+                    "done": threading.Event(),
+                    "value": None,
+                    "error": None,
+                    "dependencies": { },
+                }
+                leader = True
+            elif call["thread"] == threading.get_ident():
+                # function is asking for its own key. Waiting would never end.
+                return function()
+            else:
+                leader = False
+
+        if leader:
+            try:
+                with recording_dependencies() as call["dependencies"]:
+                    call["value"] = function()
+            except BaseException as e:
+                call["error"] = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call["done"].set()
+            return call["value"]
+
+        metrics.singleflight_waits.inc(name=self.name)
+        with metrics.singleflight_wait_duration.time(name=self.name):
+            call["done"].wait()
+        if call["error"] is not None:
+            raise call["error"]
+        for fn, fingerprint in call["dependencies"].items():
+            record_dependency(fn, fingerprint)
+        return call["value"]
+
+class Cache:
+    # A cache of values keyed by arbitrary hashable keys, each validated
+    # against the fingerprints of the files it was built from.
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = { }
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.flight = SingleFlight(name)
+        CACHES.append(self)
+
+    def get(self, key, builder):
+        # Return the cached value for key if it is fresh. Otherwise call
+        # builder() to compute it, remember which files it read, and cache it.
+        entry = self.entries.get(key)
+        if entry is not None and self.is_fresh(entry):
+            self.hits += 1
+            # Whatever is being built around us depends on the same files.
+            for fn, fingerprint in entry["dependencies"].items():
+                record_dependency(fn, fingerprint)
+            return entry["value"]
+
+        # Build the value, unless another thread is already building it, in
+        # which case wait for it and use the value it built.
+        def build():
+            # The value may have just been built by a thread we didn't wait for.
+            entry = self.entries.get(key)
+            if entry is not None and self.is_fresh(entry):
+                for fn, fingerprint in entry["dependencies"].items():
+                    record_dependency(fn, fingerprint)
+                return entry["value"]
+
+            self.misses += 1
+            with recording_dependencies() as dependencies:
+                value = builder()
+
+            with self.lock:
+                self.entries[key] = {
+                    "value": value,
+                    "dependencies": dependencies,
+                    "created": time.time(),
+                }
+            return value
+        return self.flight.do(key, build)
+
+    def peek(self, key):
+        # Return the cached value for key even if it is stale, or None, so
+        # that a builder can reuse work from the previous version of a value.
+        entry = self.entries.get(key)
+        return entry["value"] if entry is not None else None
+
+    def is_warm(self, key):
+        # Return whether a fresh value for key is cached, without building it.
+        entry = self.entries.get(key)
+        return entry is not None and self.is_fresh(entry)
+
+    def is_fresh(self, entry):
+        for fn, fingerprint in entry["dependencies"].items():
+            if file_fingerprint(fn) != fingerprint:
+                return False
+        return True
+
+    def update(self, key, updater, changed_files):
+        # Apply a change to a cached value that mirrors a change the caller
+        # just made to changed_files, so that the value need not be rebuilt.
+        # updater(value) modifies a copy of the value, which then replaces
+        # the entry: other threads may be reading the cached value without
+        # a lock, so cached values are never modified in place. If the entry
+        # is missing, depends on other files that have also changed, or the
+        # updater fails, the entry is dropped instead.
+        changed_files = [os.path.normpath(fn) for fn in changed_files]
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return False
+            fresh = all(
+                fn in changed_files or file_fingerprint(fn) == fingerprint
+                for fn, fingerprint in entry["dependencies"].items())
+            if fresh and all(fn in entry["dependencies"] for fn in changed_files):
+                value = copy.deepcopy(entry["value"])
+                try:
+                    updater(value)
+                except Exception:
+                    pass
+                else:
+                    dependencies = dict(entry["dependencies"])
+                    for fn in changed_files:
+                        dependencies[fn] = file_fingerprint(fn)
+                    self.entries[key] = {
+                        "value": value,
+                        "dependencies": dependencies,
+                        "created": entry["created"],
+                    }
+                    return True
+            del self.entries[key]
+            return False
+
+    def invalidate(self, key=None):
+        # Drop one entry, or all entries if key is None.
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+            else:
+                self.entries.pop(key, None)
+
+    def invalidate_file(self, fn):
+        # Drop the entries built from the file fn.
+        fn = os.path.normpath(fn)
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if fn in entry["dependencies"]:
+                    del self.entries[key]
+
+    def invalidate_directory(self, directory):
+        # Drop the entries built from any file within directory.
+        directory = os.path.join(os.path.normpath(directory), "")
+        with self.lock:
+            for key, entry in list(self.entries.items()):
+                if any(fn.startswith(directory) for fn in entry["dependencies"]):
+                    del self.entries[key]
+
+def invalidate_directory(directory):
+    # Drop the entries of every cache that were built from files within
+    # directory, e.g. a project that is no longer being served. (Rendered
+    # fragments have no dependencies and are left to be evicted as usual.)
+    for cache in CACHES:
+        if isinstance(cache, Cache):
+            cache.invalidate_directory(directory)
@@ -0,0 +1,184 @@
+# Precompiled catalogs of standards and certifications.
+#
+# Standard files, like NIST SP 800-53 with its nearly one thousand controls,
+# are large and rarely change, yet load_standard parses the YAML and
+# rebuilds the same controls and families, with their sort keys, every
+# time a project's standards are loaded. A catalog holds the result of that
+# work in a form that is quick to load. It is compiled ahead of time with
+#
+#   python -m hypergrc.catalog path/to/standards/NIST-SP-800-53-rev4.yaml ...
+#
+# and is written next to the YAML file, with the extension ".catalog"
+# instead of ".yaml", where load_standard and load_project_certified_controls
+# pick it up automatically.
+#
+# A catalog file is a line identifying the format and its version, a line
+# of JSON holding the SHA-256 hash of the YAML file it was compiled from,
+# and then the catalog itself as JSON (not pickle, since catalogs may come
+# from a project's repository). A catalog is only used if it is of the
+# current version and its YAML file still has the same hash, so a catalog
+# that is out of date is ignored and the YAML file is loaded instead ---
+# the YAML file is always the source of truth.
+
+import hashlib
+import json
+import os
+import os.path
+import tempfile
+
+from . import metrics
+
+MAGIC = b"hyperGRC catalog"
+FORMAT_VERSION = 1
+
+def get_catalog_filename(fn):
+    return os.path.splitext(fn)[0] + ".catalog"
+
+def hash_file(fn):
+    with open(fn, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+def read_catalog(fn, kind):
+    # Return the catalog of the given kind compiled from the YAML file fn,
+    # or None if there isn't one or it is out of date.
+    try:
+        with open(get_catalog_filename(fn), "rb") as f:
+            if f.readline() != MAGIC + " {}\n".format(FORMAT_VERSION).encode("ascii"):
+                return None
+            header = json.loads(f.readline().decode("utf8"))
+            if header.get("kind") != kind or header.get("source_sha256") != hash_file(fn):
+                return None
+            catalog = json.loads(f.read().decode("utf8"))
+    except (OSError, ValueError):
+        return None
+    metrics.catalog_loads.inc(file_type=kind)
+    return catalog
+
+def write_catalog(fn, kind, catalog):
+    # Write the catalog to a temporary file in the same directory and then
+    # move it into place, so that a server reading catalogs never sees a
+    # partly written one.
+    catalog_fn = get_catalog_filename(fn)
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(catalog_fn) or ".", prefix=".catalog-")
+    try:
+        # mkstemp creates the file readable only by its owner. Give it the
+        # permissions a newly created file would have.
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_fn, 0o666 & ~umask)
+        with os.fdopen(fd, "wb") as f:
+            f.write(MAGIC + " {}\n".format(FORMAT_VERSION).encode("ascii"))
+            f.write(json.dumps({ "kind": kind, "source_sha256": hash_file(fn) }).encode("utf8") + b"\n")
+            f.write(json.dumps(catalog, separators=(",", ":")).encode("utf8"))
+        os.replace(tmp_fn, catalog_fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+# Standards.
+
+def encode_standard(standard):
+    # Flatten a standard built by opencontrol.build_standard into records.
+    # The control numbers' sort keys are kept precomputed. The standard's id
+    # is the first part of every control's sort key, and the families' sort
+    # keys are their positions in the file, so they are stored just once.
+    return {
+        "id": standard["id"],
+        "name": standard["name"],
+        "controls": [
+            [control["number"], control["name"], control["family"], control["description"], control["sort_key"][1]]
+            for control in standard["controls"].values()
+        ],
+        "families": [
+            [family["id"], family["name"], family["sort_key"][1]]
+            for family in standard["families"].values()
+        ],
+    }
+
+def decode_standard(catalog):
+    # Rebuild the same data structure as opencontrol.build_standard.
+    standard_key = catalog["id"]
+    return {
+        "id": standard_key,
+        "name": catalog["name"],
+        "controls": {
+            number: {
+                "id": number,
+                "sort_key": (standard_key, tuple(sort_key)),
+                "number": number,
+                "name": name,
+                "family": family,
+                "description": description,
+            }
+            for number, name, family, description, sort_key in catalog["controls"]
+        },
+        "families": {
+            family_id: {
+                "id": family_id,
+                "sort_key": ("", i),
+                "number": family_id,
+                "name": name,
+                "abbrev": family_id,
+            }
+            for family_id, name, i in catalog["families"]
+        },
+    }
+
+def load_standard_catalog(fn):
+    # Return the standard in the YAML file fn from its catalog, or None.
+    catalog = read_catalog(fn, "standard")
+    if catalog is None:
+        return None
+    return decode_standard(catalog)
+
+# Certifications.
+
+def load_certification_catalog(fn):
+    # Return the certification in the YAML file fn from its catalog, as a
+    # mapping with the same "standards" key as the YAML file, or None.
+    return read_catalog(fn, "certification")
+
+# Compiling.
+
+def compile_catalog(fn):
+    # Compile the standard or certification in the YAML file fn into a
+    # catalog next to it. Returns the kind of file it was.
+    from . import opencontrol
+    data = opencontrol.load_opencontrol_yaml(fn, "standard or certification", None)
+
+    # Certification files list the controls they select from each standard.
+    # Everything else is taken to be a standard.
+    if isinstance(data.get("standards"), dict):
+        kind = "certification"
+        catalog = { "standards": data["standards"] }
+        check = lambda loaded : loaded == catalog
+    else:
+        kind = "standard"
+        standard = opencontrol.build_standard(fn, data)
+        catalog = encode_standard(standard)
+        check = lambda loaded : decode_standard(loaded) == standard
+
+    # Make sure that the catalog loads back exactly before writing it. A
+    # value that JSON can't represent, like a date, would be changed.
+    if not check(json.loads(json.dumps(catalog))):
+        raise ValueError("{} can't be compiled into a catalog because it has data that would be changed.".format(fn))
+    write_catalog(fn, kind, catalog)
+    return kind
+
+if __name__ == "__main__":
+    import argparse
+    import sys
+    parser = argparse.ArgumentParser(description="Precompile OpenControl standard and certification files into catalogs that load quickly.")
+    parser.add_argument("file", nargs="+", help="standard or certification YAML files")
+    args = parser.parse_args()
+    failed = False
+    for fn in args.file:
+        try:
+            kind = compile_catalog(fn)
+        except ValueError as e:
+            print(e, file=sys.stderr)
+            failed = True
+            continue
+        print("Compiled {} {} into {}.".format(kind, fn, get_catalog_filename(fn)))
+    if failed:
+        sys.exit(1)
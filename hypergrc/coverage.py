@@ -0,0 +1,227 @@
+# A coverage engine for comparing control implementations across components.
+#
+# Every (standard, control, control part) triple --- a "row" --- in a
+# project is assigned a dense integer id. A component's coverage is then a
+# bitset: a Python int whose bit i is set if the component has a narrative
+# for row i. Implementation statuses are stored the same way, one bitset per
+# status. Unions, intersections, differences and per-family rollups across
+# any number of components are then a handful of integer operations instead
+# of walks over every controlimpl.
+#
+# The rows are numbered separately for each project, in a registry that is
+# built along with the project's bitsets and cached with them until any of
+# the files they were built from change (see cache.py), so rows that are no
+# longer used are dropped along with the bitsets that refer to them.
+# Components from different projects are compared by renumbering their rows
+# into one registry (see merge_registries).
+
+from . import opencontrol
+from .cache import Cache
+
+_project_coverage_cache = Cache("coverage")
+
+def new_registry():
+    return {
+        "rows": [], # row id => row metadata
+        "row_ids": { }, # (standard id, control id, control part) => row id
+        "family_masks": { }, # (standard id, family id) => bitset of the rows in the family
+    }
+
+def add_row(registry, row):
+    # Return the id of a row in the registry, given its metadata, adding
+    # the row if it isn't in the registry yet.
+    key = (row["standard"]["id"], row["control"]["id"], row["control_part"])
+    row_id = registry["row_ids"].get(key)
+    if row_id is not None:
+        return row_id
+    row_id = len(registry["rows"])
+    registry["rows"].append(dict(row, id=row_id))
+    registry["row_ids"][key] = row_id
+    family_key = (row["standard"]["id"], row["family"]["id"])
+    registry["family_masks"][family_key] = registry["family_masks"].get(family_key, 0) | (1 << row_id)
+    return row_id
+
+def intern_row(registry, controlimpl):
+    # Return the row id for the control part implemented by controlimpl,
+    # registering the row the first time it is seen.
+    key = (controlimpl["standard"]["id"], controlimpl["control"]["id"], controlimpl["control_part"])
+    row_id = registry["row_ids"].get(key)
+    if row_id is not None:
+        return row_id
+    return add_row(registry, {
+        "standard": {
+            "id": controlimpl["standard"]["id"],
+            "name": controlimpl["standard"]["name"],
+        },
+        "family": {
+            "id": controlimpl["family"]["id"],
+            "abbrev": controlimpl["family"]["abbrev"],
+            "name": controlimpl["family"]["name"],
+            "sort_key": (controlimpl["standard"]["name"], controlimpl["family"]["sort_key"]),
+        },
+        "control": {
+            "id": controlimpl["control"]["id"],
+            "number": controlimpl["control"]["number"],
+            "name": controlimpl["control"].get("name"),
+        },
+        "control_part": controlimpl["control_part"],
+        "label": controlimpl["control"]["id"] + ("" if controlimpl["control_part"] is None else " part " + controlimpl["control_part"]),
+        "sort_key": (controlimpl["standard"]["name"], controlimpl["sort_key"]),
+    })
+
+def load_project_coverage(project):
+    # Return the coverage bitsets of every component in a project, as a
+    # dict mapping component ids (the URL slugs) to coverage records.
+    return _project_coverage_cache.get(project["path"], lambda : build_project_coverage(project))
+
+def build_project_coverage(project):
+    standards = opencontrol.load_project_standards(project)
+    registry = new_registry()
+    components = { }
+    for component in opencontrol.load_project_components(project):
+        coverage = 0
+        status = { }
+        narratives = { }
+        for controlimpl in opencontrol.load_project_component_controls(component, standards):
+            row_id = intern_row(registry, controlimpl)
+            bit = 1 << row_id
+            coverage |= bit
+            status[controlimpl["implementation_status"]] = status.get(controlimpl["implementation_status"], 0) | bit
+            # A component can have more than one narrative for the same
+            # control part, e.g. in different files. Keep them all.
+            narratives.setdefault(row_id, []).append(controlimpl)
+        components[component["id"]] = {
+            "component": component,
+            "registry": registry, # the project's rows, shared by its components
+            "coverage": coverage, # bitset of rows with a narrative
+            "status": status, # implementation status => bitset of rows
+            "narratives": narratives, # row id => list of controlimpls
+        }
+    return components
+
+def merge_registries(entries):
+    # Return a registry holding the rows of all of the coverage records in
+    # entries, and the records with their bitsets and narratives renumbered
+    # into it. Rows are matched by standard, control and control part, so
+    # the same control lines up across projects. Records from a single
+    # project are returned as they are.
+    registries = { id(entry["registry"]): entry["registry"] for entry in entries }
+    if len(registries) == 0:
+        return new_registry(), entries
+    if len(registries) == 1:
+        return entries[0]["registry"], entries
+    registry = new_registry()
+    merged = []
+    for entry in entries:
+        rows = entry["registry"]["rows"]
+        renumbered = {
+            row_id: add_row(registry, rows[row_id])
+            for row_id in row_ids(entry["coverage"])
+        }
+        renumber = lambda mask : union(1 << renumbered[row_id] for row_id in row_ids(mask))
+        merged.append(dict(entry,
+            registry=registry,
+            coverage=renumber(entry["coverage"]),
+            status={ status: renumber(mask) for status, mask in entry["status"].items() },
+            narratives={ renumbered[row_id]: controlimpls for row_id, controlimpls in entry["narratives"].items() },
+        ))
+    return registry, merged
+
+# Bitset helpers.
+
+def count(mask):
+    return bin(mask).count("1")
+
+def row_ids(mask):
+    # Yield the ids of the rows whose bits are set in mask, lowest first.
+    while mask:
+        low_bit = mask & -mask
+        yield low_bit.bit_length() - 1
+        mask ^= low_bit
+
+def union(masks):
+    result = 0
+    for mask in masks:
+        result |= mask
+    return result
+
+def intersection(masks):
+    masks = list(masks)
+    if not masks:
+        return 0
+    result = masks[0]
+    for mask in masks[1:]:
+        result &= mask
+    return result
+
+def difference(mask, other):
+    return mask & ~other
+
+def family_rollup(registry, mask):
+    # Return a mapping from (standard id, family id) to the number of rows
+    # in mask in that family, omitting families with no rows.
+    rollup = { }
+    for family_key, family_mask in registry["family_masks"].items():
+        n = count(mask & family_mask)
+        if n:
+            rollup[family_key] = n
+    return rollup
+
+def compare_components(entries):
+    # Build a comparison matrix for a list of coverage records (see
+    # build_project_coverage). Returns the rows covered by any component,
+    # each with one cell per component, plus summary counts per component
+    # and per control family.
+    registry, entries = merge_registries(entries)
+    masks = [entry["coverage"] for entry in entries]
+    any_mask = union(masks)
+    all_mask = intersection(masks)
+
+    # The rows of the matrix, sorted by standard, control and part. Each
+    # cell is the list of the component's narratives for the row.
+    rows = [
+        {
+            "row": registry["rows"][row_id],
+            "cells": [entry["narratives"].get(row_id, []) for entry in entries],
+        }
+        for row_id in row_ids(any_mask)
+    ]
+    rows.sort(key = lambda row : row["row"]["sort_key"])
+
+    # Summary counts per component. Rows unique to a component are those
+    # no other selected component covers.
+    columns = []
+    for i, entry in enumerate(entries):
+        others = union(masks[:i] + masks[i+1:])
+        columns.append({
+            "component": entry["component"],
+            "control_part_count": count(entry["coverage"]),
+            "unique_count": count(difference(entry["coverage"], others)),
+            "status_counts": {
+                status or "Not specified": count(mask)
+                for status, mask in entry["status"].items()
+            },
+        })
+
+    # Summary counts per control family.
+    any_rollup = family_rollup(registry, any_mask)
+    all_rollup = family_rollup(registry, all_mask)
+    column_rollups = [family_rollup(registry, mask) for mask in masks]
+    families = []
+    for family_key in any_rollup:
+        family = registry["rows"][next(row_ids(registry["family_masks"][family_key]))]["family"]
+        families.append({
+            "family": family,
+            "any_count": any_rollup[family_key],
+            "all_count": all_rollup.get(family_key, 0),
+            "counts": [rollup.get(family_key, 0) for rollup in column_rollups],
+        })
+    families.sort(key = lambda family : family["family"]["sort_key"])
+
+    return {
+        "rows": rows,
+        "columns": columns,
+        "families": families,
+        "any_count": count(any_mask),
+        "all_count": count(all_mask),
+    }
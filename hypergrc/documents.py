@@ -0,0 +1,102 @@
+# An index of the documents in a project's document directory, for the
+# documents page.
+#
+# The directory is scanned in one pass with os.scandir, collecting each
+# document's name, path, size, modification time and type. The index is
+# cached and depends on the modification time of every directory that was
+# scanned, which changes whenever a file is added to, removed from or
+# renamed within it, so it is rebuilt only when the set of documents
+# changes. (A document rewritten in place keeps its old size and time in
+# the index until something else in its directory changes.)
+
+import os
+
+from .cache import Cache, record_dependency
+
+_document_index_cache = Cache("documents")
+
+# How the documents page can sort documents.
+SORT_KEYS = {
+    "path": lambda document : document["rel_file_path"].lower(),
+    "name": lambda document : (document["name"].lower(), document["rel_file_path"].lower()),
+    "type": lambda document : (document["type"], document["rel_file_path"].lower()),
+    "size": lambda document : document["size"],
+    "modified": lambda document : document["mtime"],
+}
+
+def get_document_directory(project):
+    # Temporarily hardcode the documents directory to "outputs".
+    # We are hardcoding the directory until we modify the opencontrol.yaml
+    # file to include a list of directories.
+    return os.path.join(project["path"], "outputs")
+
+def load_document_index(project):
+    # Return the project's documents, sorted by path.
+    return _document_index_cache.get(project["path"], lambda : build_document_index(project))
+
+def build_document_index(project):
+    root = get_document_directory(project)
+    documents = []
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        record_dependency(directory)
+        try:
+            entries = list(os.scandir(directory))
+        except OSError:
+            # The directory doesn't exist (yet) or can't be read.
+            continue
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                directories.append(entry.path)
+                continue
+
+            # Skip any commonly found files that are MS Word document temp files
+            if "~$" in entry.name or not entry.is_file():
+                continue
+
+            st = entry.stat()
+            documents.append({
+                "name": entry.name,
+                "file_path": entry.path,
+                "rel_file_path": os.path.relpath(entry.path, root).replace(os.sep, "/"),
+                "size": st.st_size,
+                "mtime": st.st_mtime,
+                "type": os.path.splitext(entry.name)[1][1:].lower(),
+            })
+    documents.sort(key=SORT_KEYS["path"])
+
+    return {
+        "documents": documents,
+        "types": sorted(set(document["type"] for document in documents)),
+        "sorted": { "path": documents },
+    }
+
+def sort_documents(index, sort):
+    # Return the index's documents sorted by one of SORT_KEYS. Each order is
+    # computed once per index.
+    documents = index["sorted"].get(sort)
+    if documents is None:
+        documents = index["sorted"][sort] = sorted(index["documents"], key=SORT_KEYS[sort])
+    return documents
+
+def query_documents(project, sort="path", descending=False, search=None, doc_type=None, page=1, per_page=100):
+    # Return a page of the project's documents, sorted and filtered, along
+    # with the number of documents that matched and the document types
+    # there are to filter by.
+    index = load_document_index(project)
+    documents = sort_documents(index, sort)
+    if descending:
+        documents = documents[::-1]
+    if search:
+        search = search.lower()
+        documents = [document for document in documents if search in document["rel_file_path"].lower()]
+    if doc_type is not None:
+        documents = [document for document in documents if document["type"] == doc_type]
+    start = (page - 1) * per_page
+    return {
+        "documents": documents[start:start + per_page],
+        "count": len(documents),
+        "total": len(index["documents"]),
+        "types": index["types"],
+    }
@@ -0,0 +1,199 @@
+# A feed of changes to each project, so that open pages can update
+# themselves instead of reloading or re-requesting statistics. See the
+# /events route in routes.py and watch_project in base.html.
+#
+# Routes that change a project publish a compact event describing the
+# change. Changes made to a project's files by other tools are noticed by a
+# watcher thread that, while anyone is following the project, polls the
+# fingerprints of the files the project was loaded from, and are published
+# as "files_changed" events.
+#
+# The most recent events of each project are kept in memory so that a
+# client that reconnects (sending the Last-Event-ID header) is sent the
+# events it missed. If it missed more than are kept, it is sent a "reset"
+# event instead.
+
+import collections
+import itertools
+import json
+import os.path
+import threading
+import time
+
+from .cache import file_fingerprint, recording_dependencies
+
+SETTINGS = {
+    # How many events to keep for each project.
+    "log_size": 256,
+
+    # Seconds between keep-alive comments on idle streams. Sending
+    # something now and then is how the server notices that the client
+    # went away.
+    "keepalive": 15,
+
+    # Seconds between checks of the project files for changes.
+    "watch_interval": 2,
+}
+
+# Event ids are unique across projects.
+_event_ids = itertools.count(1)
+
+_feeds = { }
+_feeds_lock = threading.Lock()
+_watcher = None
+
+class ProjectFeed:
+    def __init__(self, project):
+        self.project = project
+        self.events = collections.deque(maxlen=SETTINGS["log_size"])
+        self.last_id = 0
+        self.last_dropped_id = 0
+        self.condition = threading.Condition()
+        self.subscribers = 0
+
+        # The fingerprints of the project's files when last checked, and
+        # the files that were seen to have changed at the last check. Both
+        # are changed by publish on request threads and by the watcher
+        # thread, always while holding condition.
+        self.files = None
+        self.pending = set()
+
+def get_feed(project):
+    with _feeds_lock:
+        feed = _feeds.get(project["path"])
+        if feed is None:
+            feed = _feeds[project["path"]] = ProjectFeed(project)
+        return feed
+
+def has_subscribers(project):
+    feed = _feeds.get(project["path"])
+    return feed is not None and feed.subscribers > 0
+
+def publish(project, event_type, data, changed_files=()):
+    # Publish an event to everyone following the project. changed_files
+    # are the files the change was saved to, which the watcher then knows
+    # not to report again.
+    feed = get_feed(project)
+    with feed.condition:
+        if feed.files is not None:
+            for fn in changed_files:
+                fn = os.path.normpath(fn)
+                feed.files[fn] = file_fingerprint(fn)
+                feed.pending.discard(fn)
+        feed.last_id = next(_event_ids)
+        if len(feed.events) == feed.events.maxlen:
+            feed.last_dropped_id = feed.events[0][0]
+        feed.events.append((feed.last_id, event_type, data))
+        feed.condition.notify_all()
+
+def subscribe(project, last_event_id=None):
+    # Yield (id, type, data) for each event published to the project from
+    # now on, or since last_event_id if given, waiting for them as needed.
+    # Yields None when no event arrives for a while so that the caller can
+    # send a keep-alive. Runs until the caller stops iterating.
+    feed = get_feed(project)
+    with feed.condition:
+        feed.subscribers += 1
+        position = feed.last_id
+        missed = [ ]
+        if last_event_id is not None:
+            if last_event_id < feed.last_dropped_id:
+                missed = [(feed.last_id, "reset", { })]
+            else:
+                missed = [event for event in feed.events if event[0] > last_event_id]
+    start_watcher()
+    try:
+        for event in missed:
+            yield event
+        while True:
+            with feed.condition:
+                if feed.last_id == position:
+                    feed.condition.wait(SETTINGS["keepalive"])
+                events = [event for event in feed.events if event[0] > position]
+                position = feed.last_id
+            if not events:
+                yield None
+            for event in events:
+                yield event
+    finally:
+        with feed.condition:
+            feed.subscribers -= 1
+
+def format_event(event):
+    # Return an event in the text/event-stream format, as bytes.
+    event_id, event_type, data = event
+    return "id: {}\nevent: {}\ndata: {}\n\n".format(event_id, event_type, json.dumps(data)).encode("utf8")
+
+# Watching for changes made outside of hyperGRC.
+
+def load_project_files(project):
+    # Return the fingerprints of every file the project's data is loaded
+    # from, which the coverage records depend on. The records are cached,
+    # so this is cheap unless the files have changed.
+    from . import coverage
+    with recording_dependencies() as dependencies:
+        coverage.load_project_coverage(project)
+    return dependencies
+
+def check_project_files(feed):
+    if feed.files is None:
+        files = load_project_files(feed.project)
+        with feed.condition:
+            feed.files = files
+        return
+
+    # Changes are reported once they are seen at two checks in a row, so
+    # that changes that hyperGRC made itself, which are published (with
+    # changed_files) just after they are saved, aren't reported twice.
+    # The files are checked without holding the lock and then checked
+    # again with it, in case a change was published in between.
+    with feed.condition:
+        files = list(feed.files.items())
+    changed = set(fn for fn, fingerprint in files if file_fingerprint(fn) != fingerprint)
+    with feed.condition:
+        changed = set(fn for fn in changed if file_fingerprint(fn) != feed.files.get(fn))
+        report = changed & feed.pending
+        feed.pending = changed - report
+    if not report:
+        return
+
+    # Re-read the project, which may now consist of other files.
+    try:
+        files = load_project_files(feed.project)
+    except Exception:
+        # The files may be in the middle of being edited. Keep watching
+        # the files already known.
+        with feed.condition:
+            for fn in report:
+                feed.files[fn] = file_fingerprint(fn)
+    else:
+        with feed.condition:
+            # A file saved and published while the project was being re-read
+            # may have been read before it was saved. Its published
+            # fingerprint is the current one.
+            for fn, fingerprint in feed.files.items():
+                if fn in files and fingerprint == file_fingerprint(fn):
+                    files[fn] = fingerprint
+            feed.files = files
+    publish(feed.project, "files_changed", {
+        "files": sorted(os.path.relpath(fn, feed.project["path"]) for fn in report),
+    })
+
+def watch():
+    while True:
+        time.sleep(SETTINGS["watch_interval"])
+        with _feeds_lock:
+            feeds = [feed for feed in _feeds.values() if feed.subscribers > 0]
+        for feed in feeds:
+            try:
+                check_project_files(feed)
+            except Exception:
+                import traceback
+                traceback.print_exc()
+
+def start_watcher():
+    global _watcher
+    with _feeds_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=watch, name="hypergrc-events-watcher", daemon=True)
+            _watcher.start()
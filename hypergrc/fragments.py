@@ -0,0 +1,109 @@
+# Caching of rendered HTML fragments.
+#
+# Pages like a component's page and a control's grid repeat a block of
+# HTML for every control implementation. Most of those blocks are the same
+# from one page load to the next, so they are cached by the template that
+# renders them and a key describing everything they show, and only blocks
+# whose control implementation changed are rendered again.
+#
+# A control implementation's block shows data from the component's files
+# and data from the project's opencontrol.yaml file and standards. The key
+# has a hash of the first kind of data (see controlimpl_fingerprint) and a
+# "data version" of the second kind that is computed from the fingerprints
+# of the files it came from (see data_version), so that editing one
+# narrative changes the key of only that narrative's block.
+#
+# The cache is held in memory and bounded by the size of the fragments
+# held. The least recently used fragments are evicted first.
+
+import collections
+import hashlib
+import threading
+
+from . import metrics
+from .cache import CACHES
+
+SETTINGS = {
+    # The most fragment text to hold, in characters.
+    "max_size": 32 * 1024 * 1024,
+}
+
+class FragmentCache:
+    # A least-recently-used cache of rendered fragments, with the same
+    # name, entries, hits, misses and invalidate as cache.Cache so that it
+    # is flushed and reported along with the other caches.
+
+    def __init__(self, name):
+        self.name = name
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        CACHES.append(self)
+
+    def get(self, key, builder):
+        # Return the fragment for key, calling builder() to render it if it
+        # isn't cached.
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return value
+            self.misses += 1
+
+        value = builder()
+
+        with self.lock:
+            if key not in self.entries:
+                self.entries[key] = value
+                self.size += len(value)
+                while self.size > SETTINGS["max_size"] and self.entries:
+                    evicted_key, evicted_value = self.entries.popitem(last=False)
+                    self.size -= len(evicted_value)
+                    self.evictions += 1
+                    metrics.fragment_cache_evictions.inc()
+            metrics.fragment_cache_size.set(self.size)
+        return value
+
+    def invalidate(self, key=None):
+        # Drop one entry, or all entries if key is None.
+        with self.lock:
+            if key is None:
+                self.entries.clear()
+                self.size = 0
+            elif key in self.entries:
+                self.size -= len(self.entries.pop(key))
+            metrics.fragment_cache_size.set(self.size)
+
+FRAGMENTS = FragmentCache("fragments")
+
+def data_version(dependencies):
+    # Return a short string that changes when any of the files in
+    # dependencies (from cache.recording_dependencies) changes.
+    h = hashlib.sha1()
+    for fn, fingerprint in sorted(dependencies.items()):
+        h.update(repr((fn, fingerprint)).encode("utf8"))
+    return h.hexdigest()[:16]
+
+def controlimpl_fingerprint(controlimpl):
+    # Return a hash of the parts of a control implementation that come from
+    # the component's files (see opencontrol.load_project_component_controls).
+    # Only the size of the fragments is counted against max_size, so the key
+    # holds a hash rather than the narrative itself.
+    h = hashlib.sha1()
+    h.update(repr((
+        controlimpl["source_file"],
+        controlimpl["component"]["id"],
+        controlimpl["component"]["name"],
+        controlimpl["standard"]["id"],
+        controlimpl["control"]["id"],
+        controlimpl["control"].get("name"),
+        controlimpl.get("control_part"),
+        controlimpl["narrative"],
+        controlimpl["implementation_status"],
+        tuple(controlimpl.get("evidence", [])),
+    )).encode("utf8"))
+    return h.hexdigest()
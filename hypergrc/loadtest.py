@@ -0,0 +1,295 @@
+# A load generator for a running hyperGRC server.
+#
+# Crawls the site from / (the index, projects, components, control grids,
+# and the statistics.json of each project and component) and then runs
+# concurrent virtual users against it for a while. In the "browse" scenario
+# the users load pages. In the "autosave" scenario they save control
+# narratives through /update-control the way the control editor does.
+# "mixed" does both. Reports throughput, latency percentiles and errors
+# by route.
+#
+# Scenarios that save narratives check afterwards that every control holds
+# the narrative that was last saved to it, and then put back the original
+# narratives. Each control is only ever saved by one user so that the last
+# save is well defined. Because they modify the repositories, run them
+# against copies or against repositories from hypergrc.benchmark.generate.
+#
+#   python -m hypergrc.loadtest http://localhost:8000 --users 10 --duration 30 --scenario mixed
+
+import json
+import random
+import re
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from . import routes
+
+# Paths not worth loading.
+SKIPPED_PATHS = re.compile(r"^/(static|admin|metrics|login)|/_extensions/|/documents/\?f=|/ssp\.csv$")
+
+# The control implementation data embedded in component pages for the control editor.
+CONTROL_DATA = re.compile(r"^\s*var control_\d+_\d+ = (\{.*\});\s*$", re.M)
+
+def route_name(method, path):
+    # Return the name of the route function that handles the path, for
+    # reporting.
+    for methods, route_path, route_function in routes.ROUTES:
+        if method in methods and routes.path_matches(route_path, path) is not False:
+            return route_function.__name__
+    return "not_found"
+
+def fetch(base_url, path, form=None, timeout=60):
+    # Make a request. Returns the status, the Content-Type and the body.
+    data = urllib.parse.urlencode(form).encode("utf8") if form is not None else None
+    request = urllib.request.Request(base_url + path, data=data)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as resp:
+            return resp.status, resp.headers.get("Content-Type", ""), resp.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.headers.get("Content-Type", ""), e.read()
+
+def crawl(base_url, max_urls):
+    # Crawl the site from / breadth first. Returns the paths that loaded
+    # successfully and the control implementations found on component pages.
+    queue = ["/"]
+    seen = set(queue)
+    paths = []
+    controlimpls = []
+    while queue and len(paths) < max_urls:
+        path = queue.pop(0)
+        status, content_type, body = fetch(base_url, path)
+        if status != 200:
+            continue
+        paths.append(path)
+        if not content_type.startswith("text/html"):
+            continue
+        body = body.decode("utf8", "replace")
+
+        # Component pages embed the data that the control editor saves.
+        if route_name("GET", path) == "component":
+            for m in CONTROL_DATA.finditer(body):
+                controlimpls.append(json.loads(m.group(1)))
+
+        # Follow links to other pages. The statistics of projects and
+        # components are loaded by scripts on their pages, so add them too.
+        links = [link.replace("&amp;", "&") for link in re.findall(r'href="(/[^"]*)"', body)]
+        for link in list(links):
+            if route_name("GET", link) in ("project", "component"):
+                links.append(link + "/statistics.json")
+        for link in links:
+            if link not in seen and not SKIPPED_PATHS.search(link) and route_name("GET", link) != "not_found":
+                seen.add(link)
+                queue.append(link)
+    return paths, controlimpls
+
+def make_update_form(controlimpl, narrative):
+    # The form fields that the control editor posts to /update-control.
+    return {
+        "mode": "update",
+        "organization": controlimpl["component"]["project"]["organization"]["id"],
+        "project": controlimpl["component"]["project"]["id"],
+        "component": controlimpl["component"]["id"],
+        "standard": controlimpl["standard"]["id"],
+        "control": controlimpl["control"]["id"],
+        "control_part": controlimpl.get("control_part") or "",
+        "narrative": narrative,
+        "implementation_status": controlimpl.get("implementation_status", ""),
+    }
+
+def controlimpl_key(controlimpl):
+    return (
+        controlimpl["component"]["url"],
+        controlimpl["standard"]["id"],
+        controlimpl["control"]["id"],
+        controlimpl.get("control_part") or None,
+    )
+
+class Results:
+    # Latencies and errors by route, collected from all of the users.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies = { }
+        self.errors = { }
+
+    def record(self, name, duration, error):
+        with self.lock:
+            self.latencies.setdefault(name, []).append(duration)
+            if error:
+                self.errors.setdefault(name, []).append(error)
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+def virtual_user(base_url, user, deadline, paths, controlimpls, write_ratio, think_time, results, saved):
+    # Browse and save until the deadline. paths maps route names to the
+    # paths crawled for the route. controlimpls are the controls this
+    # user (and only this user) saves. saved maps each control's key to the
+    # narrative last saved.
+    rng = random.Random(user)
+    n = 0
+    while time.time() < deadline:
+        n += 1
+        if controlimpls and rng.random() < write_ratio:
+            # Autosave a narrative, appending a marker that identifies the save.
+            controlimpl = rng.choice(controlimpls)
+            narrative = controlimpl["narrative"].rstrip() + " [loadtest user {} save {}]".format(user, n)
+            name = "update_control"
+            start = time.perf_counter()
+            try:
+                status, content_type, body = fetch(base_url, "/update-control", make_update_form(controlimpl, narrative))
+                if status != 200:
+                    error = "HTTP {}".format(status)
+                elif not content_type.startswith("application/json"):
+                    error = body.decode("utf8", "replace")[:200]
+                else:
+                    error = None
+                    saved[controlimpl_key(controlimpl)] = narrative
+            except Exception as e:
+                error = str(e)
+            results.record(name, time.perf_counter() - start, error)
+        else:
+            # Load a page. Pick the route first so that the many control
+            # grid pages don't crowd out everything else.
+            name = rng.choice(sorted(paths))
+            path = rng.choice(paths[name])
+            start = time.perf_counter()
+            try:
+                status, content_type, body = fetch(base_url, path)
+                error = "HTTP {}".format(status) if status != 200 else None
+            except Exception as e:
+                error = str(e)
+            results.record(name, time.perf_counter() - start, error)
+        if think_time:
+            time.sleep(rng.uniform(0, 2 * think_time))
+
+def check_integrity(base_url, saved):
+    # Reload the component pages of every saved control and return a list
+    # of (key, expected, found) for controls whose narrative isn't the one
+    # last saved.
+    component_urls = sorted(set(key[0] for key in saved))
+    found = { }
+    for component_url in component_urls:
+        status, content_type, body = fetch(base_url, component_url)
+        for m in CONTROL_DATA.finditer(body.decode("utf8", "replace")):
+            controlimpl = json.loads(m.group(1))
+            found[controlimpl_key(controlimpl)] = controlimpl["narrative"]
+    return [
+        (key, narrative, found.get(key))
+        for key, narrative in sorted(saved.items())
+        if found.get(key, "").strip() != narrative.strip()
+    ]
+
+def restore(base_url, controlimpls, saved):
+    # Put back the original narratives of the controls that were saved.
+    for controlimpl in controlimpls:
+        if controlimpl_key(controlimpl) in saved:
+            fetch(base_url, "/update-control", make_update_form(controlimpl, controlimpl["narrative"]))
+
+def main():
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Run a load test against a hyperGRC server.")
+    parser.add_argument("url", nargs="?", default="http://localhost:8000", help="the server's base URL (default http://localhost:8000)")
+    parser.add_argument("--users", type=int, default=10, help="number of concurrent virtual users (default 10)")
+    parser.add_argument("--duration", type=float, default=30, help="seconds to run for (default 30)")
+    parser.add_argument("--scenario", choices=["browse", "autosave", "mixed"], default="browse", help="what the users do (default browse)")
+    parser.add_argument("--write-ratio", type=float, default=0.2, help="fraction of requests that are saves in the mixed scenario (default 0.2)")
+    parser.add_argument("--think-time", type=float, default=0, help="average seconds each user waits between requests (default 0)")
+    parser.add_argument("--max-urls", type=int, default=500, help="maximum number of pages to crawl (default 500)")
+    parser.add_argument("--no-restore", action="store_true", help="leave the saved narratives in place")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+    base_url = args.url.rstrip("/")
+    write_ratio = { "browse": 0, "autosave": 1, "mixed": args.write_ratio }[args.scenario]
+
+    print("Crawling {}...".format(base_url), file=sys.stderr)
+    paths, controlimpls = crawl(base_url, args.max_urls)
+    if not paths:
+        print("Could not load any pages.", file=sys.stderr)
+        sys.exit(2)
+    print("Found {} pages and {} control narratives.".format(len(paths), len(controlimpls)), file=sys.stderr)
+    paths_by_route = { }
+    for path in paths:
+        paths_by_route.setdefault(route_name("GET", path), []).append(path)
+    if write_ratio and not controlimpls:
+        print("No control narratives were found to save.", file=sys.stderr)
+        sys.exit(2)
+
+    # Deal the controls out to the users.
+    rng = random.Random(0)
+    rng.shuffle(controlimpls)
+    results = Results()
+    saved = { }
+    deadline = time.time() + args.duration
+    start = time.perf_counter()
+    threads = [
+        threading.Thread(target=virtual_user, args=(
+            base_url, user, deadline, paths_by_route, controlimpls[user::args.users],
+            write_ratio, args.think_time, results, saved))
+        for user in range(args.users)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    # Check the saves.
+    mismatches = []
+    if saved:
+        mismatches = check_integrity(base_url, saved)
+        if not args.no_restore:
+            restore(base_url, controlimpls, saved)
+
+    # Report.
+    def summarize(latencies, errors):
+        # There are no latencies if no request succeeded, e.g. if the server
+        # is down. Report the errors anyway.
+        return {
+            "requests": len(latencies),
+            "errors": len(errors),
+            "throughput": len(latencies) / elapsed,
+            "p50_ms": percentile(latencies, 50) * 1000 if latencies else None,
+            "p90_ms": percentile(latencies, 90) * 1000 if latencies else None,
+            "p99_ms": percentile(latencies, 99) * 1000 if latencies else None,
+            "max_ms": max(latencies) * 1000 if latencies else None,
+        }
+    report = {
+        "scenario": args.scenario,
+        "users": args.users,
+        "duration": elapsed,
+        "total": summarize(sum(results.latencies.values(), []), sum(results.errors.values(), [])),
+        "routes": {
+            name: summarize(latencies, results.errors.get(name, []))
+            for name, latencies in sorted(results.latencies.items())
+        },
+        "saves_checked": len(saved),
+        "integrity_failures": len(mismatches),
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print("{:<28} {:>8} {:>7} {:>9} {:>9} {:>9} {:>9} {:>9}".format(
+            "route", "requests", "errors", "req/s", "p50 ms", "p90 ms", "p99 ms", "max ms"))
+        def format_ms(ms):
+            return "-" if ms is None else "{:.1f}".format(ms)
+        for name, r in sorted(report["routes"].items()) + [("TOTAL", report["total"])]:
+            print("{:<28} {:>8} {:>7} {:>9.1f} {:>9} {:>9} {:>9} {:>9}".format(
+                name, r["requests"], r["errors"], r["throughput"],
+                format_ms(r["p50_ms"]), format_ms(r["p90_ms"]), format_ms(r["p99_ms"]), format_ms(r["max_ms"])))
+        if saved:
+            print("Saves checked: {} controls, {} with lost or wrong narratives.".format(len(saved), len(mismatches)))
+    for name, errors in sorted(results.errors.items()):
+        print("{}: {} errors, e.g. {}".format(name, len(errors), errors[0]), file=sys.stderr)
+    for key, expected, found in mismatches[:10]:
+        print("Integrity failure {}: expected {!r}, found {!r}".format(key, expected[-60:], (found or "")[-60:]), file=sys.stderr)
+
+    if mismatches:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# Inspecting the caches and how much memory they hold, for /admin/caches.
+#
+# The size of a cache is estimated by walking everything reachable from its
+# keys and values through dicts, lists, tuples, sets and object attributes
+# and adding up sys.getsizeof of each object, counting objects reachable
+# more than once only once. Caches share some objects (e.g. the component
+# records in coverage and statistics), so the total over all caches, which
+# counts each object once, is less than the sum of the caches' sizes.
+#
+# For a view of all of the memory allocated by Python, not only the caches,
+# tracemalloc can be turned on, after which snapshots of the source lines
+# that allocated the most memory still held can be taken.
+
+import sys
+import time
+import tracemalloc
+
+from .cache import CACHES, Cache
+
+# How many allocation sites to list in a tracemalloc snapshot.
+TOP_ALLOCATIONS = 25
+
+def estimate_size(value, seen):
+    # Return the estimated size in bytes of value and everything reachable
+    # from it, not counting objects whose ids are in seen, which is updated.
+    size = 0
+    stack = [value]
+    while stack:
+        obj = stack.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        size += sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            stack.extend(obj.keys())
+            stack.extend(obj.values())
+        elif isinstance(obj, (list, tuple, set, frozenset)):
+            stack.extend(obj)
+        elif hasattr(obj, "__dict__"):
+            stack.append(obj.__dict__)
+    return size
+
+def get_entries(cache):
+    # Return a list of the cache's (key, value, time created or None) while
+    # holding its lock, since other threads may be changing it.
+    with cache.lock:
+        if isinstance(cache, Cache):
+            return [(key, entry["value"], entry["created"]) for key, entry in cache.entries.items()]
+        return [(key, value, None) for key, value in cache.entries.items()]
+
+def describe_caches():
+    # Return a description of each cache and the estimated total size.
+    now = time.time()
+    caches = []
+    total_seen = set()
+    total_size = 0
+    for cache in CACHES:
+        entries = get_entries(cache)
+        seen = set()
+        size = 0
+        for key, value, created in entries:
+            size += estimate_size(key, seen) + estimate_size(value, seen)
+            total_size += estimate_size(key, total_seen) + estimate_size(value, total_seen)
+        created = [created for key, value, created in entries if created is not None]
+        lookups = cache.hits + cache.misses
+        caches.append({
+            "name": cache.name,
+            "entries": len(entries),
+            "estimated_bytes": size,
+            "hits": cache.hits,
+            "misses": cache.misses,
+            "hit_rate": cache.hits / lookups if lookups else None,
+            "oldest_entry_age": now - min(created) if created else None,
+            "newest_entry_age": now - max(created) if created else None,
+            # Rendered fragments don't remember which files they came from,
+            # so they can only be flushed all at once.
+            "flushable_by_file": isinstance(cache, Cache),
+        })
+    return {
+        "caches": caches,
+        "estimated_bytes": total_size,
+        "tracemalloc": tracemalloc.is_tracing(),
+    }
+
+def flush(cache_name=None, project_dir=None, file_name=None):
+    # Drop cache entries: every entry of the named cache (or of every cache
+    # if None), narrowed to the entries built from files in project_dir or
+    # from file_name if given. Returns the number of entries dropped.
+    dropped = 0
+    for cache in CACHES:
+        if cache_name and cache.name != cache_name:
+            continue
+        before = len(cache.entries)
+        if project_dir or file_name:
+            if not isinstance(cache, Cache):
+                continue
+            if project_dir:
+                cache.invalidate_directory(project_dir)
+            if file_name:
+                cache.invalidate_file(file_name)
+        else:
+            cache.invalidate()
+        dropped += before - len(cache.entries)
+    return dropped
+
+def start_tracing():
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+def stop_tracing():
+    tracemalloc.stop()
+
+def top_allocations():
+    # Return the source lines that allocated the most memory that is still
+    # held, since tracing started, or None if tracing is off.
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces([
+        tracemalloc.Filter(False, tracemalloc.__file__),
+    ])
+    return [
+        {
+            "file": stat.traceback[0].filename,
+            "line": stat.traceback[0].lineno,
+            "bytes": stat.size,
+            "blocks": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:TOP_ALLOCATIONS]
+    ]
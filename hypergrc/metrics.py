@@ -0,0 +1,170 @@
+# Instrumentation: counters, gauges and histograms describing where hyperGRC
+# spends its time, exposed in the Prometheus text format at /metrics.
+
+import threading
+import time
+
+# All of the metrics that have been created, in the order they were created.
+METRICS = []
+
+# The default histogram buckets, in seconds.
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+class Metric:
+    # The base class for metrics. Each metric holds a value per distinct
+    # combination of label values.
+    type = None
+
+    def __init__(self, name, documentation, labels=()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+        self.values = { }
+        self.lock = threading.Lock()
+        METRICS.append(self)
+
+    def label_values(self, labels):
+        return tuple(str(labels.get(label, "")) for label in self.labels)
+
+    def format_labels(self, values, extra=()):
+        pairs = list(zip(self.labels, values)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(
+            '{}="{}"'.format(k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+            for k, v in pairs) + "}"
+
+    def samples(self):
+        # Yield (name suffix, label values, extra labels, value) tuples.
+        with self.lock:
+            items = sorted(self.values.items())
+        for values, value in items:
+            yield ("", values, (), value)
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation),
+            "# TYPE {} {}".format(self.name, self.type),
+        ]
+        for suffix, values, extra, value in self.samples():
+            lines.append("{}{}{} {}".format(self.name, suffix, self.format_labels(values, extra), format_value(value)))
+        return "\n".join(lines)
+
+class Counter(Metric):
+    type = "counter"
+
+    def inc(self, n=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def inc(self, n=1, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + n
+
+    def dec(self, n=1, **labels):
+        self.inc(-n, **labels)
+
+    def set(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            self.values[key] = value
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(self, name, documentation, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.label_values(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = { "buckets": [0] * len(self.buckets), "sum": 0, "count": 0 }
+            h = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h["buckets"][i] += 1
+            h["sum"] += value
+            h["count"] += 1
+
+    def time(self, **labels):
+        # Return a context manager that observes the time spent within it.
+        return Timer(self, labels)
+
+    def samples(self):
+        with self.lock:
+            items = sorted((values, dict(h, buckets=list(h["buckets"]))) for values, h in self.values.items())
+        for values, h in items:
+            for bound, n in zip(self.buckets, h["buckets"]):
+                yield ("_bucket", values, (("le", format_value(bound)),), n)
+            yield ("_bucket", values, (("le", "+Inf"),), h["count"])
+            yield ("_sum", values, (), h["sum"])
+            yield ("_count", values, (), h["count"])
+
+class Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.elapsed = time.perf_counter() - self.start
+        self.histogram.observe(self.elapsed, **self.labels)
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+# HTTP requests.
+http_requests = Counter("hypergrc_http_requests_total", "HTTP requests handled.", ("route", "method", "status"))
+http_request_duration = Histogram("hypergrc_http_request_duration_seconds", "Time spent handling HTTP requests.", ("route", "method"))
+http_requests_in_flight = Gauge("hypergrc_http_requests_in_flight", "HTTP requests currently being handled.")
+
+# YAML parsing, by the type of OpenControl file (system, component, standard, certification, team).
+yaml_parses = Counter("hypergrc_yaml_parses_total", "YAML files parsed.", ("file_type",))
+yaml_parse_bytes = Counter("hypergrc_yaml_parse_bytes_total", "Bytes of YAML parsed.", ("file_type",))
+yaml_parse_duration = Histogram("hypergrc_yaml_parse_duration_seconds", "Time spent parsing YAML files.", ("file_type",))
+catalog_loads = Counter("hypergrc_catalog_loads_total", "Standards and certifications loaded from precompiled catalogs instead of YAML.", ("file_type",))
+
+# Rendering and serialization.
+template_render_duration = Histogram("hypergrc_template_render_duration_seconds", "Time spent rendering templates and sending the pages.", ("template",))
+json_serialize_duration = Histogram("hypergrc_json_serialize_duration_seconds", "Time spent serializing JSON responses.")
+
+# Caches. These are read from the caches themselves when metrics are rendered.
+class CacheMetric(Metric):
+    def __init__(self, name, documentation, type, attribute):
+        super().__init__(name, documentation, ("cache",))
+        self.type = type
+        self.attribute = attribute
+
+    def samples(self):
+        from .cache import CACHES
+        for cache in CACHES:
+            yield ("", (cache.name,), (), self.attribute(cache))
+
+cache_hits = CacheMetric("hypergrc_cache_hits_total", "Cache lookups that found a fresh entry.", "counter", lambda cache : cache.hits)
+cache_misses = CacheMetric("hypergrc_cache_misses_total", "Cache lookups that had to build the entry.", "counter", lambda cache : cache.misses)
+cache_entries = CacheMetric("hypergrc_cache_entries", "Entries currently held in the cache.", "gauge", lambda cache : len(cache.entries))
+
+# Computations that were already in progress on another thread when they
+# were needed, and were waited for instead of repeated (see cache.SingleFlight).
+singleflight_waits = Counter("hypergrc_singleflight_waits_total", "Calls that waited for the same computation in progress on another thread instead of repeating it.", ("name",))
+singleflight_wait_duration = Histogram("hypergrc_singleflight_wait_duration_seconds", "Time spent waiting for computations in progress on another thread.", ("name",))
+
+# The rendered-fragment cache (see fragments.py), which evicts entries.
+fragment_cache_size = Gauge("hypergrc_fragment_cache_size_chars", "Characters of rendered HTML held in the fragment cache.")
+fragment_cache_evictions = Counter("hypergrc_fragment_cache_evictions_total", "Fragments evicted from the fragment cache to stay within its size limit.")
+
+def render_prometheus():
+    # Return all metrics in the Prometheus text exposition format.
+    return "\n".join(metric.render() for metric in METRICS) + "\n"
@@ -1,12 +1,45 @@
 # Routines for loading OpenControl data.
 
+import contextlib
 import os.path
 import re
 import shutil
+import threading
 from urllib.parse import quote_plus
 from collections import OrderedDict
 
 import rtyaml
+import yaml
+
+from . import metrics, catalog
+from .cache import record_dependency, file_fingerprint, SingleFlight
+
+# Use PyYAML's C loader for reading files, if PyYAML was built with libyaml.
+try:
+    from yaml import CSafeLoader as FastYamlLoader
+except ImportError:
+    FastYamlLoader = None
+
+SETTINGS = {
+    # How load_opencontrol_yaml parses files: "libyaml" to use PyYAML's C
+    # loader directly, producing plain dicts and lists (or rtyaml if libyaml
+    # isn't available), or "rtyaml" to always use rtyaml. Files that are
+    # written back out are always read with rtyaml, which keeps the comment
+    # at the top of the file.
+    "yaml_loader": "libyaml",
+}
+
+def parse_yaml(f):
+    # Parse YAML from an open file, for reading only.
+    if SETTINGS["yaml_loader"] == "libyaml" and FastYamlLoader is not None:
+        return yaml.load(f, Loader=FastYamlLoader)
+    return rtyaml.load(f)
+
+# Held while a file is read, modified and written back, so that concurrent
+# requests don't overwrite each other's changes.
+_write_lock = threading.Lock()
+
+_parse_flight = SingleFlight("yaml")
 
 def load_opencontrol_yaml(fn, schema_type, expected_schema_versions):
     # Load a YAML file holding a mapping, and check that its schema_version is recognized.
@@ -14,10 +47,23 @@ def load_opencontrol_yaml(fn, schema_type, expected_schema_versions):
     # that may not be the system default encoding (e.g. on Windows the default is based on
     # the system locale). schema_type holds e.g. "system", "standards", or "component," a
     # string to display to the user describing the type of file expected in error messages.
+    #
+    # Any cached data being built right now depends on this file. See cache.py.
+    record_dependency(fn)
     try:
         with open(fn, encoding="utf8") as f:
+            def parse():
+                opencontrol = get_preloaded_file(fn)
+                if opencontrol is None:
+                    metrics.yaml_parses.inc(file_type=schema_type)
+                    metrics.yaml_parse_bytes.inc(os.fstat(f.fileno()).st_size, file_type=schema_type)
+                    with metrics.yaml_parse_duration.time(file_type=schema_type):
+                        opencontrol = parse_yaml(f)
+                return opencontrol
             try:
-                opencontrol = rtyaml.load(f)
+                # Concurrent loads of the same file, unchanged, share one
+                # parse, so callers must not modify the data.
+                opencontrol = _parse_flight.do((os.path.normpath(fn), file_fingerprint(fn)), parse)
             except Exception as e:
                 raise ValueError("OpenControl {} file {} has invalid data (is not valid YAML: {}).".format(
                     schema_type,
@@ -40,6 +86,33 @@ def load_opencontrol_yaml(fn, schema_type, expected_schema_versions):
             fn,
             str(e) ))
 
+# Files parsed ahead of time by preload.py, mapping file names to their
+# fingerprint when they were parsed and their pickled data.
+_preloaded_files = { }
+
+@contextlib.contextmanager
+def using_preloaded_files(files):
+    # Within the with block, load_opencontrol_yaml takes the data of the
+    # given files from files, if they haven't changed since, instead of
+    # parsing them.
+    _preloaded_files.update(files)
+    try:
+        yield
+    finally:
+        for fn in files:
+            _preloaded_files.pop(fn, None)
+
+def get_preloaded_file(fn):
+    # Return a fresh copy of the parsed data of a preloaded file, or None.
+    if not _preloaded_files:
+        return None
+    fn = os.path.normpath(fn)
+    preloaded = _preloaded_files.get(fn)
+    if preloaded is None or preloaded[0] != file_fingerprint(fn):
+        return None
+    import pickle
+    return pickle.loads(preloaded[1])
+
 # This is a utility function to generate a short hex hash for
 # text.
 def short_hash(s, len=6):
@@ -222,9 +295,16 @@ def make_control_number_sort_key(s):
     import re
     return tuple(intify(part) for part in re.split(r"(\d+)", s or ""))
 
+# Concurrent requests for the same project's standards share one load.
+_standards_flight = SingleFlight("standards")
+
 def load_project_standards(project):
-    # Return a mapping from standard_keys to parsed standard data.
+    # Return a mapping from standard_keys to parsed standard data. The data
+    # may be shared with other requests running at the same time, so callers
+    # must not modify it (copy what needs annotating, as routes.controls does).
+    return _standards_flight.do(project["path"], lambda : build_project_standards(project))
 
+def build_project_standards(project):
     standards = { }
 
     # Open the OpenControl system file (the project) and check that its schema_version
@@ -245,18 +325,25 @@ def load_project_standards(project):
     return standards
 
 def load_standard(fn, schema_version, standards):
-    # Read the file..
-    standard_opencontrol = load_opencontrol_yaml(fn, "standard", None) # no schema_version is present in this file
-
+    # Use the standard's precompiled catalog if there is one and it is up to
+    # date (see catalog.py). Otherwise read the file..
+    record_dependency(fn)
+    standard = catalog.load_standard_catalog(fn)
+    if standard is None:
+        standard_opencontrol = load_opencontrol_yaml(fn, "standard", None) # no schema_version is present in this file
+        standard = build_standard(fn, standard_opencontrol)
+    standards[standard["id"]] = standard
+
+def build_standard(fn, standard_opencontrol):
     # The 'key' of a standard is set in its 'name' field, which is weird, but so it is.
     # If there's no name --- it's probably required, but just in case --- fall back to
     # the filename without its extension.
     standard_key = standard_opencontrol.get('name') \
-        or os.path.splitext(os.path.basename(os.path.normpath(fn3)))[0]
+        or os.path.splitext(os.path.basename(os.path.normpath(fn)))[0]
 
     # Create a dict holding information about the standard and the controls
     # within the standard.
-    standards[standard_key] = {
+    return {
         # A unique identifier for the standard. This is used to map URLs to standards --- it's placed in URLs like a slug.
         "id": standard_key,
 
@@ -328,8 +415,10 @@ def load_project_certified_controls(project):
         # Construct the file name.
         fn3 = os.path.join(project["path"], certification_fn)
 
-        # Read the file..
-        certification_opencontrol = load_opencontrol_yaml(fn3, "certification", None) # no schema_version is present in this file
+        # Read the file, or its precompiled catalog (see catalog.py)..
+        record_dependency(fn3)
+        certification_opencontrol = catalog.load_certification_catalog(fn3) \
+            or load_opencontrol_yaml(fn3, "certification", None) # no schema_version is present in this file
 
         # Iterate over each standard...
         for standard_id, controls in certification_opencontrol.get("standards", {}).items():
@@ -659,7 +748,7 @@ def create_component(project, component_path, component_name):
         f.write(rtyaml.dump(component_opencontrol))
 
     # Add the path to the project's opencontrol.yaml file.
-    with open(os.path.join(project["path"], 'opencontrol.yaml'), "r+", encoding="utf8") as f:
+    with _write_lock, open(os.path.join(project["path"], 'opencontrol.yaml'), "r+", encoding="utf8") as f:
         # Parse the content.
         data = rtyaml.load(f)
 
@@ -671,9 +760,7 @@ def create_component(project, component_path, component_name):
         data["components"].append(component_path)
 
         # Write back out to the data files.
-        f.seek(0);
-        f.truncate()
-        rtyaml.dump(data, f)
+        replace_yaml_file(f, data)
 
     # Read the component back and return it.
     for component in load_project_components(project):
@@ -699,6 +786,27 @@ def clean_text(text):
     text += "\n"
   return text
 
+def replace_yaml_file(f, data):
+    # Replace the content of the open file f with data. The new content is
+    # written to a temporary file that is then renamed over f, so that
+    # requests reading the file at the same time see the old or the new
+    # content but never a partly-written file. Where an open file can't be
+    # replaced (Windows), it is rewritten in place.
+    import tempfile
+    content = rtyaml.dump(data)
+    fd, temp_fn = tempfile.mkstemp(dir=os.path.dirname(f.name), prefix=".hypergrc-", suffix=".yaml")
+    try:
+        with open(fd, "w", encoding="utf8") as temp:
+            temp.write(content)
+        shutil.copymode(f.name, temp_fn)
+        os.replace(temp_fn, f.name)
+    except OSError:
+        if os.path.exists(temp_fn):
+            os.unlink(temp_fn)
+        f.seek(0)
+        f.truncate()
+        f.write(content)
+
 def update_component_control(controlimpl):
     # Clean the inputs. Update controlimpl so the caller has the actual values we saved here.
     controlimpl["narrative"] = clean_text(controlimpl["narrative"])
@@ -707,7 +815,7 @@ def update_component_control(controlimpl):
 
     # The control is defined in the component.yaml file given in controlimpl["source_file"].
     # Open that file for editing, find the control record, update it, and return.
-    with open(controlimpl["source_file"], "r+", encoding="utf8") as f:
+    with _write_lock, open(controlimpl["source_file"], "r+", encoding="utf8") as f:
         # Parse the content.
         data = rtyaml.load(f)
 
@@ -737,9 +845,7 @@ def update_component_control(controlimpl):
                             del narrative_part["implementation_status"]
 
                         # Write back out to the data files.
-                        f.seek(0);
-                        f.truncate()
-                        rtyaml.dump(data, f)
+                        replace_yaml_file(f, data)
 
                         return True
 
@@ -758,7 +864,7 @@ def add_component_control(component, controlimpl):
         controlimpl["implementation_status"] = clean_text(controlimpl["implementation_status"])
 
     # Open the source file.
-    with open(controlimpl["source_file"], "r+", encoding="utf8") as f:
+    with _write_lock, open(controlimpl["source_file"], "r+", encoding="utf8") as f:
         # Parse the content.
         data = rtyaml.load(f)
 
@@ -810,6 +916,4 @@ def add_component_control(component, controlimpl):
         control["narrative"].append(narrative_part)
 
         # Write back out to the data files.
-        f.seek(0);
-        f.truncate()
-        rtyaml.dump(data, f)
+        replace_yaml_file(f, data)
@@ -0,0 +1,171 @@
+# Rollups of control implementation data across the whole portfolio of
+# projects, for the portfolio dashboard.
+#
+# Each project's rollup is summed from the per-component statistics kept
+# by statistics.py and is cached until any file it was built from changes.
+# When a narrative is edited, only that project's rollup is re-summed ---
+# from statistics that are themselves updated by delta --- and no YAML is
+# re-read. Organization and portfolio rollups are sums of project rollups.
+
+import time
+
+from . import opencontrol
+from . import statistics
+from .cache import Cache, file_fingerprint
+
+# Narratives in files that haven't been modified in this many days are
+# counted as stale.
+STALE_NARRATIVE_DAYS = 365
+
+_project_rollup_cache = Cache("rollups")
+_certification_index_cache = Cache("certifications")
+
+def load_certification_index(project):
+    # Return a mapping from (standard id, control id) to the control's family
+    # id for every control in the project's certifications. The family comes
+    # from the project's standards, so this is cached separately from the
+    # rollups, which change whenever a narrative is edited.
+    def builder():
+        standards = opencontrol.load_project_standards(project)
+        index = { }
+        for standard_id, control_id in opencontrol.load_project_certified_controls(project):
+            control = standards.get(standard_id, {}).get("controls", {}).get(control_id) or {}
+            index[(standard_id, control_id)] = control.get("family") or control_id.split("-")[0]
+        return index
+    return _certification_index_cache.get(project["path"], builder)
+
+def new_rollup():
+    return {
+        "control_parts": 0,
+        "words": 0,
+        "implementation_status_counts": { },
+        "certified_controls": 0,
+        "certified_controls_implemented": 0,
+        "stale_narratives": 0,
+        "families": { },
+    }
+
+def new_family_rollup(name):
+    return {
+        "name": name,
+        "control_parts": 0,
+        "implementation_status_counts": { },
+        "certified_controls": 0,
+        "certified_controls_implemented": 0,
+        "stale_narratives": 0,
+    }
+
+def load_project_rollup(project):
+    return _project_rollup_cache.get(project["path"], lambda : build_project_rollup(project))
+
+def build_project_rollup(project):
+    stats = statistics.merge_statistics(statistics.load_project_statistics(project).values())
+    rollup = new_rollup()
+    rollup["control_parts"] = stats["control_parts"]
+    rollup["words"] = stats["words"]
+    rollup["implementation_status_counts"] = dict(stats["implementation_statuses"])
+
+    def family(family_id):
+        if family_id not in rollup["families"]:
+            rollup["families"][family_id] = new_family_rollup(stats["family_names"].get(family_id, family_id))
+        return rollup["families"][family_id]
+
+    # Status counts by family.
+    for (family_id, status), n in stats["family_statuses"].items():
+        family(family_id)["control_parts"] += n
+        family(family_id)["implementation_status_counts"][status] = n
+
+    # Certified-control coverage. A certified control is implemented if any
+    # component has a narrative for it. Statistics identify controls by
+    # standard name, which is also the standard's id (see load_standard).
+    for (standard_id, control_id), family_id in load_certification_index(project).items():
+        implemented = (standard_id, control_id) in stats["controls"]
+        for r in (rollup, family(family_id)):
+            r["certified_controls"] += 1
+            if implemented:
+                r["certified_controls_implemented"] += 1
+
+    # Stale narratives. Staleness depends on the clock, not just on the
+    # files, but rollups are re-summed whenever any file changes and the
+    # threshold is measured in days, so that's close enough.
+    stale_before = time.time() - STALE_NARRATIVE_DAYS * 24 * 60 * 60
+    for (family_id, source_file), n in stats["family_source_files"].items():
+        fingerprint = file_fingerprint(source_file)
+        if fingerprint is not None and fingerprint[0] / 1e9 < stale_before:
+            rollup["stale_narratives"] += n
+            family(family_id)["stale_narratives"] += n
+
+    return rollup
+
+def merge_rollups(rollups):
+    # Sum any number of rollups into a new one.
+    def add(total, rollup):
+        for key in ("control_parts", "certified_controls", "certified_controls_implemented", "stale_narratives"):
+            total[key] += rollup[key]
+        for status, n in rollup["implementation_status_counts"].items():
+            total["implementation_status_counts"][status] = total["implementation_status_counts"].get(status, 0) + n
+    total = new_rollup()
+    for rollup in rollups:
+        add(total, rollup)
+        total["words"] += rollup["words"]
+        for family_id, family in rollup["families"].items():
+            if family_id not in total["families"]:
+                total["families"][family_id] = new_family_rollup(family["name"])
+            add(total["families"][family_id], family)
+    return total
+
+def summarize_rollup(rollup):
+    # Return the public (JSON) form of a rollup: families become a sorted
+    # list, empty statuses are labeled "Not specified", and coverage and
+    # averages are computed.
+    def summarize(r):
+        r = dict(r)
+        r["implementation_status_counts"] = dict(r["implementation_status_counts"])
+        if "" in r["implementation_status_counts"]:
+            r["implementation_status_counts"]["Not specified"] = r["implementation_status_counts"].pop("")
+        r["certified_coverage"] = r["certified_controls_implemented"] / r["certified_controls"] if r["certified_controls"] else None
+        return r
+    summary = summarize(rollup)
+    summary["average_words_per_controlpart"] = rollup["words"] / (rollup["control_parts"] or 1)
+    summary["families"] = [
+        dict(summarize(family), id=family_id)
+        for family_id, family in sorted(rollup["families"].items())
+    ]
+    return summary
+
+def build_dashboard(projects):
+    # Build the dashboard's data structure: the portfolio rollup, and the
+    # rollups of each organization and of each project within it, sorted by name.
+    organizations = { }
+    for project in projects:
+        org = project["organization"]["id"]
+        if org not in organizations:
+            organizations[org] = {
+                "id": org,
+                "name": project["organization"]["name"],
+                "projects": [],
+            }
+        organizations[org]["projects"].append({
+            "id": project["id"],
+            "title": project["title"],
+            "url": project["url"],
+            "rollup": load_project_rollup(project),
+        })
+
+    organizations = list(organizations.values())
+    organizations.sort(key = lambda org : org["name"])
+    for org in organizations:
+        org["projects"].sort(key = lambda project : project["title"])
+        org["rollup"] = merge_rollups(project["rollup"] for project in org["projects"])
+    portfolio = merge_rollups(org["rollup"] for org in organizations)
+
+    # Summarize everything for output.
+    for org in organizations:
+        org["rollup"] = summarize_rollup(org["rollup"])
+        for project in org["projects"]:
+            project["rollup"] = summarize_rollup(project["rollup"])
+    return {
+        "portfolio": summarize_rollup(portfolio),
+        "organizations": organizations,
+        "stale_narrative_days": STALE_NARRATIVE_DAYS,
+    }
@@ -0,0 +1,109 @@
+# Loading projects cold, in parallel.
+#
+# Parsing YAML is most of the work of loading a project, and it is pure
+# Python and so can't be sped up with threads. Instead, the files of the
+# projects are found and parsed ahead of time in a pool of worker
+# processes. Each worker returns the parsed data of its files pickled,
+# which is much faster to unpickle than the YAML was to parse. Then the
+# projects are loaded as usual, in this process and in the usual order, but
+# with opencontrol.load_opencontrol_yaml taking the parsed data of each
+# file from the preloaded files instead of parsing it again (see
+# opencontrol.using_preloaded_files).
+#
+# The files that make up a project are found in rounds, since which files
+# there are is only known by parsing other files: first the projects'
+# opencontrol.yaml files, then the standards, certifications and
+# component.yaml files they list, and then the files listed in those.
+
+import os.path
+import pickle
+import time
+
+from .cache import file_fingerprint
+from . import opencontrol
+
+def parse_file(job):
+    # Parse a YAML file of the project in the given directory with the
+    # given loader (see opencontrol.parse_yaml). Runs in a worker process.
+    # Returns the file name, the fingerprint of the file before it was
+    # read, its pickled data, the files it lists, the time spent parsing
+    # and its size --- or a None fingerprint if it couldn't be read or
+    # parsed, which leaves the file to be loaded (and the error to be
+    # reported) as usual.
+    fn, project_dir, yaml_loader = job
+    opencontrol.SETTINGS["yaml_loader"] = yaml_loader
+    fingerprint = file_fingerprint(fn)
+    try:
+        with open(fn, encoding="utf8") as f:
+            start = time.perf_counter()
+            data = opencontrol.parse_yaml(f)
+            duration = time.perf_counter() - start
+    except Exception:
+        return (fn, None, None, [], 0, 0)
+    return (fn, fingerprint, pickle.dumps(data, pickle.HIGHEST_PROTOCOL),
+            find_listed_files(fn, data, project_dir), duration, fingerprint[1])
+
+def find_listed_files(fn, data, project_dir):
+    # Return the files that a parsed file lists and which are part of the
+    # project too.
+    if not isinstance(data, dict):
+        return []
+    if os.path.basename(fn) == "opencontrol.yaml" and os.path.dirname(fn) == project_dir:
+        return [os.path.join(project_dir, path) for path in data.get("standards", []) + data.get("certifications", [])] \
+             + [os.path.join(project_dir, path, "component.yaml") for path in data.get("components", [])]
+    # Component files may list other files of control implementations and
+    # evidence, relative to their own directory.
+    return [
+        os.path.join(os.path.dirname(fn), item)
+        for key in ("satisfies", "verifications")
+        if isinstance(data.get(key), list)
+        for item in data[key]
+        if isinstance(item, str)
+    ]
+
+def preload_files(project_dirs, workers):
+    # Parse the files of the projects in the given directories using a
+    # pool of worker processes. Returns a dict mapping each file name to
+    # its fingerprint and pickled data.
+    from concurrent.futures import ProcessPoolExecutor
+    from . import metrics
+
+    files = { }
+    project_of = { os.path.normpath(os.path.join(project_dir, "opencontrol.yaml")): os.path.normpath(project_dir) for project_dir in project_dirs }
+    batch = sorted(project_of)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        while batch:
+            next_batch = set()
+            jobs = [(fn, project_of[fn], opencontrol.SETTINGS["yaml_loader"]) for fn in batch]
+            chunksize = max(1, len(jobs) // (workers * 4))
+            for fn, fingerprint, data, listed_files, duration, size in pool.map(parse_file, jobs, chunksize=chunksize):
+                if fingerprint is None:
+                    continue
+                files[fn] = (fingerprint, data)
+                metrics.yaml_parses.inc(file_type="preload")
+                metrics.yaml_parse_bytes.inc(size, file_type="preload")
+                metrics.yaml_parse_duration.observe(duration, file_type="preload")
+
+                # Parse the files that this one lists in the next round.
+                # They belong to the same project.
+                for listed_fn in listed_files:
+                    listed_fn = os.path.normpath(listed_fn)
+                    if listed_fn not in project_of:
+                        project_of[listed_fn] = project_of[fn]
+                        next_batch.add(listed_fn)
+            batch = sorted(next_batch)
+    return files
+
+def load_projects(projects, workers):
+    # Load the projects' control implementations and statistics into the
+    # caches, parsing their files in the given number of worker processes
+    # first if it is more than one. Returns the number of files preloaded.
+    from . import coverage, statistics
+    files = { }
+    if workers > 1:
+        files = preload_files([project["path"] for project in projects], workers)
+    with opencontrol.using_preloaded_files(files):
+        for project in projects:
+            coverage.load_project_coverage(project)
+            statistics.load_project_statistics(project)
+    return len(files)
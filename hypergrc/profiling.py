@@ -0,0 +1,129 @@
+# On-demand profiling of requests.
+#
+# An administrator can add `__profile` to the query string of any URL to
+# run that request under Python's deterministic profiler and get back a
+# report instead of the page (`?__profile`), or to get the page as usual
+# and keep the report on the server (`?__profile=keep`). Profiling can also
+# be switched on for every request from /admin/profiles. The reports of
+# the slowest profiled requests are kept in memory and listed there.
+
+import cProfile
+import io
+import itertools
+import pstats
+import threading
+import time
+
+# How many of the slowest profiles to keep.
+MAX_PROFILES = 20
+
+# Whether to profile every request, toggled from /admin/profiles.
+SETTINGS = {
+    "profile_all": False,
+}
+
+PROFILES = [] # the slowest profiles, slowest first
+_profiles_lock = threading.Lock()
+_profile_ids = itertools.count(1)
+_profiler_lock = threading.Lock()
+
+# Functions whose cumulative time is broken out at the top of every report,
+# as (label, test on (filename, line, function name)).
+HOTSPOTS = [
+    # opencontrol.parse_yaml uses PyYAML's yaml.load directly, and rtyaml.load
+    # calls it too, so this counts YAML parsing by either loader once.
+    ("YAML parsing (yaml.load)", lambda fn, line, func : func == "load" and fn.replace("\\", "/").endswith("/yaml/__init__.py")),
+    ("Template rendering (render.render_template)", lambda fn, line, func : func == "render_template" and fn.replace("\\", "/").endswith("hypergrc/render.py")),
+    ("load_project_component_controls", lambda fn, line, func : func == "load_project_component_controls" and fn.replace("\\", "/").endswith("hypergrc/opencontrol.py")),
+    ("Sorting (list.sort, sorted)", lambda fn, line, func : func in ("<method 'sort' of 'list' objects>", "<built-in method builtins.sorted>")),
+]
+
+def take_profile_parameter(path):
+    # Remove the __profile query string parameter from a request path.
+    # Returns the new path and None if the parameter isn't present, or else
+    # the parameter's value ("" if it has no value).
+    if "?" not in path:
+        return path, None
+    base, query = path.split("?", 1)
+    mode = None
+    kept = []
+    for param in query.split("&"):
+        name, _, value = param.partition("=")
+        if name == "__profile":
+            mode = value
+        else:
+            kept.append(param)
+    if mode is None:
+        return path, None
+    return (base + "?" + "&".join(kept) if kept else base), mode
+
+def run_profiled(function):
+    # Call function() under the profiler. Returns the profiler and the
+    # wall-clock duration of the call. Exceptions propagate. Only one
+    # request is profiled at a time --- requests run on concurrent threads,
+    # and since Python 3.12 enabling a second profiler while one is running
+    # raises ValueError --- so if another request is being profiled,
+    # function() is called without the profiler and the profiler returned
+    # is None.
+    if not _profiler_lock.acquire(blocking=False):
+        start = time.perf_counter()
+        function()
+        return None, time.perf_counter() - start
+    try:
+        profiler = cProfile.Profile()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            function()
+        finally:
+            profiler.disable()
+    finally:
+        _profiler_lock.release()
+    return profiler, time.perf_counter() - start
+
+def make_report(profiler, duration, method, path, top=40):
+    # Format a profiler's data as a text report.
+    buf = io.StringIO()
+    stats = pstats.Stats(profiler, stream=buf)
+    buf.write("{} {}\n".format(method, path))
+    buf.write("Total time: {:.1f} ms\n\n".format(duration * 1000))
+
+    # Break out the time spent in a few known hot spots.
+    buf.write("Hot spots (cumulative time, calls):\n")
+    for label, test in HOTSPOTS:
+        cumulative = 0
+        calls = 0
+        for (fn, line, func), (cc, nc, tt, ct, callers) in stats.stats.items():
+            if test(fn, line, func):
+                cumulative += ct
+                calls += nc
+        buf.write("  {:<48} {:9.1f} ms {:8}\n".format(label, cumulative * 1000, calls))
+    buf.write("\n")
+
+    # Then the top functions by cumulative and by internal time.
+    stats.sort_stats("cumulative").print_stats(top)
+    stats.sort_stats("tottime").print_stats(top)
+    return buf.getvalue()
+
+def keep_profile(method, path, duration, report):
+    # Remember a profile if it is among the slowest seen.
+    record = {
+        "id": next(_profile_ids),
+        "method": method,
+        "path": path,
+        "duration": duration,
+        "time": time.time(),
+        "report": report,
+    }
+    with _profiles_lock:
+        PROFILES.append(record)
+        PROFILES.sort(key = lambda record : -record["duration"])
+        del PROFILES[MAX_PROFILES:]
+    return record
+
+def get_profile(profile_id):
+    with _profiles_lock:
+        for record in PROFILES:
+            if record["id"] == profile_id:
+                return record
+    return None
@@ -0,0 +1,353 @@
+# Publishing hyperGRC as a static site.
+#
+# Most people who look at a system's compliance documentation only read
+# it. This renders every page reachable from the home page --- projects,
+# components, controls and each control's grid and combined views,
+# evidence, documents, team, and the SSP exports --- into a directory of
+# plain files that any web server (e.g. nginx) can serve, with links
+# rewritten to be relative so that the directory can be served from any
+# path or even opened from disk:
+#
+#   python -m hypergrc.publish /var/www/hypergrc @repos.conf
+#
+# Pages are found by following links from the home page, in rounds: each
+# round renders the pages linked from the pages of the previous round that
+# haven't been seen yet. The pages of a round are rendered in a pool of
+# worker processes, forked after the projects are loaded so that the
+# workers start with warm caches.
+#
+# Publishing again is incremental. A manifest in the output directory
+# records the files that each page was rendered from (see cache.py) and the
+# pages it links to, and a page is only rendered again when one of its files
+# changed. Everything is rendered again when the list of projects or
+# hyperGRC itself changes, since any page may depend on those. Pages that
+# are no longer linked to are deleted. Files are replaced atomically, so the
+# directory can be served while it is being published.
+#
+# Pages that change things, take input, or are only for administrators
+# (settings, forms, the API, /admin) are not published, and links to them
+# are left pointing at the live hyperGRC server.
+
+import hashlib
+import json
+import os
+import posixpath
+import re
+import shutil
+import sys
+import tempfile
+import time
+from urllib.parse import quote, unquote
+
+from . import routes
+from .cache import file_fingerprint, recording_dependencies
+from .render import CapturedRequest
+
+# The routes that are published, by route function name, and whether each
+# is an HTML page, which is written to index.html in a directory named by
+# its path, or a file, which is written to its path.
+PUBLISHED_ROUTES = {
+    "index": "page",
+    "dashboard": "page",
+    "dashboard_json": "file",
+    "gap_matrix": "page",
+    "project": "page",
+    "documents": "page",
+    "document": "file",
+    "team": "page",
+    "component": "page",
+    "component_guide": "page",
+    "controls": "page",
+    "project_gaps": "page",
+    "project_control_grid": "page",
+    "evidence": "page",
+    "ssp": "file",
+    "component_app_export": "file",
+    "custom_css": "file",
+    "all_components": "page",
+    "narrative_duplicates": "page",
+}
+
+# The name of the manifest in the output directory.
+MANIFEST = ".hypergrc-publish.json"
+
+# The version of the manifest's format. Older manifests are ignored.
+MANIFEST_VERSION = 1
+
+# Site-absolute links in HTML pages, which are rewritten.
+LINK_RE = re.compile(r"""\b(href|src)=(["'])(/(?!/)[^"'<>]*)\2""")
+
+def match_route(url):
+    # Return the name of the GET route for the URL and its path parameters,
+    # or (None, None).
+    for methods, route_path, route_function in routes.ROUTES:
+        if "GET" in methods:
+            m = routes.path_matches(route_path, url)
+            if m is not False:
+                return route_function, m
+    return None, None
+
+def get_output_filename(url):
+    # Return the file, relative to the output directory and with forward
+    # slashes, that the page at url is published to, or None if it isn't
+    # published. Query strings, e.g. of the sorted and paged document lists,
+    # become part of the file name.
+    route_function, m = match_route(url)
+    if route_function is None or route_function.__name__ not in PUBLISHED_ROUTES:
+        return None
+    kind = PUBLISHED_ROUTES[route_function.__name__]
+    path, _, query = url.partition("?")
+    parts = [part for part in unquote(path).split("/") if part]
+    if any(part in (".", "..") for part in parts):
+        return None
+    if query:
+        name = re.sub(r"[^A-Za-z0-9._=,-]", "_", unquote(query)).lstrip(".")
+        parts.append(name + ".html" if kind == "page" else name)
+    elif kind == "page":
+        parts.append("index.html")
+    return "/".join(parts)
+
+def get_relative_link(from_filename, to_filename):
+    # Return a URL for to_filename relative to the page from_filename.
+    return quote(posixpath.relpath(to_filename, posixpath.dirname(from_filename)))
+
+def rewrite_links(html, filename):
+    # Make the site-absolute links in the page published to filename
+    # relative. Returns the new HTML and the URLs of the published pages it
+    # links to.
+    links = set()
+    def replacer(m):
+        url, _, fragment = m.group(3).replace("&amp;", "&").partition("#")
+        if url.startswith("/static/"):
+            # Static files are copied as they are, without any query string.
+            target = url.partition("?")[0].lstrip("/")
+        else:
+            target = get_output_filename(url)
+            if target is None:
+                # Not published. Leave the link pointing at the server.
+                return m.group(0)
+            links.add(url)
+        link = get_relative_link(filename, target) + ("#" + fragment if fragment else "")
+        return "{}={}{}{}".format(m.group(1), m.group(2), link.replace("&", "&amp;"), m.group(2))
+    return LINK_RE.sub(replacer, html), links
+
+def write_file(fn, data):
+    # Write the file atomically so that a web server serving the directory
+    # never sends part of it. The temporary file gets a unique name so that
+    # publishes running at the same time don't write to the same one, and
+    # the permissions a newly created file would have.
+    os.makedirs(os.path.dirname(fn), exist_ok=True)
+    fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn), prefix=".tmp-")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(data)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp_fn, 0o666 & ~umask)
+        os.replace(tmp_fn, fn)
+    except:
+        os.unlink(tmp_fn)
+        raise
+
+def publish_page(job):
+    # Render the page at url into the output directory. Runs in a worker
+    # process. Returns the url, the file it was written to (or None if the
+    # page couldn't be rendered), the files the page was rendered from, and
+    # the URLs of the published pages it links to.
+    url, output_dir, project_list = job
+    if not routes.PROJECT_LIST:
+        # Worker processes that weren't forked need the project list.
+        routes.PROJECT_LIST[:] = project_list
+    filename = get_output_filename(url)
+    route_function, m = match_route(url)
+    request = CapturedRequest("GET", url)
+    try:
+        with recording_dependencies() as dependencies:
+            resp = route_function(request, **m)
+    except Exception as e:
+        print("[hyperGRC] {} could not be published: {}".format(url, e), file=sys.stderr)
+        return (url, None, { }, [])
+    if isinstance(resp, str):
+        request.status = 200
+        request.wfile.write(resp.encode("utf8"))
+    if request.status != 200:
+        print("[hyperGRC] {} could not be published: HTTP status {}".format(url, request.status), file=sys.stderr)
+        return (url, None, { }, [])
+    if request.close_connection:
+        # The page failed partway through, after the 200 status was sent.
+        # See render.render_template.
+        print("[hyperGRC] {} could not be published: the page is incomplete".format(url), file=sys.stderr)
+        return (url, None, { }, [])
+
+    data = request.wfile.getvalue()
+    links = set()
+    if PUBLISHED_ROUTES[route_function.__name__] == "page":
+        html, links = rewrite_links(data.decode("utf8"), filename)
+        data = html.encode("utf8")
+    write_file(os.path.join(output_dir, *filename.split("/")), data)
+    return (url, filename, dependencies, sorted(links))
+
+def get_site_fingerprint(project_list):
+    # Return a value that changes when the list of projects or hyperGRC's
+    # code or templates change, any of which may change any page.
+    h = hashlib.sha256()
+    h.update(json.dumps(project_list).encode("utf8"))
+    package_dir = os.path.dirname(os.path.abspath(__file__))
+    for dirpath, dirnames, filenames in os.walk(package_dir):
+        dirnames[:] = sorted(dirname for dirname in dirnames if dirname != "__pycache__")
+        for fn in sorted(filenames):
+            fn = os.path.join(dirpath, fn)
+            h.update(json.dumps([os.path.relpath(fn, package_dir), file_fingerprint(fn)]).encode("utf8"))
+    return h.hexdigest()
+
+def read_manifest(output_dir):
+    # Return the site fingerprint and the pages recorded in the output
+    # directory's manifest, or None and an empty dict if there is none.
+    try:
+        with open(os.path.join(output_dir, MANIFEST), encoding="utf8") as f:
+            manifest = json.load(f)
+    except (OSError, ValueError):
+        return None, { }
+    if manifest.get("version") != MANIFEST_VERSION:
+        return None, { }
+    return manifest["site"], manifest["pages"]
+
+def is_page_current(page, output_dir):
+    # Was the page published from files that haven't changed since? Pages
+    # that weren't rendered from any files can't be checked.
+    if not page["dependencies"]:
+        return False
+    if not os.path.isfile(os.path.join(output_dir, *page["file"].split("/"))):
+        return False
+    return all(
+        file_fingerprint(fn) == (tuple(fingerprint) if fingerprint else None)
+        for fn, fingerprint in page["dependencies"].items())
+
+def copy_static_files(output_dir):
+    # Copy the static files that the pages use (see __main__.Handler), or
+    # just the ones that changed.
+    static_dir = "static"
+    for dirpath, dirnames, filenames in os.walk(static_dir):
+        for fn in filenames:
+            src = os.path.join(dirpath, fn)
+            dst = os.path.join(output_dir, src)
+            if file_fingerprint(src) != file_fingerprint(dst):
+                os.makedirs(os.path.dirname(dst), exist_ok=True)
+                shutil.copy2(src, dst)
+
+def remove_page(output_dir, filename):
+    # Delete a page that is no longer published, and its directories if
+    # they are left empty.
+    fn = os.path.join(output_dir, *filename.split("/"))
+    try:
+        os.unlink(fn)
+    except OSError:
+        return
+    directory = os.path.dirname(fn)
+    while os.path.normpath(directory) != os.path.normpath(output_dir):
+        try:
+            os.rmdir(directory)
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+def publish(output_dir, workers):
+    # Publish every page reachable from the home page into output_dir,
+    # rendering only the pages whose files changed since the last time.
+    # Returns the number of pages published, the number rendered, and the
+    # number of pages deleted because they are no longer linked to.
+    from . import preload
+
+    project_list = list(routes.PROJECT_LIST)
+    site_fingerprint = get_site_fingerprint(project_list)
+    previous_site_fingerprint, previous = read_manifest(output_dir)
+    pages = { }
+    rendered = 0
+    loaded = False
+    pool = None
+
+    copy_static_files(output_dir)
+
+    try:
+        batch = ["/"]
+        seen = set(batch)
+        while batch:
+            # Pages whose files are unchanged are kept, and their recorded
+            # links are followed without rendering them.
+            jobs = []
+            links = []
+            for url in batch:
+                page = previous.get(url)
+                if page is not None and previous_site_fingerprint == site_fingerprint and is_page_current(page, output_dir):
+                    pages[url] = page
+                    links.extend(page["links"])
+                else:
+                    jobs.append((url, output_dir, project_list))
+
+            if jobs:
+                # Load the projects before the first page is rendered, and
+                # before the workers are forked so that they share the
+                # loaded data.
+                if not loaded:
+                    preload.load_projects(list(routes.load_projects()), workers)
+                    loaded = True
+                if workers > 1 and pool is None:
+                    from concurrent.futures import ProcessPoolExecutor
+                    pool = ProcessPoolExecutor(max_workers=workers)
+                if pool is not None:
+                    chunksize = max(1, len(jobs) // (workers * 4))
+                    results = pool.map(publish_page, jobs, chunksize=chunksize)
+                else:
+                    results = map(publish_page, jobs)
+                for url, filename, dependencies, page_links in results:
+                    if filename is None:
+                        continue
+                    pages[url] = {
+                        "file": filename,
+                        "dependencies": dependencies,
+                        "links": page_links,
+                    }
+                    links.extend(page_links)
+                    rendered += 1
+
+            # Render the pages linked to that haven't been seen yet next.
+            batch = sorted(set(url for url in links if url not in seen))
+            seen.update(batch)
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    # Delete the pages that are no longer linked to, unless the same file
+    # was published for another page.
+    published_files = set(page["file"] for page in pages.values())
+    removed = 0
+    for url, page in previous.items():
+        if url not in pages and page["file"] not in published_files:
+            remove_page(output_dir, page["file"])
+            removed += 1
+
+    manifest = {
+        "version": MANIFEST_VERSION,
+        "site": site_fingerprint,
+        "pages": pages,
+    }
+    write_file(os.path.join(output_dir, MANIFEST), json.dumps(manifest, indent=1, sort_keys=True).encode("utf8"))
+    return len(pages), rendered, removed
+
+if __name__ == "__main__":
+    import argparse
+    from . import repos
+    parser = argparse.ArgumentParser(description="Publish hyperGRC's pages as a static site.")
+    parser.add_argument("output", help="the directory to publish into")
+    parser.add_argument("project", nargs="*", default=["@repos.conf"], help="project directories to publish (or @file to read them from a file)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="number of processes to render pages in (default: one per CPU)")
+    args = parser.parse_args()
+    try:
+        repos.configure(args.project)
+    except ValueError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
+    start = time.perf_counter()
+    published, rendered, removed = publish(args.output, max(1, args.workers))
+    print("Published {} pages ({} rendered, {} removed) into {} in {:.1f} s.".format(
+        published, rendered, removed, args.output, time.perf_counter() - start))
@@ -1,14 +1,75 @@
 import re
 
-from jinja2 import Environment, FileSystemLoader, evalcontextfilter, Markup, escape
+from jinja2 import Environment, FileSystemLoader, FileSystemBytecodeCache, evalcontextfilter, Markup, escape
+import io
 import os.path
 import json
+import time
+
+from . import metrics
+from .fragments import FRAGMENTS, controlimpl_fingerprint
 
 
 jinja_env = Environment(
 	loader=FileSystemLoader(__package__ + '/templates'),
 	autoescape=True)
 
+# Settings made on the command line. See __main__.py and configure_templates.
+SETTINGS = {
+	# Report how long each page spent loading and rendering its template,
+	# in a Server-Timing header and on the console.
+	"debug": False,
+}
+
+#############################
+# Template compilation
+#############################
+
+class SharedBytecodeCache(FileSystemBytecodeCache):
+	# Jinja's on-disk cache of compiled templates, made safe to share between
+	# processes: a cache file is written to a temporary file and then renamed
+	# into place so that no process reads a partly-written file, and a cache
+	# directory that can't be written to (e.g. one filled at build time) is
+	# only read from.
+	def dump_bytecode(self, bucket):
+		import tempfile
+		fn = self._get_cache_filename(bucket)
+		try:
+			fd, tmp_fn = tempfile.mkstemp(dir=self.directory, prefix=".tmp")
+		except OSError:
+			return
+		try:
+			with os.fdopen(fd, "wb") as f:
+				bucket.write_bytecode(f)
+			os.replace(tmp_fn, fn)
+		except OSError:
+			try:
+				os.unlink(tmp_fn)
+			except OSError:
+				pass
+
+def configure_templates(bytecode_cache_dir=None, production=False, debug=False):
+	# Keep compiled templates in bytecode_cache_dir, which is shared by all
+	# hyperGRC processes. (Jinja's default is a directory in the system's
+	# temporary directory.) In production, templates are assumed not to
+	# change while hyperGRC is running, so don't check their files for
+	# changes on every request.
+	if bytecode_cache_dir:
+		os.makedirs(bytecode_cache_dir, exist_ok=True)
+	jinja_env.bytecode_cache = SharedBytecodeCache(bytecode_cache_dir)
+	jinja_env.auto_reload = not production
+	SETTINGS["debug"] = debug
+
+def warm_templates():
+	# Compile (or load from the bytecode cache) every template so that the
+	# first requests after startup don't pay for it. Returns the number of
+	# templates and the time it took.
+	start = time.perf_counter()
+	template_names = [name for name in jinja_env.list_templates() if name.endswith(".html")]
+	for name in template_names:
+		jinja_env.get_template(name)
+	return len(template_names), time.perf_counter() - start
+
 #############################
 # Jinja Helpers
 #############################
@@ -36,27 +97,117 @@ def blockquote(s):
   return "\n".join((" " + line) for line in s.strip().split("\n")) + "\n"
 jinja_env.filters['blockquote'] = blockquote
 
+def format_timestamp(t):
+  import datetime
+  return datetime.datetime.fromtimestamp(t).strftime("%Y-%m-%d %H:%M")
+jinja_env.filters['timestamp'] = format_timestamp
+
+# Render a template as a fragment of a page, or get it from the fragment
+# cache if it was already rendered for key. See fragments.py.
+def render_fragment(template_fn, key, **contextvars):
+  return Markup(FRAGMENTS.get((template_fn, key), lambda : jinja_env.get_template(template_fn).render(**contextvars)))
+jinja_env.globals['render_fragment'] = render_fragment
+
+jinja_env.filters['controlimpl_fingerprint'] = controlimpl_fingerprint
+
+# Pages are sent as they are rendered, this many bytes at a time, so that
+# the browser can start on large pages before rendering finishes. Pages
+# smaller than this are sent all at once.
+STREAM_BUFFER_SIZE = 32768
+
 def render_template(request, template_fn, **contextvars):
 	try:
+		load_start = time.perf_counter()
 		template = jinja_env.get_template(template_fn)
-		body = template.render(**contextvars)
+
+		# Render the first buffer-full of the page before sending anything so
+		# that if rendering fails early, as it usually does, or the page is
+		# small, we can still send an error response.
+		render_start = time.perf_counter()
+		chunks = template.generate(**contextvars)
+		buf = read_template_chunks(chunks)
+		first_chunk_time = time.perf_counter() - render_start
 	except Exception as e:
 		import traceback
 		traceback.print_exc()
-		request.send_response(500)
-		request.send_header("Content-Type", "text/plain; charset=UTF-8")
-		request.end_headers()
-		request.wfile.write(b"Ooops! Something went wrong.")
+		send_body(request, 500, "text/plain; charset=UTF-8", b"Ooops! Something went wrong.")
 		return
 
+	# Use chunked transfer encoding when the server and the client both speak
+	# HTTP/1.1 (see __main__.Handler), so that the connection can be kept
+	# open after the response and so that a response cut short by an error
+	# is seen to be incomplete: it lacks the final empty chunk. Otherwise
+	# (HTTP/1.0) the end of the response is the end of the connection.
+	chunked = (getattr(request, "protocol_version", None) == "HTTP/1.1"
+	           and getattr(request, "request_version", None) == "HTTP/1.1")
+	def write(data):
+		if chunked:
+			request.wfile.write("{:x}\r\n".format(len(data)).encode("ascii") + data + b"\r\n")
+		else:
+			request.wfile.write(data)
+
 	request.send_response(200)
 	request.send_header("Content-Type", "text/html; charset=UTF-8")
+	if chunked:
+		request.send_header("Transfer-Encoding", "chunked")
+
+	# In debug mode, break down the time spent on the template. Only the
+	# time until the first part of the page is sent can go in the header.
+	load_time = render_start - load_start
+	if SETTINGS["debug"]:
+		request.send_header("Server-Timing", "template-load;dur={:.2f}, template-first-chunk;dur={:.2f}".format(
+			load_time * 1000, first_chunk_time * 1000))
+
 	request.end_headers()
-	request.wfile.write(body.encode("utf8"))
 
-def send_file_response(request, file_path, data, content_type="application/octet-stream"):
-    # Form and send the response
-	request.send_response(200)
+	# Send the rest of the page as it is rendered.
+	size = 0
+	try:
+		while buf:
+			write(buf)
+			size += len(buf)
+			buf = read_template_chunks(chunks)
+	except OSError:
+		# The client went away.
+		request.close_connection = True
+		return
+	except Exception as e:
+		# Rendering failed partway through. The response has already begun,
+		# so all we can do is say so at the end of what was sent and not
+		# mark the response as complete.
+		import traceback
+		traceback.print_exc()
+		request.close_connection = True
+		try:
+			write(b"<p><strong>Ooops! Something went wrong.</strong></p>")
+		except OSError:
+			pass
+		return
+	finally:
+		render_time = time.perf_counter() - render_start
+		metrics.template_render_duration.observe(render_time, template=template_fn)
+	if chunked:
+		request.wfile.write(b"0\r\n\r\n")
+
+	if SETTINGS["debug"]:
+		print("[template] {}: load {:.1f} ms, first chunk {:.1f} ms, render and send {:.1f} ms, {} bytes".format(
+			template_fn, load_time * 1000, first_chunk_time * 1000, render_time * 1000, size))
+
+def read_template_chunks(chunks):
+	# Read the output of a template from the chunks generator until there is
+	# at least STREAM_BUFFER_SIZE bytes of it, or until it ends. Returns the
+	# UTF-8 encoded bytes, which are empty at the end of the template.
+	parts = []
+	size = 0
+	for chunk in chunks:
+		chunk = chunk.encode("utf8")
+		parts.append(chunk)
+		size += len(chunk)
+		if size >= STREAM_BUFFER_SIZE:
+			break
+	return b"".join(parts)
+
+def send_attachment_headers(request, file_path, content_type):
 	request.send_header("Content-Type", content_type)
 	request.send_header('Content-Disposition', 'attachment; filename=' + os.path.basename(file_path))
 
@@ -68,45 +219,200 @@ def send_file_response(request, file_path, data, content_type="application/octet
 		request.send_header('X-Content-Type-Options', 'nosniff')
 		request.send_header('X-Download-Options', 'noopen')
 
-	# mimetype
+def send_file_response(request, file_path, data, content_type="application/octet-stream"):
+	# Form and send the response
+	request.send_response(200)
+	send_attachment_headers(request, file_path, content_type)
+	request.send_header("Content-Length", str(len(data)))
 	request.end_headers()
 	request.wfile.write(data)
 
+# Files that can't be sent with sendfile are copied to the client in blocks
+# of this many bytes.
+SEND_FILE_BLOCK_SIZE = 65536
+
 def send_file(request, file_path):
 	"""Send a text or binary file"""
 
 	# Confirm file exists and send exception if file does not exist
 	try:
-		with open(file_path, 'rb') as f:
-			data = f.read()
+		f = open(file_path, 'rb')
 	except Exception as e:
 		import traceback
 		traceback.print_exc()
-		request.send_response(500)
-		request.send_header("Content-Type", "text/plain; charset=UTF-8")
+		send_body(request, 500, "text/plain; charset=UTF-8", b"Ooops! Something went wrong.")
+		return
+
+	with f:
+		# The file's size and modification time identify its version.
+		import email.utils
+		st = os.fstat(f.fileno())
+		size = st.st_size
+		etag = '"{:x}-{:x}"'.format(st.st_mtime_ns, size)
+		last_modified = email.utils.formatdate(st.st_mtime, usegmt=True)
+
+		# If the client already has this version, say so.
+		if is_not_modified(request, etag, st.st_mtime):
+			request.send_response(304)
+			request.send_header("ETag", etag)
+			request.send_header("Last-Modified", last_modified)
+			request.end_headers()
+			return
+
+		# Send part of the file if the client asks for one range of bytes of
+		# this version of it (e.g. to resume a download), otherwise all of it.
+		byte_range = None
+		if_range = request.headers.get("If-Range")
+		if request.headers.get("Range") and if_range in (None, etag, last_modified):
+			byte_range = parse_range_header(request.headers["Range"], size)
+		if byte_range is False:
+			request.send_response(416)
+			request.send_header("Content-Range", "bytes */{}".format(size))
+			request.send_header("Content-Length", "0")
+			request.end_headers()
+			return
+		start, end = byte_range or (0, size)
+
+		request.send_response(206 if byte_range else 200)
+		send_attachment_headers(request, file_path, "application/octet-stream")
+		request.send_header("Content-Length", str(end - start))
+		if byte_range:
+			request.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+		request.send_header("Accept-Ranges", "bytes")
+		request.send_header("ETag", etag)
+		request.send_header("Last-Modified", last_modified)
 		request.end_headers()
-		request.wfile.write(b"Ooops! Something went wrong.")
+
+		# A HEAD request gets only the headers.
+		if getattr(request, "command", None) == "HEAD":
+			return
+
+		try:
+			copy_file_to_response(request, f, start, end - start)
+		except OSError:
+			# The client went away.
+			request.close_connection = True
+
+def is_not_modified(request, etag, mtime):
+	# Does the client already have the version of the file with the given
+	# ETag and modification time, per its If-None-Match or (if that's not
+	# given) If-Modified-Since header?
+	if_none_match = request.headers.get("If-None-Match")
+	if if_none_match:
+		tags = [tag.strip() for tag in if_none_match.split(",")]
+		return "*" in tags or etag in tags or ("W/" + etag) in tags
+	if_modified_since = request.headers.get("If-Modified-Since")
+	if if_modified_since:
+		import email.utils
+		try:
+			since = email.utils.parsedate_to_datetime(if_modified_since).timestamp()
+		except (TypeError, ValueError):
+			return False
+		return int(mtime) <= since
+	return False
+
+def parse_range_header(value, size):
+	# Parse a Range header asking for one range of bytes of a file of the
+	# given size. Returns the (start, end) of the range, with end exclusive,
+	# False if the range lies outside of the file, or None if the header
+	# should be ignored because it isn't a single valid byte range.
+	m = re.match(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", value)
+	if not m or m.group(1) == m.group(2) == "":
+		return None
+	if m.group(1) == "":
+		# The last n bytes.
+		n = int(m.group(2))
+		if n == 0 or size == 0:
+			return False
+		return (max(0, size - n), size)
+	start = int(m.group(1))
+	if m.group(2) != "" and int(m.group(2)) < start:
+		return None
+	if start >= size:
+		return False
+	end = size if m.group(2) == "" else min(int(m.group(2)) + 1, size)
+	return (start, end)
+
+def copy_file_to_response(request, f, offset, count):
+	# Send count bytes of the open file f starting at offset. When the
+	# response goes straight to the client's socket, the operating system
+	# copies the bytes with sendfile (where it can) without reading them into
+	# memory here. Otherwise, e.g. when the response is being captured for
+	# profiling, they are copied a block at a time.
+	if request.wfile is getattr(request, "socket_wfile", None):
+		request.connection.sendfile(f, offset, count)
 		return
-	send_file_response(request, file_path, data)
+	f.seek(offset)
+	while count > 0:
+		block = f.read(min(count, SEND_FILE_BLOCK_SIZE))
+		if not block:
+			break
+		request.wfile.write(block)
+		count -= len(block)
 
 def redirect(request, url):
 	request.send_response(301)
 	request.send_header("Location", url)
+	request.send_header("Content-Length", "0")
 	request.end_headers()
 
+def send_body(request, code, content_type, body):
+	# Send a response whose body, in bytes, is known up front. Its length is
+	# sent so that the client can reuse the connection for its next request.
+	request.send_response(code)
+	request.send_header("Content-Type", content_type)
+	request.send_header("Content-Length", str(len(body)))
+	request.end_headers()
+	request.wfile.write(body)
+
 def send_json_response(request, data):
 	try:
-		body = json.dumps(data, indent=2)
+		with metrics.json_serialize_duration.time():
+			body = json.dumps(data, indent=2)
 	except Exception as e:
 		import traceback
 		traceback.print_exc()
-		request.send_response(500)
-		request.send_header("Content-Type", "text/plain; charset=UTF-8")
-		request.end_headers()
-		request.wfile.write(b"Ooops! Something went wrong.")
+		send_body(request, 500, "text/plain; charset=UTF-8", b"Ooops! Something went wrong.")
 		return
 
-	request.send_response(200)
-	request.send_header("Content-Type", "application/json")
-	request.end_headers()
-	request.wfile.write(body.encode("utf8"))
+	send_body(request, 200, "application/json", body.encode("utf8"))
+
+class CapturedRequest:
+	# Stands in for __main__.Handler when a route is called outside of the
+	# web server, e.g. to benchmark it or to publish its page: collects the
+	# response in memory.
+
+	def __init__(self, method, path, form=None):
+		self.method = method
+		self.path = path
+		self.form = form or { }
+		self.headers = { }
+		self.client_address = ("127.0.0.1", 0)
+		self.wfile = io.BytesIO()
+		self.status = None
+		# Set by render_template if the page failed partway through.
+		self.close_connection = False
+
+	def send_response(self, code, message=None):
+		self.status = code
+
+	def send_header(self, name, value):
+		pass
+
+	def end_headers(self):
+		pass
+
+	def send_error(self, code, message=None):
+		self.status = code
+
+if __name__ == "__main__":
+	# Precompile all templates into a bytecode cache directory, e.g. when
+	# building a deployment, so that hyperGRC processes started with
+	# --template-cache pointing at it never compile templates.
+	import argparse
+	parser = argparse.ArgumentParser(description="Precompile hyperGRC's templates.")
+	parser.add_argument("directory", help="the bytecode cache directory to write to")
+	args = parser.parse_args()
+	configure_templates(args.directory)
+	count, duration = warm_templates()
+	print("Compiled {} templates into {} in {:.0f} ms.".format(count, args.directory, duration * 1000))
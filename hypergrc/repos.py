@@ -0,0 +1,154 @@
+# The list of projects that hyperGRC serves, and keeping it up to date
+# while the server runs.
+#
+# Projects are given on the command line, either directly or in listing
+# files named with an @-sign, like @repos.conf. A watcher thread re-reads
+# the listing files when they change (e.g. when /create-system appends a
+# new system to repos.conf) and checks that the listed projects exist, so
+# that systems can be added and retired without restarting hyperGRC and
+# losing what it has cached. Projects that were added are loaded into the
+# caches before they are served, the cached data of projects that were
+# removed is dropped, and projects that are still listed keep their warm
+# caches. The list in routes.PROJECT_LIST is replaced in one step, so a
+# request sees either the old list or the new one.
+
+import os.path
+import sys
+import threading
+import time
+
+from . import routes
+from .cache import file_fingerprint, invalidate_directory
+
+SETTINGS = {
+    # Seconds between checks of the listing files for changes.
+    "watch_interval": 2,
+}
+
+# The command-line arguments the project list was made from.
+_sources = []
+
+# The projects that are listed but can't be served (yet), mapped to why,
+# so that each problem is only reported once.
+_problems = { }
+
+_reload_lock = threading.Lock()
+_watcher = None
+
+def read_project_list(sources):
+    # Return the project directories given by the command-line arguments,
+    # reading any @-prefixed listing files. '@' prefixes are the Unixy-way
+    # of saying read a list from a file and use the contents of the listing
+    # file as if they were command-line arguments.
+    project_list = []
+    for source in sources:
+        if source.startswith("@"):
+            # Read the listing file.
+            if not os.path.isfile(source[1:]):
+                raise ValueError("File `{}` listing Compliance as Code repositories was not found.".format(source[1:]))
+            with open(source[1:], 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line and not line.startswith("#"):
+                        project_list.append(line)
+        else:
+            # Append this argument.
+            project_list.append(source)
+    return project_list
+
+def check_project_dir(project_dir):
+    # Raise ValueError if the directory isn't a project.
+    if not os.path.isdir(project_dir):
+        raise ValueError("Path `{}` to Compliance as Code repository was not found.".format(project_dir))
+    if not os.path.isfile(os.path.join(project_dir, 'opencontrol.yaml')):
+        raise ValueError("Path `{}` to Compliance as Code repository does not contain a file named opencontrol.yaml.".format(project_dir))
+
+def configure(sources):
+    # Set the projects to serve from the command-line arguments, at startup.
+    # Raises ValueError if any listing file or project is missing.
+    project_list = read_project_list(sources)
+    for project_dir in project_list:
+        check_project_dir(project_dir)
+    _sources[:] = sources
+    routes.PROJECT_LIST[:] = project_list
+
+def reload():
+    # Re-read the project list and serve the projects that were added and
+    # stop serving the ones that were removed. Returns the lists of added
+    # and removed project directories.
+    from . import opencontrol, preload
+    with _reload_lock:
+        try:
+            project_list = read_project_list(_sources)
+        except (OSError, ValueError) as e:
+            # Keep the current list until the listing file is back.
+            report_problem(None, str(e))
+            return [], []
+        report_problem(None, None)
+
+        current = set(routes.PROJECT_LIST)
+        new_list = []
+        added = []
+        for project_dir in project_list:
+            if project_dir not in current and project_dir not in added:
+                # Load the project, which must exist and be readable, before
+                # serving it. A project that can't be loaded is tried again
+                # at the next check.
+                try:
+                    check_project_dir(project_dir)
+                    preload.load_projects([opencontrol.load_project_from_path(project_dir)], 1)
+                except Exception as e:
+                    report_problem(project_dir, str(e))
+                    continue
+                report_problem(project_dir, None)
+                added.append(project_dir)
+            new_list.append(project_dir)
+        for project_dir in list(_problems):
+            if project_dir is not None and project_dir not in project_list:
+                report_problem(project_dir, None)
+        removed = sorted(current - set(new_list))
+        if not added and not removed:
+            return [], []
+
+        routes.PROJECT_LIST[:] = new_list
+        for project_dir in removed:
+            invalidate_directory(project_dir)
+
+    for project_dir in added:
+        sys.stdout.write("[hyperGRC] now serving {}\n".format(project_dir))
+    for project_dir in removed:
+        sys.stdout.write("[hyperGRC] no longer serving {}\n".format(project_dir))
+    return added, removed
+
+def report_problem(project_dir, problem):
+    # Print a problem with the project list (or with a project, if
+    # project_dir is not None) once, or forget it when problem is None.
+    if problem is None:
+        _problems.pop(project_dir, None)
+    elif _problems.get(project_dir) != problem:
+        _problems[project_dir] = problem
+        sys.stderr.write("[hyperGRC] {}\n".format(problem))
+
+def get_listing_fingerprints():
+    return [file_fingerprint(source[1:]) for source in _sources if source.startswith("@")]
+
+def watch(fingerprints):
+    # Reload the project list whenever a listing file changes, and retry the
+    # projects that couldn't be loaded the last time.
+    while True:
+        time.sleep(SETTINGS["watch_interval"])
+        current = get_listing_fingerprints()
+        if current == fingerprints and not any(project_dir is not None for project_dir in _problems):
+            continue
+        fingerprints = current
+        try:
+            reload()
+        except Exception:
+            import traceback
+            traceback.print_exc()
+
+def start_watcher():
+    global _watcher
+    if _watcher is None:
+        _watcher = threading.Thread(target=watch, args=(get_listing_fingerprints(),), name="hypergrc-repos-watcher", daemon=True)
+        _watcher.start()
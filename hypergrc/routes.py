@@ -1,15 +1,31 @@
 # This module contains hyperGRC's routes, i.e. handlers for
 # virtual paths.
 
-from .render import render_template, redirect, send_file, send_file_response, send_json_response
+from .render import render_template, redirect, send_body, send_file, send_file_response, send_json_response
 from . import opencontrol
+from . import statistics
+from . import metrics
+from . import fragments
+from . import events
+from . import baselines
+from . import documents as documents_index
+from .cache import recording_dependencies, record_dependency
 import os
-import glob
+import json
 import rtyaml
 
 PROJECT_LIST = []
 ROUTES = []
 
+# Settings made on the command line. See __main__.py.
+SETTINGS = {
+  # A secret that administrators present to use admin features, in the
+  # X-hyperGRC-Admin-Token header or hypergrc_admin_token cookie. If it
+  # is not set, admin features are available to requests from this
+  # machine only.
+  "admin_token": None,
+}
+
 #############################
 # Helpers
 #############################
@@ -48,12 +64,16 @@ def parse_route_path_string(path):
       # Return it escaped so it can be included in a regular expression literally.
       return re.escape(m.group(0))
   
+  # Routes that don't specify a query string themselves accept any query
+  # string, which the route function can read with get_query_parameters.
+  query = "$" if "?" in path else r"(?:\?.*)?$"
+
   # Replace <variable>s with named groups and escape every other character
   # in the path pattern.
   path = re.sub(r"<([a-z_]+?)>|.", replacer, path)
 
   # Return the compiled regular expression.
-  path = re.compile(path + "$")
+  path = re.compile(path + query)
   return path
 
 # This defines an @route decorator that adds the function to the ROUTES routing
@@ -66,6 +86,69 @@ def route(path, methods=["GET"]):
     return route_function
   return decorator
 
+def path_matches(route_path, path):
+  # Does path match the route path specification in route_path?
+  # If so, return a dict mapping path components to parts of
+  # the input path. Un-URL-encode the values.
+  from urllib.parse import unquote_plus
+  m = route_path.match(path)
+  if m:
+    return {
+      k: unquote_plus(v)
+      for k, v
+      in m.groupdict().items()
+    }
+  return False
+
+def get_query_parameters(request):
+  # Parse the query string of the request into a dict, which like
+  # request.form maps names to a value or, for repeated names, a list.
+  from urllib.parse import parse_qs
+  query = parse_qs(request.path.partition("?")[2])
+  return { key: value[0] if len(value) == 1 else value for key, value in query.items() }
+
+# Is the request from an administrator?
+def is_admin(request):
+  if SETTINGS["admin_token"]:
+    import hmac, http.cookies
+    token = request.headers.get("X-hyperGRC-Admin-Token")
+    if not token:
+      cookie = http.cookies.SimpleCookie(request.headers.get("Cookie", ""))
+      token = cookie["hypergrc_admin_token"].value if "hypergrc_admin_token" in cookie else ""
+    return hmac.compare_digest(token.encode("utf8"), SETTINGS["admin_token"].encode("utf8"))
+  return request.client_address[0] in ("127.0.0.1", "::1")
+
+# Send a 403 response and return False if the request is not from an
+# administrator. Admin routes start with `if not require_admin(request): return`.
+def require_admin(request):
+  if is_admin(request):
+    return True
+  send_body(request, 403, "text/plain; charset=UTF-8", b"This page is only available to administrators.")
+  return False
+
+# A secret that admin pages put in their forms. Browsers send the admin
+# cookie (and, without an admin token, come from this machine) with POSTs
+# that any web site the administrator visits can make, but other sites
+# can't read admin pages to learn this.
+ADMIN_FORM_TOKEN = os.urandom(16).hex()
+
+# Send a 403 response and return False if a POST to an admin route does
+# not carry the admin form token, or for scripts the admin token in the
+# X-hyperGRC-Admin-Token header. Admin routes that change things on POST
+# call this after require_admin.
+def require_admin_post(request):
+  if request.method != "POST":
+    return True
+  import hmac
+  token = request.form.get("admin_form_token")
+  if isinstance(token, str) and hmac.compare_digest(token.encode("utf8"), ADMIN_FORM_TOKEN.encode("utf8")):
+    return True
+  token = request.headers.get("X-hyperGRC-Admin-Token")
+  if SETTINGS["admin_token"] and token and hmac.compare_digest(token.encode("utf8"), SETTINGS["admin_token"].encode("utf8")):
+    return True
+  send_body(request, 403, "text/plain; charset=UTF-8", b"This form has expired. Reload the page and try again.")
+  return False
+
 #############################
 # Model helpers
 #############################
@@ -73,7 +156,9 @@ def route(path, methods=["GET"]):
 def load_projects():
     # Yield a dict of information for each project by reading the opencontrol.yaml
     # file in each project directory.
-    for project_dir in PROJECT_LIST:
+    # PROJECT_LIST may be replaced while we iterate (see repos.py), so
+    # iterate over the list as it is now.
+    for project_dir in list(PROJECT_LIST):
         yield opencontrol.load_project_from_path(project_dir)
 
 def load_project(organization_id, project_id):
@@ -83,17 +168,14 @@ def load_project(organization_id, project_id):
     # paths at application startup.
     for project in load_projects():
         if project["organization"]["id"] == organization_id and project["id"] == project_id:
+            # Keep the data of the project warm from now on. See warmer.py.
+            from . import warmer
+            warmer.record_access(project)
             return project
     raise ValueError("Project {} not found.".format(project_id))
 
-# Helper to retrive all document directories, included nested sub-directories
-def get_document_directories(project):
-
-  # Temporarily hardcode the documents directory to "outputs".
-  # We are hardcoding the directory until we modify the opencontrol.yaml
-  # file to include a list of directories.
-  dir_list = [x[0] for x in os.walk(os.path.join(project["path"], "outputs"))]
-  return dir_list
+# How many documents to list on each page of a project's documents.
+DOCUMENTS_PER_PAGE = 100
 
 implementation_status_css_classes = {
   "In Place": "glyphicon glyphicon-ok-circle color-green",
@@ -141,6 +223,45 @@ def index(request):
         modify_msg=modify_msg
     )
 
+@route('/dashboard')
+def dashboard(request):
+    """Show implementation status, certified-control coverage and stale narratives across all projects."""
+
+    # Rollups are summed from cached per-component statistics. See portfolio.py.
+    from .portfolio import build_dashboard
+    dashboard = build_dashboard(load_projects())
+
+    # Prepare modify page message
+    modify_msg = "Displayed totals taken from loaded projects. To modify listed projects, change hyperGRC launch params or edit file: `{}`".format(os.path.join(os.getcwd(), "repos.conf"))
+
+    return render_template(request, 'dashboard.html',
+        dashboard=dashboard,
+        implementation_status_css_classes=implementation_status_css_classes,
+        modify_msg=modify_msg
+    )
+
+@route('/dashboard.json')
+def dashboard_json(request):
+    """Return the portfolio dashboard's rollups as JSON."""
+    from .portfolio import build_dashboard
+    return send_json_response(request, build_dashboard(load_projects()))
+
+@route('/gaps')
+def gap_matrix(request):
+    """Show the certified controls that are not implemented, and the implemented controls that are not certified, across all projects."""
+
+    # Baselines are compared with implemented controls as bitsets. See baselines.py.
+    projects = sorted(load_projects(), key = lambda project : (project["organization"]["name"], project["title"]))
+    matrix = baselines.build_gap_matrix(projects)
+
+    # Prepare modify page message
+    modify_msg = "Certified controls are taken from each project's certifications. To modify them, edit the files in each project's certifications directory."
+
+    return render_template(request, 'gap_matrix.html',
+        matrix=matrix,
+        modify_msg=modify_msg
+    )
+
 # Project general routes
 
 @route('/organizations/<organization>/projects/<project>')
@@ -179,46 +300,51 @@ def documents(request, organization, project):
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
     # Prepare modify page message
-    # Use our assumed hardcoded 'outputs' directory as repo's top level document directory
-    edit_dir = os.path.join(project["path"], "outputs")
+    edit_dir = documents_index.get_document_directory(project)
     modify_msg = "To modify listed documents, change files in document directories of `{}`".format(edit_dir)
 
-    # Create variables for documents and message
-    docs = []
-    message = ""
+    # Read the sort order, filters and page from the query string.
+    query = get_query_parameters(request)
+    sort = query.get("sort", "path")
+    if sort not in documents_index.SORT_KEYS:
+      sort = "path"
+    descending = query.get("order") == "desc"
+    search = query.get("q", "").strip()
+    doc_type = query.get("type") or None
+    if doc_type == ".":
+      doc_type = "" # documents without an extension
+    try:
+      page = max(1, int(query.get("page", 1)))
+    except ValueError:
+      page = 1
 
-    # We want to be able to store documents in our repo.
-    # If document directories exists, read all the documents and append
-    # information on each document to the list of doc objects to pass to
-    # the page to be rendered.
-    document_dirs = get_document_directories(project)
-    for doc_dir_path in document_dirs:
-      # Skip anything that is not really a directory
-      if not os.path.isdir(doc_dir_path):
-        continue
-      else:
-        # Get the files from within the directory
-        docs_glob = doc_dir_path.rstrip('/') + "/*"
-        for doc in glob.glob(docs_glob):
-          # Skip any commonly found files that are MS Word document temp files 
-          if "~$" in os.path.basename(doc):
-            continue
-          if os.path.isfile(doc):
-            # Append found document file paths to our list of documents
-            docs.append({'name': os.path.basename(doc),
-                         'file_path': doc,
-                         'rel_file_path': doc.replace(os.path.join(project["path"], "outputs/"), "")
-                        })
+    # The documents are indexed once and re-indexed only when files are
+    # added to, removed from or renamed in the document directories. See
+    # documents.py.
+    result = documents_index.query_documents(project, sort=sort, descending=descending,
+      search=search, doc_type=doc_type, page=page, per_page=DOCUMENTS_PER_PAGE)
 
     # What? No documents found? Generate a message to display.
-    if len(docs) == 0:
+    message = ""
+    if result["total"] == 0:
       message += "No documents are listed in your repository."
+    elif result["count"] == 0:
+      message += "No documents match."
 
     return render_template(request, 'documents.html',
                             project=project,
                             organization=organization,
                             message=message,
-                            documents=docs,
+                            documents=result["documents"],
+                            document_count=result["count"],
+                            document_total=result["total"],
+                            document_types=result["types"],
+                            sort=sort,
+                            descending=descending,
+                            search=search,
+                            doc_type=doc_type,
+                            page=page,
+                            page_count=(result["count"] + DOCUMENTS_PER_PAGE - 1) // DOCUMENTS_PER_PAGE,
                             modify_msg=modify_msg
                           )
 
@@ -239,6 +365,7 @@ def document(request, organization, project, doc_file_path):
 
     # TODO: Make sure this file exists and has no relative paths or goes to system directory
     # We aren't too worried about security when user is running on their own workstation.
+    record_dependency(doc)
     if os.path.isfile(doc):
       fn, fe = os.path.splitext(doc)
       if fe.lower() not in [".txt", ".conf", ".csv", ".md",
@@ -262,10 +389,14 @@ def team(request, organization, project):
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
     teams = {}
-    # Read the team file
+    # Read the team file. The page depends on it (see publish.py).
+    record_dependency(os.path.join(project["path"], "team", "team.yaml"))
     try:
       with open(os.path.join(project["path"], "team", "team.yaml"), encoding="utf8") as f:
-        team_data = rtyaml.load(f)
+        with metrics.yaml_parse_duration.time(file_type="team"):
+          team_data = rtyaml.load(f)
+        metrics.yaml_parses.inc(file_type="team")
+        metrics.yaml_parse_bytes.inc(os.fstat(f.fileno()).st_size, file_type="team")
         # Follow the code pattern from opencontrol.transform list
         # to parse a team file that references other team file
         # so we can refactor and combine in the future
@@ -403,8 +534,12 @@ def component(request, organization, project, component_name):
       return "Component `{}` in URL not found in project.".format(component_name)
 
     # Each control's metadata, such as control names and control family names,
-    # is loaded from standards. Load the standards first.
-    standards = opencontrol.load_project_standards(project)
+    # is loaded from standards. Load the standards first. Note which files they
+    # came from so that the cached HTML of each control (see fragments.py) is
+    # rendered again if they change.
+    with recording_dependencies() as dependencies:
+      standards = opencontrol.load_project_standards(project)
+    fragment_version = fragments.data_version(dependencies)
 
     # Load the component's controls.
     controlimpls = list(opencontrol.load_project_component_controls(component, standards))
@@ -474,11 +609,12 @@ def component(request, organization, project, component_name):
                             control_catalog=control_catalog, # used for creating a new control in the component
                             source_files=source_files, # used for creating a new control in the component
                             implementation_status_css_classes=implementation_status_css_classes,
-                            stats=compute_control_implementation_statistics(controlimpls),
+                            fragment_version=fragment_version,
+                            stats=statistics.summarize_statistics(statistics.load_component_statistics(component, standards, dependencies)),
                           )
 
 @route('/organizations/<organization>/projects/<project>/components/<component_name>/statistics.json')
-def component(request, organization, project, component_name):
+def component_statistics(request, organization, project, component_name):
     """Return a JSON object holding statistics about the control implementations for a component."""
 
     # Load the project.
@@ -486,62 +622,85 @@ def component(request, organization, project, component_name):
       project = load_project(organization, project)
       component = opencontrol.load_project_component(project, component_name)
     except ValueError:
-      return "Organization `{}`, project `{}`, or component `{}` in URL not found.".format(organization, project, component)
+      return "Organization `{}`, project `{}`, or component `{}` in URL not found.".format(organization, project, component_name)
 
-    # Each control's metadata, such as control names and control family names,
-    # is loaded from standards. Load the standards first.
-    standards = opencontrol.load_project_standards(project)
-
-    # Load the component's controls.
-    controlimpls = list(opencontrol.load_project_component_controls(component, standards))
-
-    return send_json_response(request, compute_control_implementation_statistics(controlimpls))
-
-def compute_control_implementation_statistics(controlimpls):
-    # Compute some statistics about how many words are in the controls,
-    # and totals on control implementation status
+    # Statistics are computed once per component and kept up to date as
+    # narratives are edited. See statistics.py.
+    return send_json_response(request, statistics.summarize_statistics(statistics.load_component_statistics(component)))
 
-    import re
+@route('/organizations/<organization>/projects/<project>/statistics.json')
+def project_statistics(request, organization, project):
+    """Return a JSON object holding statistics for a project and each of its components."""
 
-    # Get total count of controls and control parts.
-    control_count = len({
-        ( controlimpl["standard"]["name"], controlimpl["control"]["number"] )
-        for controlimpl in controlimpls
-        })
-    control_part_counts = len(controlimpls)
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
-    # Get total count of control families.
-    control_families_count = len(set(controlimpl["family"]["id"] for controlimpl in controlimpls))
+    # Get the statistics of each component and sum them for the project.
+    component_stats = statistics.load_project_statistics(project)
+    return send_json_response(request, {
+      "project": statistics.summarize_statistics(statistics.merge_statistics(component_stats.values())),
+      "components": {
+        component_id: statistics.summarize_statistics(stats)
+        for component_id, stats in component_stats.items()
+      },
+    })
 
-    ctl_i7r = {} # Counts by status.
-    words = [] # word counts for each control
-    for controlimpl in controlimpls:
-        # Count up words.
-        wds = len(re.split(r"\W+", controlimpl["narrative"]))
-        words.append(wds)
+@route('/statistics.json')
+def portfolio_statistics(request):
+    """Return a JSON object holding statistics across all projects and for each project."""
 
-        # Count implementation status
-        if controlimpl["implementation_status"] in ctl_i7r.keys():
-          ctl_i7r[controlimpl["implementation_status"]] += 1
-        else:
-          ctl_i7r[controlimpl["implementation_status"]] = 1
-    
-    total_words = sum(words)
-    average_words_per_controlpart = total_words / (len(controlimpls) if len(controlimpls) > 0 else 1) # don't err if no controlimpls
-    
-    # Re-label status an empty implementation status key as "Not specified"
-    if "" in ctl_i7r.keys():
-       ctl_i7r["Not specified"] = ctl_i7r[""]
-       del ctl_i7r[""]
-
-    return {
-      "control_count": control_count,
-      "control_part_count": control_part_counts,
-      "control_families_count": control_families_count,
-      "total_words": total_words,
-      "average_words_per_controlpart": average_words_per_controlpart,
-      "implementation_status_counts": ctl_i7r,
-    }
+    # Sum the statistics of each project's components, and then of all projects.
+    projects = []
+    project_stats = []
+    for project in load_projects():
+      stats = statistics.merge_statistics(statistics.load_project_statistics(project).values())
+      project_stats.append(stats)
+      projects.append({
+        "id": project["id"],
+        "organization": project["organization"]["id"],
+        "title": project["title"],
+        "url": project["url"],
+        "statistics": statistics.summarize_statistics(stats),
+      })
+
+    return send_json_response(request, {
+      "portfolio": statistics.summarize_statistics(statistics.merge_statistics(project_stats)),
+      "projects": projects,
+    })
+
+@route('/component-statistics.json', methods=['POST'])
+def bulk_component_statistics(request):
+    """Return a JSON object holding statistics for many components, given by their URLs."""
+
+    # The form holds the URLs of the components, as on /component-comparison.
+    component_urls = request.form.get("component", [])
+    if isinstance(component_urls, str):
+      component_urls = [component_urls]
+
+    # Load each project only once and get the statistics of all of its
+    # components at once.
+    from urllib.parse import unquote_plus
+    projects = { }
+    results = { }
+    for component_url in component_urls:
+      try:
+        empty, org_l, organization, project_l, project_id, components_l, component_name = component_url.split("/")
+      except ValueError:
+        return "`{}` is not a component URL.".format(component_url)
+      key = (unquote_plus(organization), unquote_plus(project_id))
+      if key not in projects:
+        try:
+          projects[key] = statistics.load_project_statistics(load_project(*key))
+        except ValueError:
+          return "Organization `{}` project `{}` in URL not found.".format(*key)
+      if unquote_plus(component_name) not in projects[key]:
+        return "Component `{}` in URL not found in project.".format(unquote_plus(component_name))
+      results[component_url] = statistics.summarize_statistics(projects[key][unquote_plus(component_name)])
+
+    return send_json_response(request, results)
 
 @route('/organizations/<organization>/projects/<project>/components/<component_name>/guide')
 def component_guide(request, organization, project, component_name):
@@ -585,7 +744,10 @@ def controls(request, organization, project):
     # controls that might be found.
 
     all_standards = opencontrol.load_project_standards(project)
-    certified_controls = opencontrol.load_project_certified_controls(project)
+
+    # The controls selected by the project's certifications, by standard.
+    # See baselines.py.
+    baseline = baselines.load_project_baseline(project)
 
     # Add in controls defined by the components and group them by standard.
     # Iterate through all components in the project...
@@ -606,10 +768,12 @@ def controls(request, organization, project):
                           else controlimpl["standard"]["name"],
               })
 
-            # Make a "controls" dict to hold control implementations.
+            # Make a "controls" dict to hold control implementations. The
+            # controls are annotated below, so copy them: the loaded data
+            # may be shared with other requests (see load_project_standards).
             control_key = controlimpl["control"]["id"]
             standards[standard_key].setdefault("controls", {})
-            standards[standard_key]["controls"].setdefault(control_key, controlimpl["control"])
+            standards[standard_key]["controls"].setdefault(control_key, dict(controlimpl["control"]))
 
             # Count up the number of components that have an implementation for the control.
             # Note that we may come here more than once for a component because a component
@@ -625,20 +789,20 @@ def controls(request, organization, project):
     # controls don't know what project we're doing right now and so could not pre-generate a URL.
     # Add a URL field now so that the template can generate links.
     from urllib.parse import quote_plus
-    certified_standards = { standard_key for (standard_key, control_id) in certified_controls }
     for standard_key, standard in all_standards.items():
       for control in standard["controls"].values():
         # Include this control in the table if the standard does not have a certification
         # or if the control is in the certification.
-        if standard_key not in certified_standards or (standard_key, control["id"]) in certified_controls:
+        if standard_key not in baseline["controls"] or baselines.is_set(baseline["registry"], standard_key, baseline["controls"][standard_key], control["id"]):
           # Make a standard if we haven't seen it yet.
           standards.setdefault(standard_key, {
               "name": standard["name"],
               "controls": {},
           })
 
-          # Add this control.
-          standards[standard_key]["controls"].setdefault(control["id"], control)
+          # Add a copy of this control, since the standards may be shared
+          # with other requests.
+          control = standards[standard_key]["controls"].setdefault(control["id"], dict(control))
 
           # Set its URL.
           control["url"] = "{}/controls/{}/{}".format(
@@ -669,6 +833,28 @@ def controls(request, organization, project):
                             modify_msg=modify_msg
                           )
 
+@route('/organizations/<organization>/projects/<project>/gaps')
+def project_gaps(request, organization, project):
+    """Show the project's certified controls that are not implemented and implemented controls that are not certified."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    gaps = baselines.build_project_gaps(project)
+
+    # Prepare modify page message
+    edit_dir = os.path.join(project["path"])
+    modify_msg = "To modify certified controls, edit content in the certifications directory of project path: `{}`".format(edit_dir)
+
+    return render_template(request, 'gaps.html',
+                            project=project,
+                            gaps=gaps,
+                            modify_msg=modify_msg
+                          )
+
 @route('/organizations/<organization>/projects/<project>/controls/<standard_key>/<control_key>/<format>')
 def project_control_grid(request, organization, project, standard_key, control_key, format):
     """Show all of the components that contribute to this control."""
@@ -685,8 +871,11 @@ def project_control_grid(request, organization, project, standard_key, control_k
     except ValueError:
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
-    # Load the standards in use by this project.
-    standards = opencontrol.load_project_standards(project)
+    # Load the standards in use by this project. Note which files they came
+    # from for the cached HTML of each control (see fragments.py).
+    with recording_dependencies() as dependencies:
+      standards = opencontrol.load_project_standards(project)
+    fragment_version = fragments.data_version(dependencies)
 
     # Get the control metadata from the standard. Sometimes we're loading
     # a page for a control not mentioned in the standard but mentioned in
@@ -749,8 +938,10 @@ def project_control_grid(request, organization, project, standard_key, control_k
     narratives.sort(key = lambda narrative : ( narrative["part"] is None, narrative["part"], narrative["component"]["name"] ))
 
     # Add URL info to the control --- it might be missing if the metadata
-    # came from the standard.
+    # came from the standard. Copy the control first: the loaded data may
+    # be shared with other requests (see load_project_standards).
     from urllib.parse import quote_plus
+    control = dict(control)
     control["url"] = "{}/controls/{}/{}".format(
         project["url"],
         quote_plus(standard_key),
@@ -765,6 +956,7 @@ def project_control_grid(request, organization, project, standard_key, control_k
                             components=components,
                             narratives=narratives,
                             implementation_status_css_classes=implementation_status_css_classes,
+                            fragment_version=fragment_version,
                           )
 
 @route('/organizations/<organization>/projects/<project>/evidence')
@@ -806,10 +998,10 @@ def ssp(request, organization, project, format):
     except ValueError:
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
-    # Construct the SSP.
+    # Construct the SSP, or get it from the cache. See ssp.load_export.
+    from .ssp import load_export
     if format == "md":
-        from .ssp import build_ssp
-        return build_ssp(project, {})
+        return load_export(project, format)
     elif format == "csv":
         from datetime import datetime
         file_path = "exported-controls-{}Z.csv".format(
@@ -817,8 +1009,7 @@ def ssp(request, organization, project, format):
           .isoformat(timespec="seconds")
           .replace(':', '')
           )
-        from .csv import build_csv
-        send_file_response(request, file_path, build_csv(project, {}).encode('utf-8'), "text/csv")
+        send_file_response(request, file_path, load_export(project, format).encode('utf-8'), "text/csv")
 
 @route('/organizations/<organization>/projects/<project>/components/<component_name>/app.yaml')
 def component_app_export(request, organization, project, component_name):
@@ -893,6 +1084,11 @@ def create_system(request):
             # Validation OK. Create the system.
             created_repo_path = opencontrol.create_system(organization_name, system_name, description, repo_path)
             print(created_repo_path)
+
+            # Serve the new system now, if repos.conf is being served.
+            from . import repos
+            repos.reload()
+
             return render_template(request, 'system_new.html',
                   system_name=system_name,
                   repo_path=created_repo_path,
@@ -935,6 +1131,9 @@ def add_component(request, organization, project):
             # Validation OK. Create the component.
             component = opencontrol.create_component(project, component_path, component_name)
             print(component)
+            events.publish(project, "component_created", {
+              "component": { "id": component["id"], "name": component["name"], "url": component["url"] },
+            }, changed_files=[os.path.join(project["path"], "opencontrol.yaml")])
             return redirect(request, component["url"])
 
     # Show the form.
@@ -975,9 +1174,18 @@ def update_control(request):
 
        # Update the control's metadata.
        #controlimpl["summary"] = request.form.get("summary", "")
+       old_controlimpl = dict(controlimpl)
        controlimpl["narrative"] = request.form.get("narrative", "")
        controlimpl["implementation_status"] = request.form.get("implementation_status", "")
        if opencontrol.update_component_control(controlimpl):
+         # Apply the edit to the component's statistics so they don't have
+         # to be recomputed.
+         statistics.update_narrative_statistics(component, old_controlimpl, controlimpl)
+
+         # Tell pages showing the project about the change.
+         events.publish(project, "controlimpl_updated", make_controlimpl_event(component, controlimpl),
+                        changed_files=[controlimpl["source_file"]])
+
          # If the control was updated, return it back to the user
          # as JSON.
          return send_json_response(request, controlimpl)
@@ -1000,12 +1208,69 @@ def update_control(request):
       "source_file": request.form.get("source_file", ""),
     }
 
-    # Save it.
-    opencontrol.add_component_control(component, controlimpl)
+    # Save it, and tell pages showing the project about it.
+    if opencontrol.add_component_control(component, controlimpl) is None:
+      events.publish(project, "controlimpl_added", make_controlimpl_event(component, controlimpl),
+                     changed_files=[controlimpl["source_file"]])
 
     # Return it back to the client.
     return send_json_response(request, controlimpl)
 
+def make_controlimpl_event(component, controlimpl):
+    # The data of a controlimpl_updated or controlimpl_added event: which
+    # control implementation changed, its new values, and the component's
+    # statistics after the change.
+    return {
+      "component": { "id": component["id"] },
+      "standard": { "id": controlimpl["standard"]["id"] },
+      "control": { "id": controlimpl["control"]["id"] },
+      "control_part": controlimpl.get("control_part") or None,
+      "narrative": controlimpl["narrative"],
+      "implementation_status": controlimpl["implementation_status"],
+      "statistics": statistics.summarize_statistics(statistics.load_component_statistics(component)),
+    }
+
+@route('/organizations/<organization>/projects/<project>/events')
+def project_events(request, organization, project):
+    """Stream changes to a project as server-sent events."""
+
+    # Load the project.
+    try:
+      project = load_project(organization, project)
+    except ValueError:
+      return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+
+    # A reconnecting client says which event it saw last.
+    try:
+      last_event_id = int(request.headers.get("Last-Event-ID"))
+    except (TypeError, ValueError):
+      last_event_id = None
+
+    request.send_response(200)
+    request.send_header("Content-Type", "text/event-stream; charset=utf-8")
+    request.send_header("Cache-Control", "no-cache")
+    request.end_headers()
+    request.close_connection = True
+
+    # A HEAD request gets only the headers. Its body is discarded, so the
+    # stream would never notice the client going away.
+    if getattr(request, "command", None) == "HEAD":
+      return
+
+    # Send events until the client goes away, which we notice when a write
+    # fails. Keep-alive comments are sent when there's nothing else to send.
+    stream = events.subscribe(project, last_event_id)
+    try:
+      request.wfile.write(b"retry: 5000\n\n")
+      request.wfile.flush()
+      for event in stream:
+        request.wfile.write(events.format_event(event) if event else b": keep-alive\n\n")
+        request.wfile.flush()
+    except OSError:
+      pass
+    finally:
+      stream.close()
+
 #####################################################
 # Routes for Component Analysis Across Projects
 #####################################################
@@ -1035,66 +1300,242 @@ def all_components(request):
 def component_comparison(request):
   """Compare the respective controls of components"""
 
-  # Super set of controls
-  super_control_list = set()
-  components = [ ]
-  if "component_selected" in request.form:
-    component_urls = request.form["component_selected"]
-    for component_url in component_urls:
+  # The form holds the URLs of the selected components. A single selected
+  # checkbox comes through as a string rather than a list.
+  component_urls = request.form.get("component_selected", [])
+  if isinstance(component_urls, str):
+    component_urls = [component_urls]
+
+  # Look up the coverage record of each selected component. Coverage is
+  # computed once per project and cached (see coverage.py), so load each
+  # project only once no matter how many of its components are selected.
+  from . import coverage
+  from urllib.parse import unquote_plus
+  projects = { }
+  entries = [ ]
+  for component_url in component_urls:
+    empty, org_l, organization, project_l, project, components_l, component_name = component_url.split("/")
+    organization = unquote_plus(organization)
+    project = unquote_plus(project)
+    component_name = unquote_plus(component_name)
 
-      from urllib.parse import unquote_plus
-      empty, org_l, organization, project_l, project, components_l, component_name = component_url.split("/")
-      organization = unquote_plus(organization)
-      project = unquote_plus(project)
-      component_name = unquote_plus(component_name)
-
-      # Load the project.
+    # Load the project.
+    if (organization, project) not in projects:
       try:
-        project = load_project(organization, project)
+        projects[(organization, project)] = load_project(organization, project)
       except ValueError:
         return "Organization `{}` project `{}` in URL not found.".format(organization, project)
+    project = projects[(organization, project)]
 
-      # Load the component.
-      try:
-        component = opencontrol.load_project_component(project, component_name)
-      except ValueError:
-        return "Component `{}` in URL not found in project.".format(component_name)
+    # Get the component's coverage.
+    project_coverage = coverage.load_project_coverage(project)
+    if component_name not in project_coverage:
+      return "Component `{}` in URL not found in project.".format(component_name)
+    entries.append(project_coverage[component_name])
 
-      # Each control's metadata, such as control names and control family names,
-      # is loaded from standards. Load the standards first.
-      standards = opencontrol.load_project_standards(project)
+  # Build the comparison matrix. With no components selected, the page
+  # reminds people to select some.
+  comparison = coverage.compare_components(entries)
 
-      # Load the component's controls.
-      controlimpls = list(opencontrol.load_project_component_controls(component, standards))
+  return render_template(request, 'component_comparison.html',
+                         comparison=comparison
+                        )
 
-      # extract control ids
-      component_control_ids = ["{}{}".format(c["control"]["id"], "" if c["control_part"] == None else " part "+c["control_part"]) for c in controlimpls]
-      super_control_list = super_control_list.union(set(component_control_ids))
+@route('/narrative-duplicates')
+def narrative_duplicates(request):
+  """Show clusters of near-duplicate control narratives across all projects"""
 
-      # Add key to each control
-      controlimpls_new = {}
-      for c in controlimpls:
-        if c["control_part"] == None:
-          new_id = c["control"]["id"]
-        else:
-          new_id = c["control"]["id"] + " part " + c["control_part"]
-        controlimpls_new[new_id] = c
+  # Collect the narratives of every component in every project and
+  # cluster the ones that are near-duplicates of each other. The clusters
+  # are cached until any of the projects' files change (see similarity.py).
+  from .similarity import load_near_duplicate_narratives, DEFAULT_THRESHOLD
+  clusters = load_near_duplicate_narratives(load_projects())
+
+  # Prepare modify page message
+  modify_msg = "Displayed narratives taken from loaded projects. To consolidate near-duplicate narratives, edit the component files listed for each control."
+
+  return render_template(request, 'narrative_duplicates.html',
+                         clusters=clusters,
+                         threshold=DEFAULT_THRESHOLD,
+                         modify_msg=modify_msg
+                        )
 
-      # Update components
-      components.append({ "organization": organization, "project": project, "name": component_name, "controls": controlimpls_new })
+#####################################################
+# Routes for the JSON API
+#####################################################
 
+# The API routes return paginated, filterable lists. See api.py.
+
+def send_api_response(request, build):
+  # Call build(query) with the request's query string parameters and send
+  # what it returns as JSON, or send a 400 or 404 JSON error.
+  from . import api
+  try:
+    data = build(get_query_parameters(request))
+  except api.ApiError as e:
+    status, data = e.status, { "error": str(e) }
+  except ValueError as e: # from load_project
+    status, data = 404, { "error": str(e) }
   else:
-    components = []
-    # Remind people to select components if no components selected.
+    return send_json_response(request, data)
+  send_body(request, status, "application/json", json.dumps(data).encode("utf8"))
+
+@route('/api/projects')
+def api_projects(request):
+  """List projects as JSON"""
+  from . import api
+  return send_api_response(request, lambda query : api.list_projects(load_projects(), query))
+
+@route('/api/organizations/<organization>/projects/<project>/components')
+def api_components(request, organization, project):
+  """List a project's components as JSON"""
+  from . import api
+  return send_api_response(request, lambda query : api.list_components(load_project(organization, project), query))
+
+@route('/api/organizations/<organization>/projects/<project>/controls')
+def api_controls(request, organization, project):
+  """List a project's control implementations as JSON"""
+  from . import api
+  return send_api_response(request, lambda query : api.list_controls(load_project(organization, project), query))
+
+@route('/api/organizations/<organization>/projects/<project>/components/<component_name>/controls')
+def api_component_controls(request, organization, project, component_name):
+  """List a component's control implementations as JSON"""
+  from . import api
+  return send_api_response(request, lambda query : api.list_controls(load_project(organization, project), query, component_id=component_name))
+
+@route('/api/gaps')
+def api_gap_matrix(request):
+  """Return the portfolio gap matrix of certified and implemented controls as JSON"""
+  projects = sorted(load_projects(), key = lambda project : (project["organization"]["name"], project["title"]))
+  return send_api_response(request, lambda query : baselines.build_gap_matrix(projects))
+
+@route('/api/organizations/<organization>/projects/<project>/gaps')
+def api_project_gaps(request, organization, project):
+  """Return a project's certified-but-unimplemented and implemented-but-uncertified controls as JSON"""
+  return send_api_response(request, lambda query : baselines.build_project_gaps(load_project(organization, project)))
 
-  controls = list(super_control_list)
-  controls.sort()
+#####################################################
+# Routes for Operations
+#####################################################
 
-  return render_template(request, 'component_comparison.html',
-                         components=components,
-                         controls=controls
+@route('/metrics')
+def prometheus_metrics(request):
+  """Return request timing, YAML parsing, rendering and cache metrics in the Prometheus text format"""
+  return metrics.render_prometheus()
+
+@route('/admin/profiles', methods=["GET", "POST"])
+def admin_profiles(request):
+  """List the slowest profiled requests and turn profiling of every request on or off"""
+  if not require_admin(request): return
+  if not require_admin_post(request): return
+  from . import profiling
+
+  if request.method == "POST":
+    profiling.SETTINGS["profile_all"] = request.form.get("profile_all") == "on"
+
+  return render_template(request, 'admin_profiles.html',
+                         profiles=list(profiling.PROFILES),
+                         profile_all=profiling.SETTINGS["profile_all"],
+                         max_profiles=profiling.MAX_PROFILES,
+                         admin_form_token=ADMIN_FORM_TOKEN,
                         )
 
+@route('/admin/warmer')
+def admin_warmer(request):
+  """Show which projects' cached data is warm and which is cold, and when the cache warmer last rebuilt it"""
+  if not require_admin(request): return
+  from . import warmer
+
+  projects = []
+  for project in load_projects():
+    state = dict(warmer.get_project_state(project["path"]))
+    state.update({
+      "project": project,
+      "parts": warmer.get_warm_state(project),
+    })
+    projects.append(state)
+  projects.sort(key = lambda state : (-state["accesses"], state["project"]["title"]))
+
+  return render_template(request, 'admin_warmer.html',
+                         projects=projects,
+                         settings=warmer.SETTINGS,
+                        )
+
+def do_cache_admin_action(request):
+  # Carry out an action POSTed to /admin/caches. Returns a message saying
+  # what was done and, if a tracemalloc snapshot was asked for, its top
+  # allocations.
+  from . import memory
+  action = request.form.get("action")
+  if action == "flush":
+    dropped = memory.flush(
+      cache_name=request.form.get("cache") or None,
+      project_dir=request.form.get("project") or None,
+      file_name=request.form.get("file") or None)
+    return "Flushed {} cache entr{}.".format(dropped, "y" if dropped == 1 else "ies"), None
+  if action == "start_tracing":
+    memory.start_tracing()
+    return "Started tracing memory allocations. This slows hyperGRC down until tracing is stopped.", None
+  if action == "stop_tracing":
+    memory.stop_tracing()
+    return "Stopped tracing memory allocations.", None
+  if action == "snapshot":
+    allocations = memory.top_allocations()
+    if allocations is None:
+      return "Start tracing memory allocations first.", None
+    return "Took a snapshot of the memory allocated since tracing started.", allocations
+  return "Unknown action.", None
+
+@route('/admin/caches', methods=["GET", "POST"])
+def admin_caches(request):
+  """List the caches with their sizes and hit rates, flush them, and take memory allocation snapshots"""
+  if not require_admin(request): return
+  if not require_admin_post(request): return
+  from . import memory
+
+  message, allocations = None, None
+  if request.method == "POST":
+    message, allocations = do_cache_admin_action(request)
+
+  return render_template(request, 'admin_caches.html',
+                         caches=memory.describe_caches(),
+                         projects=sorted(set(PROJECT_LIST)),
+                         message=message,
+                         allocations=allocations,
+                         admin_form_token=ADMIN_FORM_TOKEN,
+                        )
+
+@route('/admin/caches.json', methods=["GET", "POST"])
+def admin_caches_json(request):
+  """Return the caches with their sizes and hit rates as JSON, or flush them or take a memory allocation snapshot"""
+  if not require_admin(request): return
+  if not require_admin_post(request): return
+  from . import memory
+
+  message, allocations = None, None
+  if request.method == "POST":
+    message, allocations = do_cache_admin_action(request)
+
+  result = memory.describe_caches()
+  if request.method == "POST":
+    result["message"] = message
+    result["allocations"] = allocations
+  # Scripts without the admin token POST this back. Other web sites can't
+  # read the response to learn it.
+  result["admin_form_token"] = ADMIN_FORM_TOKEN
+  return send_json_response(request, result)
+
+@route('/admin/profiles/<profile_id>')
+def admin_profile(request, profile_id):
+  """Show the report of a profiled request"""
+  if not require_admin(request): return
+  from . import profiling
+  record = profiling.get_profile(int(profile_id)) if profile_id.isdigit() else None
+  if record is None:
+    return "Profile `{}` not found. Only the {} slowest profiles are kept.".format(profile_id, profiling.MAX_PROFILES)
+  return record["report"]
+
 #####################################################
 # Routes for Customization
 #####################################################
@@ -1110,6 +1551,7 @@ def custom_css(request, organization, project):
       return "Organization `{}` project `{}` in URL not found.".format(organization, project)
 
     doc = os.path.join(project["path"], "_extensions", "hypergrc","static", "css", "repo.css")
+    record_dependency(doc)
 
     # Make sure this file exists and TODO: has no relative paths or goes to system directory
     # We aren't too worried about security when user is running on their own workstation.
@@ -1121,15 +1563,9 @@ def custom_css(request, organization, project):
       except Exception as e:
         import traceback
         traceback.print_exc()
-        request.send_response(500)
-        request.send_header("Content-Type", "text/plain; charset=UTF-8")
-        request.end_headers()
-        request.wfile.write(b"Ooops! Something went wrong.")
+        send_body(request, 500, "text/plain; charset=UTF-8", b"Ooops! Something went wrong.")
         return
     else:
       print("file not found {}".format(doc))
-      request.send_response(404)
-      request.send_header("Content-Type", "text/plain; charset=UTF-8")
-      request.end_headers()
-      request.wfile.write(b"file not found")
+      send_body(request, 404, "text/plain; charset=UTF-8", b"file not found")
       return
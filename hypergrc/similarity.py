@@ -0,0 +1,243 @@
+# Find near-duplicate control narratives across components and projects.
+#
+# Narrative text is often copy-pasted between components and then drifts
+# over time. Comparing every narrative against every other narrative is
+# quadratic, so instead we use MinHash signatures and locality-sensitive
+# hashing (LSH): each narrative is broken into overlapping word "shingles,"
+# summarized by a short signature whose agreement with another signature
+# estimates the Jaccard similarity of their shingle sets, and then the
+# signatures are split into bands that are hashed into buckets. Only
+# narratives that share a bucket are ever compared.
+#
+# Each project's signatures, and the clusters found across the projects,
+# are cached until any of the files they were built from change (see
+# cache.py).
+
+import random
+import re
+import zlib
+
+from . import opencontrol
+from .cache import Cache
+
+_project_signatures_cache = Cache("narrative-signatures")
+_clusters_cache = Cache("narrative-duplicates")
+
+# MinHash parameters. The signature length is NUM_BANDS * ROWS_PER_BAND.
+# With 16 bands of 4 rows, two narratives with Jaccard similarity s
+# become candidates with probability 1 - (1 - s^4)^16, which is about
+# 0.5 at s=0.5 and better than 0.99 at s=0.8.
+SHINGLE_SIZE = 5
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+NUM_PERMUTATIONS = NUM_BANDS * ROWS_PER_BAND
+DEFAULT_THRESHOLD = 0.8
+
+# The MinHash permutations are universal hash functions of the form
+# (a*x + b) mod p. The coefficients are drawn from a fixed seed so that
+# signatures are stable across runs and processes.
+_MERSENNE_PRIME = (1 << 61) - 1
+_rng = random.Random(1)
+_PERMUTATIONS = [
+    (_rng.randrange(1, _MERSENNE_PRIME), _rng.randrange(0, _MERSENNE_PRIME))
+    for i in range(NUM_PERMUTATIONS)
+]
+
+def shingle(text, size=SHINGLE_SIZE):
+    # Return the set of hashed word shingles in text. Case, punctuation
+    # and whitespace are ignored so that reformatting a narrative doesn't
+    # change its shingles. Short narratives with fewer words than the
+    # shingle size are represented by a single shingle of all their words.
+    # We use crc32 rather than hash() because hash() is salted per-process.
+    words = re.findall(r"\w+", (text or "").lower())
+    if not words:
+        return set()
+    if len(words) < size:
+        return { zlib.crc32(" ".join(words).encode("utf8")) }
+    return {
+        zlib.crc32(" ".join(words[i:i+size]).encode("utf8"))
+        for i in range(len(words) - size + 1)
+    }
+
+def compute_minhash_signatures(shingle_sets):
+    # Compute MinHash signatures for a batch of shingle sets. The work is
+    # arranged permutation-major: each permutation is applied to every set
+    # in the batch before moving on to the next one, which keeps the inner
+    # loop a tight comprehension over one pair of coefficients. Returns a
+    # list of signatures (tuples), one per input set, or None for empty sets.
+    signatures = [[] if shingles else None for shingles in shingle_sets]
+    batch = [(signature, list(shingles)) for signature, shingles in zip(signatures, shingle_sets) if shingles]
+    p = _MERSENNE_PRIME
+    for a, b in _PERMUTATIONS:
+        for signature, shingles in batch:
+            signature.append(min([(a * x + b) % p for x in shingles]))
+    return [tuple(signature) if signature is not None else None for signature in signatures]
+
+def estimate_similarity(signature1, signature2):
+    # The fraction of agreeing MinHash values estimates the Jaccard similarity.
+    return sum(1 for x, y in zip(signature1, signature2) if x == y) / len(signature1)
+
+def jaccard_similarity(shingles1, shingles2):
+    if not shingles1 and not shingles2:
+        return 1.0
+    return len(shingles1 & shingles2) / len(shingles1 | shingles2)
+
+def load_narratives(projects):
+    # Collect the control narratives of every component in every project,
+    # from the projects' cached coverage records (see coverage.py). Returns
+    # a list of controlimpls (see opencontrol.load_project_component_controls).
+    from . import coverage
+    narratives = []
+    for project in projects:
+        for entry in coverage.load_project_coverage(project).values():
+            for controlimpls in entry["narratives"].values():
+                narratives.extend(controlimpls)
+    return narratives
+
+def sign_narratives(controlimpls, previous=()):
+    # Shingle each narrative and compute signatures in one batch. Returns a
+    # list of (controlimpl, shingle set, signature) tuples. The shingles and
+    # signatures of narratives whose text is the same as in previous, an
+    # earlier result, are reused.
+    known = { controlimpl["narrative"]: (shingles, signature) for controlimpl, shingles, signature in previous }
+    controlimpls = list(controlimpls)
+    new_texts = list(dict.fromkeys(controlimpl["narrative"] for controlimpl in controlimpls if controlimpl["narrative"] not in known))
+    new_shingle_sets = [shingle(text) for text in new_texts]
+    known.update(zip(new_texts, zip(new_shingle_sets, compute_minhash_signatures(new_shingle_sets))))
+    return [(controlimpl,) + known[controlimpl["narrative"]] for controlimpl in controlimpls]
+
+def load_project_signatures(project):
+    # Return the signed narratives of a project (see sign_narratives). When
+    # a file changes, usually only a few narratives have changed, so the
+    # signatures of the previous version are reused for the rest.
+    key = project["path"]
+    return _project_signatures_cache.get(key, lambda : sign_narratives(
+        load_narratives([project]), _project_signatures_cache.peek(key) or ()))
+
+def load_near_duplicate_narratives(projects, threshold=DEFAULT_THRESHOLD):
+    # Return the clusters of near-duplicate narratives across the projects
+    # (see find_near_duplicate_narratives). Only the signatures of projects
+    # whose files changed are computed again.
+    projects = list(projects)
+    def build():
+        signed = []
+        for project in projects:
+            signed.extend(load_project_signatures(project))
+        return cluster_narratives(signed, threshold)
+    return _clusters_cache.get((tuple(project["path"] for project in projects), threshold), build)
+
+def find_near_duplicate_narratives(controlimpls, threshold=DEFAULT_THRESHOLD):
+    # Find clusters of near-duplicate narratives among controlimpls. Only
+    # narratives for the same control (the same standard and control ID)
+    # are compared, but they may come from any component in any project.
+    # Returns a list of clusters, each a dict holding the control, the
+    # member controlimpls, and the similarity of each linked pair, sorted
+    # by standard and control.
+    return cluster_narratives(sign_narratives(controlimpls), threshold)
+
+def cluster_narratives(signed, threshold):
+    # Cluster signed narratives (see sign_narratives).
+    controlimpls = [controlimpl for controlimpl, shingles, signature in signed]
+    shingle_sets = [shingles for controlimpl, shingles, signature in signed]
+    signatures = [signature for controlimpl, shingles, signature in signed]
+
+    # Hash each band of each signature into a bucket. The bucket key
+    # includes the control so that only narratives for the same control
+    # can become candidates.
+    buckets = { }
+    for i, (controlimpl, signature) in enumerate(zip(controlimpls, signatures)):
+        if signature is None:
+            continue
+        control_key = (controlimpl["standard"]["id"], controlimpl["control"]["id"])
+        for band in range(NUM_BANDS):
+            band_values = signature[band*ROWS_PER_BAND:(band+1)*ROWS_PER_BAND]
+            buckets.setdefault((control_key, band, band_values), []).append(i)
+
+    # Gather candidate pairs from buckets with more than one member.
+    candidates = set()
+    for members in buckets.values():
+        for j in range(len(members)):
+            for k in range(j+1, len(members)):
+                candidates.add((members[j], members[k]))
+
+    # Verify the candidates. The signature estimate is a cheap filter and
+    # the exact Jaccard similarity of the shingle sets is the reported score.
+    # Link verified pairs into clusters with a union-find.
+    parent = list(range(len(controlimpls)))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    pairs = []
+    for j, k in sorted(candidates):
+        if estimate_similarity(signatures[j], signatures[k]) < threshold / 2:
+            continue
+        similarity = jaccard_similarity(shingle_sets[j], shingle_sets[k])
+        if similarity < threshold:
+            continue
+        pairs.append((j, k, similarity))
+        parent[find(j)] = find(k)
+
+    # Assemble the clusters.
+    clusters = { }
+    for j, k, similarity in pairs:
+        root = find(j)
+        if root not in clusters:
+            controlimpl = controlimpls[j]
+            clusters[root] = {
+                "standard": controlimpl["standard"],
+                "control": controlimpl["control"],
+                "members": set(),
+                "pairs": [],
+            }
+        clusters[root]["members"].update((j, k))
+        clusters[root]["pairs"].append({
+            "narratives": (controlimpls[j], controlimpls[k]),
+            "similarity": similarity,
+        })
+
+    # Sort the clusters by control, and the members within each cluster by
+    # project and component name.
+    clusters = list(clusters.values())
+    for cluster in clusters:
+        cluster["members"] = sorted(
+            (controlimpls[i] for i in cluster["members"]),
+            key = lambda controlimpl : (
+                controlimpl["component"]["project"]["title"],
+                controlimpl["component"]["name"],
+                controlimpl["control_part"] is not None,
+                controlimpl["control_part"]))
+        cluster["pairs"].sort(key = lambda pair : -pair["similarity"])
+        cluster["min_similarity"] = min(pair["similarity"] for pair in cluster["pairs"])
+        cluster["max_similarity"] = max(pair["similarity"] for pair in cluster["pairs"])
+    clusters.sort(key = lambda cluster : (cluster["standard"]["name"], cluster["control"]["sort_key"]))
+    return clusters
+
+if __name__ == "__main__":
+    # Report near-duplicate narratives across one or more projects.
+    from argparse import ArgumentParser
+    parser = ArgumentParser(description="Report near-duplicate control narratives across components.")
+    parser.add_argument("projectdir", nargs="+", help="path to a directory containing an opencontrol.yaml file")
+    parser.add_argument("-t", "--threshold", dest="threshold", type=float, default=DEFAULT_THRESHOLD,
+                        help="minimum Jaccard similarity of narratives to report (default %(default)s)")
+    args = parser.parse_args()
+
+    # Load the projects and find the clusters.
+    projects = [opencontrol.load_project_from_path(projectdir) for projectdir in args.projectdir]
+    clusters = find_near_duplicate_narratives(load_narratives(projects), threshold=args.threshold)
+
+    # Print a report.
+    for cluster in clusters:
+        print("{} {} ({} narratives, similarity {:.2f}-{:.2f})".format(
+            cluster["standard"]["name"],
+            cluster["control"]["id"],
+            len(cluster["members"]),
+            cluster["min_similarity"],
+            cluster["max_similarity"]))
+        for controlimpl in cluster["members"]:
+            print("  {} / {}{}".format(
+                controlimpl["component"]["project"]["title"],
+                controlimpl["component"]["name"],
+                " part " + controlimpl["control_part"] if controlimpl["control_part"] else ""))
+        print()
@@ -1,6 +1,7 @@
 # Construct system security plans from project data.
 
 from . import opencontrol
+from .cache import Cache
 
 def blockquote(s):
   # Prepend "> " to the start of each line in s.
@@ -78,6 +79,19 @@ def build_ssp(project, options):
 
   return buf.getvalue()
 
+# The exports served by the /ssp.md and /ssp.csv routes are cached until any
+# file they were built from changes (and kept warm by warmer.py).
+_export_cache = Cache("exports")
+
+def load_export(project, format):
+  # Return the project's SSP in the given format, "md" or "csv".
+  def builder():
+    if format == "md":
+      return build_ssp(project, {})
+    from .csv import build_csv
+    return build_csv(project, {})
+  return _export_cache.get((project["path"], format), builder)
+
 if __name__ == "__main__":
   # Parse for optionally including control description from standard
   from argparse import ArgumentParser
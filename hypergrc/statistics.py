@@ -0,0 +1,157 @@
+# Statistics about control implementations: how many controls, control
+# parts and control families are implemented, how many words are in the
+# narratives, and how many control parts have each implementation status.
+#
+# Statistics are kept per component in an additive form --- counts keyed
+# by control, by family and by status, plus the contribution of each
+# narrative --- so that they can be computed once, adjusted by a delta
+# when a single narrative is edited, and summed into project-level and
+# portfolio-level rollups without re-reading any narratives.
+
+import re
+
+from . import opencontrol
+from .cache import Cache, record_dependency, recording_dependencies
+
+_component_statistics_cache = Cache("statistics")
+
+def narrative_word_count(narrative):
+    return len(re.split(r"\W+", narrative))
+
+def new_statistics():
+    return {
+        "controls": { }, # (standard name, control number) => number of control parts
+        "families": { }, # family id => number of control parts
+        "implementation_statuses": { }, # implementation status => number of control parts
+        "family_statuses": { }, # (family id, implementation status) => number of control parts
+        "family_source_files": { }, # (family id, source file) => number of control parts
+        "family_names": { }, # family id => family name
+        "control_parts": 0,
+        "words": 0,
+    }
+
+def add_to_counter(counter, key, n):
+    counter[key] = counter.get(key, 0) + n
+    if counter[key] == 0:
+        del counter[key]
+
+def add_contribution(stats, contribution, sign=1):
+    # Add (or with sign=-1, remove) one narrative's contribution.
+    add_to_counter(stats["controls"], contribution["control"], sign)
+    add_to_counter(stats["families"], contribution["family"], sign)
+    add_to_counter(stats["implementation_statuses"], contribution["implementation_status"], sign)
+    add_to_counter(stats["family_statuses"], (contribution["family"], contribution["implementation_status"]), sign)
+    add_to_counter(stats["family_source_files"], (contribution["family"], contribution["source_file"]), sign)
+    stats["control_parts"] += sign
+    stats["words"] += sign * contribution["words"]
+
+def merge_statistics(stats_list):
+    # Sum any number of statistics records into a new one.
+    total = new_statistics()
+    for stats in stats_list:
+        for key in ("controls", "families", "implementation_statuses", "family_statuses", "family_source_files"):
+            for k, n in stats[key].items():
+                add_to_counter(total[key], k, n)
+        total["family_names"].update(stats["family_names"])
+        total["control_parts"] += stats["control_parts"]
+        total["words"] += stats["words"]
+    return total
+
+def narrative_key(controlimpl):
+    return (controlimpl["standard"]["id"], controlimpl["control"]["id"], controlimpl.get("control_part"))
+
+def build_statistics(controlimpls):
+    # Compute a statistics record from scratch. The record also remembers
+    # the contribution of each narrative so that edits can be applied as deltas.
+    stats = new_statistics()
+    stats["narratives"] = { }
+    for controlimpl in controlimpls:
+        contribution = {
+            "control": (controlimpl["standard"]["name"], controlimpl["control"]["number"]),
+            "family": controlimpl["family"]["id"],
+            "implementation_status": controlimpl["implementation_status"],
+            "words": narrative_word_count(controlimpl["narrative"]),
+            "source_file": controlimpl["source_file"],
+        }
+        stats["family_names"][controlimpl["family"]["id"]] = controlimpl["family"]["name"]
+        stats["narratives"][narrative_key(controlimpl)] = contribution
+        add_contribution(stats, contribution)
+    return stats
+
+def summarize_statistics(stats):
+    # Return the public (JSON) form of a statistics record.
+
+    # Re-label status an empty implementation status key as "Not specified"
+    implementation_status_counts = dict(stats["implementation_statuses"])
+    if "" in implementation_status_counts:
+       implementation_status_counts["Not specified"] = implementation_status_counts.pop("")
+
+    return {
+      "control_count": len(stats["controls"]),
+      "control_part_count": stats["control_parts"],
+      "control_families_count": len(stats["families"]),
+      "total_words": stats["words"],
+      "average_words_per_controlpart": stats["words"] / (stats["control_parts"] or 1), # don't err if no controlimpls
+      "implementation_status_counts": implementation_status_counts,
+    }
+
+def load_component_statistics(component, standards=None, standards_dependencies=None):
+    # Return the statistics record for a component, computing it only if the
+    # component's files have changed since it was last computed. standards
+    # may be given if the caller already has them loaded, together with the
+    # files they were loaded from (see cache.recording_dependencies).
+    if standards is None or standards_dependencies is None:
+        return _load_component_statistics(component, make_standards_getter(lambda : opencontrol.load_project_standards(component["project"])))
+    return _load_component_statistics(component, make_standards_getter(None, (standards, standards_dependencies)))
+
+def make_standards_getter(load, loaded=None):
+    # Return a function that returns the project's standards, calling load()
+    # for them the first time unless they are already loaded, given as
+    # (standards, the files they were loaded from). Every call records the
+    # standards' files as dependencies of the statistics being built, since
+    # the statistics hold the family names from the standards.
+    loaded = [loaded] if loaded else []
+    def get_standards():
+        if not loaded:
+            with recording_dependencies() as dependencies:
+                standards = load()
+            loaded.append((standards, dependencies))
+        else:
+            for fn, fingerprint in loaded[0][1].items():
+                record_dependency(fn, fingerprint)
+        return loaded[0][0]
+    return get_standards
+
+def _load_component_statistics(component, get_standards):
+    def builder():
+        return build_statistics(opencontrol.load_project_component_controls(component, get_standards()))
+    return _component_statistics_cache.get(component["path"], builder)
+
+def load_project_statistics(project):
+    # Return a mapping from component ids to statistics records for every
+    # component in the project. The project's standards are only loaded if
+    # some component's statistics need to be computed, and then only once.
+    get_standards = make_standards_getter(lambda : opencontrol.load_project_standards(project))
+    component_stats = { }
+    for component in opencontrol.load_project_components(project):
+        component_stats[component["id"]] = _load_component_statistics(component, get_standards)
+    return component_stats
+
+def update_narrative_statistics(component, old_controlimpl, new_controlimpl):
+    # Apply the edit of a single narrative --- which has already been saved
+    # to new_controlimpl["source_file"] --- to the component's statistics as a
+    # delta instead of recomputing them. If the statistics aren't cached or
+    # anything else changed on disk, the cache drops them instead and they
+    # will be recomputed on next use.
+    def updater(stats):
+        key = narrative_key(old_controlimpl)
+        if key not in stats["narratives"]:
+            raise KeyError(key)
+        old_contribution = stats["narratives"][key]
+        new_contribution = dict(old_contribution)
+        new_contribution["implementation_status"] = new_controlimpl["implementation_status"] or ""
+        new_contribution["words"] = narrative_word_count(new_controlimpl["narrative"])
+        add_contribution(stats, old_contribution, -1)
+        add_contribution(stats, new_contribution)
+        stats["narratives"][key] = new_contribution
+    _component_statistics_cache.update(component["path"], updater, [new_controlimpl["source_file"]])
@@ -0,0 +1,144 @@
+# Refreshing cached project data ahead of need.
+#
+# When a project's files change --- after a git pull, say --- the data
+# cached from them goes stale, and without the warmer it is rebuilt by the
+# next request that needs it, which is slow. The warmer is a background
+# thread that checks the cached data of recently viewed projects and
+# rebuilds whatever is stale or missing before anyone asks for it, most
+# viewed projects first.
+#
+# The warmer runs within a CPU budget, a fraction of one CPU: after each
+# piece of work it sleeps long enough that it is busy no more than that
+# fraction of the time. Since the warmer shares the interpreter with the
+# request handlers, that leaves the rest for them.
+
+import threading
+import time
+
+from . import routes
+from . import opencontrol
+from .cache import CACHES
+
+SETTINGS = {
+    # The fraction of one CPU the warmer may use. 0 turns the warmer off.
+    "cpu_budget": 0.25,
+
+    # Seconds between checks for stale data.
+    "interval": 5,
+
+    # Projects viewed within this many seconds are kept warm.
+    "recent": 24 * 60 * 60,
+}
+
+# The data kept warm for each project: a label, the name of the cache that
+# holds it, its key in the cache, and the function that loads it into the
+# cache. Statistics are loaded by the rollups, which are built from them.
+def get_parts():
+    from . import coverage, portfolio, baselines, api, ssp
+    return [
+        ("coverage", "coverage", lambda project : project["path"], coverage.load_project_coverage),
+        ("statistics", "rollups", lambda project : project["path"], portfolio.load_project_rollup),
+        ("baselines", "baselines", lambda project : project["path"], baselines.load_project_baseline),
+        ("api", "api", lambda project : project["path"], api.load_project_index),
+        ("ssp.md", "exports", lambda project : (project["path"], "md"), lambda project : ssp.load_export(project, "md")),
+        ("ssp.csv", "exports", lambda project : (project["path"], "csv"), lambda project : ssp.load_export(project, "csv")),
+    ]
+
+# Maps project paths to how often and when each was last viewed and warmed.
+_projects = { }
+_projects_lock = threading.Lock()
+_warmer = None
+
+def get_project_state(project_dir):
+    with _projects_lock:
+        if project_dir not in _projects:
+            _projects[project_dir] = {
+                "accesses": 0,
+                "last_access": None,
+                "last_warmed": None,
+                "warm_time": None,
+                "error": None,
+            }
+        return _projects[project_dir]
+
+def record_access(project):
+    # Note that a page of the project was viewed.
+    state = get_project_state(project["path"])
+    state["accesses"] += 1
+    state["last_access"] = time.time()
+
+def get_recent_projects():
+    # Return the paths of the projects still being served that were viewed
+    # recently, the most viewed first.
+    since = time.time() - SETTINGS["recent"]
+    with _projects_lock:
+        recent = [
+            (-state["accesses"], project_dir)
+            for project_dir, state in _projects.items()
+            if state["last_access"] is not None and state["last_access"] >= since
+        ]
+    served = set(routes.PROJECT_LIST)
+    return [project_dir for _, project_dir in sorted(recent) if project_dir in served]
+
+def get_cache(name):
+    for cache in CACHES:
+        if cache.name == name:
+            return cache
+    raise KeyError(name)
+
+def get_warm_state(project):
+    # Return a list of (label, is warm) pairs for the project's data.
+    return [
+        (label, get_cache(cache_name).is_warm(key(project)))
+        for label, cache_name, key, load in get_parts()
+    ]
+
+def throttle(duration):
+    # Sleep long enough after duration seconds of work to stay within the
+    # CPU budget. Work is measured in wall-clock time, which while the
+    # warmer holds the interpreter lock is about the same as CPU time.
+    budget = SETTINGS["cpu_budget"]
+    time.sleep(duration * (1 - budget) / budget)
+
+def warm_project(project_dir):
+    # Rebuild whatever of the project's cached data is stale. Returns
+    # whether anything was rebuilt.
+    start = time.perf_counter()
+    project = opencontrol.load_project_from_path(project_dir)
+    throttle(time.perf_counter() - start)
+
+    rebuilt = False
+    warm_time = 0
+    for label, cache_name, key, load in get_parts():
+        start = time.perf_counter()
+        if not get_cache(cache_name).is_warm(key(project)):
+            load(project)
+            rebuilt = True
+        duration = time.perf_counter() - start
+        warm_time += duration
+        throttle(duration)
+
+    if rebuilt:
+        state = get_project_state(project_dir)
+        state["last_warmed"] = time.time()
+        state["warm_time"] = warm_time
+    return rebuilt
+
+def warm():
+    while True:
+        time.sleep(SETTINGS["interval"])
+        for project_dir in get_recent_projects():
+            state = get_project_state(project_dir)
+            try:
+                warm_project(project_dir)
+                state["error"] = None
+            except Exception as e:
+                # The files may be in the middle of being edited. Whichever
+                # request needs the data will report the problem.
+                state["error"] = str(e)
+
+def start_warmer():
+    global _warmer
+    if _warmer is None and SETTINGS["cpu_budget"] > 0:
+        _warmer = threading.Thread(target=warm, name="hypergrc-cache-warmer", daemon=True)
+        _warmer.start()
@@ -1,47 +1,217 @@
 # python lint.py file.yaml
 # python lint.py file1.yaml file2.yaml file3.yaml
+# # lint every YAML file in repositories, or in those listed in a file
+# python lint.py path/to/repo1 path/to/repo2
+# python lint.py @repos.conf
 # # dry run (no changes)
 # python lint.py -n file.yaml
+# # check only, printing a JSON summary and exiting with status 1 if any
+# # file isn't linted
+# python lint.py --check @repos.conf
 #
 # Example:
 # python lint.py components/Drupal/AC-ACCESS_CONTROL.yaml
 #
+# Files are linted in a pool of processes, one per CPU. A file is only
+# written if linting changes it, and then atomically, so files that are
+# already linted keep their modification times and hyperGRC's caches of
+# them stay valid. The hashes of files that are known to be linted are
+# kept in a cache file so that they aren't even parsed the next time.
 
 
 import argparse
 import difflib
+import hashlib
+import json
+import os
+import sys
+import tempfile
 
 import rtyaml
 
 
-# Parse command-line arguments.
-parser = argparse.ArgumentParser(description='Lint some YAML files.')
-parser.add_argument('files', nargs='+', help='an integer for the accumulator')
-parser.add_argument('-n', dest="dry_run", action='store_true', help='dry run (print diff instead of rewriting file)')
-args = parser.parse_args()
+# Where the hashes of linted files are kept by default.
+DEFAULT_CACHE = os.path.join(tempfile.gettempdir(), "hypergrc-lint-cache.json")
 
-# Process each file on the command line.
-for fn in args.files:
-	# Read and parse the YAML file.
-	with open(fn, encoding="utf8") as f:
-		in_text = f.read()
+
+def find_files(paths):
+	# Yield the YAML files named by the command line: files, directories
+	# (e.g. repositories) to search for YAML files, and @-prefixed files
+	# that list more paths, like repos.conf.
+	for path in paths:
+		if path.startswith("@"):
+			with open(path[1:], encoding="utf8") as f:
+				listed = [line.strip() for line in f]
+			yield from find_files([line for line in listed if line and not line.startswith("#")])
+		elif os.path.isdir(path):
+			for dirpath, dirnames, filenames in os.walk(path):
+				# Skip .git and other hidden directories.
+				dirnames[:] = sorted(dirname for dirname in dirnames if not dirname.startswith("."))
+				for fn in sorted(filenames):
+					if fn.endswith((".yaml", ".yml")):
+						yield os.path.join(dirpath, fn)
+		else:
+			yield path
+
+
+def get_linter_version():
+	# Return a value that changes when the output of linting might change,
+	# i.e. when rtyaml or PyYAML is upgraded.
+	import yaml
+	with open(rtyaml.__file__, "rb") as f:
+		return hashlib.sha256(f.read()).hexdigest() + "/" + yaml.__version__
+
+
+def read_cache(fn):
+	# Return the set of hashes of file contents known to be linted.
+	try:
+		with open(fn, encoding="utf8") as f:
+			cache = json.load(f)
+	except (OSError, ValueError):
+		return set()
+	if cache.get("linter") != get_linter_version():
+		return set()
+	return set(cache["clean"])
+
+
+def write_file(fn, data):
+	# Replace the file atomically, keeping its permissions.
+	import shutil
+	fd, tmp_fn = tempfile.mkstemp(dir=os.path.dirname(fn) or ".", prefix=".lint-")
+	try:
+		with os.fdopen(fd, "wb") as f:
+			f.write(data)
+		if os.path.exists(fn):
+			shutil.copymode(fn, tmp_fn)
+		os.replace(tmp_fn, fn)
+	except:
+		os.unlink(tmp_fn)
+		raise
+
+
+def lint_file(job):
+	# Lint one file. Runs in a worker process. Returns the file name, what
+	# happened ("clean", "linted" if it was rewritten, "unlinted" if it
+	# needs linting but wasn't rewritten, or "error"), the hash of its
+	# content if it was clean, and a diff or error message.
+	fn, write, show_diff = job
+	try:
+		# Read and parse the YAML file.
+		with open(fn, "rb") as f:
+			in_data = f.read()
+		in_text = in_data.decode("utf8")
 		data = rtyaml.load(in_text)
 
-	# Lint.
-	out_text = rtyaml.dump(data)
+		# Lint.
+		out_text = rtyaml.dump(data)
+		out_data = out_text.encode("utf8")
+	except Exception as e:
+		return (fn, "error", None, str(e))
+
+	if out_data == in_data:
+		return (fn, "clean", hashlib.sha256(in_data).hexdigest(), None)
 
 	# If doing a dry run, show a unified diff.
-	if args.dry_run:
-		diff = difflib.unified_diff(
+	diff = None
+	if show_diff:
+		diff = "\n".join(difflib.unified_diff(
 			in_text.split("\n"),
 			out_text.split("\n"),
 			fromfile=fn + " (original)",
 			tofile=fn + " (linted)",
-			lineterm="")
-		for line in diff:
-			print(line)
-		continue
+			lineterm=""))
+	if not write:
+		return (fn, "unlinted", None, diff)
 
 	# Write back out.
-	with open(fn, "w") as f:
-		f.write(out_text)
\ No newline at end of file
+	try:
+		write_file(fn, out_data)
+	except OSError as e:
+		return (fn, "error", None, str(e))
+	# Linting isn't always idempotent, so the new content is only known to
+	# be clean once it is linted again without changes.
+	return (fn, "linted", None, diff)
+
+
+def lint_files(files, write, show_diff, cache, workers):
+	# Lint the files, skipping those whose hashes are in the cache (a set,
+	# to which the hashes of clean files are added). Yields the results of
+	# lint_file, with a None hash for skipped files.
+	jobs = []
+	for fn in files:
+		try:
+			with open(fn, "rb") as f:
+				file_hash = hashlib.sha256(f.read()).hexdigest()
+		except OSError as e:
+			yield (fn, "error", None, str(e))
+			continue
+		if file_hash in cache:
+			yield (fn, "skipped", None, None)
+		else:
+			jobs.append((fn, write, show_diff))
+
+	if workers > 1 and len(jobs) > 1:
+		from concurrent.futures import ProcessPoolExecutor
+		with ProcessPoolExecutor(max_workers=workers) as pool:
+			chunksize = max(1, len(jobs) // (workers * 4))
+			for result in pool.map(lint_file, jobs, chunksize=chunksize):
+				yield result
+	else:
+		for job in jobs:
+			yield lint_file(job)
+
+
+def main():
+	# Parse command-line arguments.
+	parser = argparse.ArgumentParser(description='Lint some YAML files.')
+	parser.add_argument('files', nargs='+', help='YAML files, directories of YAML files such as OpenControl repositories, or @file to read a list of them from a file such as repos.conf')
+	parser.add_argument('-n', dest="dry_run", action='store_true', help='dry run (print diff instead of rewriting file)')
+	parser.add_argument('--check', action='store_true', help='don\'t rewrite files; print a JSON summary and exit with status 1 if any file isn\'t linted')
+	parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='number of processes to lint files in (default: one per CPU)')
+	parser.add_argument('--cache', default=DEFAULT_CACHE, help='file to keep the hashes of linted files in (default: {})'.format(DEFAULT_CACHE))
+	parser.add_argument('--no-cache', action='store_true', help='lint every file, even those known to be linted')
+	args = parser.parse_args()
+
+	cache = set() if args.no_cache else read_cache(args.cache)
+	cache_size = len(cache)
+	write = not (args.dry_run or args.check)
+
+	# Process each file on the command line.
+	summary = { "files": 0, "skipped": 0, "clean": 0, "linted": [], "unlinted": [], "errors": [] }
+	for fn, status, file_hash, message in lint_files(find_files(args.files), write, args.dry_run, cache, max(1, args.workers)):
+		summary["files"] += 1
+		if file_hash is not None:
+			cache.add(file_hash)
+		if status in ("skipped", "clean"):
+			summary[status] += 1
+		elif status == "error":
+			summary["errors"].append({ "file": fn, "error": message })
+			print("{}: {}".format(fn, message), file=sys.stderr)
+		else:
+			summary[status].append(fn)
+			if message:
+				print(message)
+			elif status == "linted" and not args.check:
+				print("linted {}".format(fn))
+
+	# Remember which files are linted for next time.
+	if not args.no_cache and len(cache) > cache_size:
+		write_file(args.cache, json.dumps({
+			"linter": get_linter_version(),
+			"clean": sorted(cache),
+		}).encode("utf8"))
+
+	if args.check:
+		print(json.dumps(summary, indent=2))
+		if summary["unlinted"] or summary["errors"]:
+			sys.exit(1)
+	else:
+		print("{} files: {} already linted, {} linted, {} to lint, {} errors.".format(
+			summary["files"], summary["skipped"] + summary["clean"], len(summary["linted"]),
+			len(summary["unlinted"]), len(summary["errors"])), file=sys.stderr)
+		if summary["errors"]:
+			sys.exit(1)
+
+
+if __name__ == "__main__":
+	main()